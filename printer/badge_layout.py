@@ -0,0 +1,398 @@
+"""
+標籤佈局模組
+將 Node 端保存的 BadgeConfig（model/BadgeConfig.js）編譯為可重複使用的渲染計劃：
+圖層按 zIndex 排序，字體和圖片預先加載，不含變量的底層圖層預先繪製，
+每次打印只需填入 {{user.name}} 等變量
+"""
+
+import base64
+import hashlib
+import io
+import json
+import os
+import re
+import urllib.parse
+import urllib.request
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
+
+from PIL import Image, ImageDraw
+
+from brother_ql_raster import DEFAULT_MEDIA, printable_size
+from print_metrics import timed_stage
+from label_renderer import (
+    convert_image, create_label_image, get_font, ink, new_image, render_qr,
+    resolve_color_mode, resolve_font_path,
+)
+
+# {{user.name}}、{{qrcodeUrl}} 等變量
+VARIABLE_PATTERN = re.compile(r'\{\{\s*([\w.]+)\s*\}\}')
+
+# 本地圖片（例如 /uploads/logo.png）相對於 Node 的 public 目錄，不能讀取此目錄以外的文件
+BADGE_ASSET_ROOT = os.getenv(
+    'BADGE_ASSET_ROOT',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'public')
+)
+
+# 單張圖片（遠程圖片、data URL 或本地文件）的大小上限（bytes）
+BADGE_IMAGE_MAX_BYTES = int(os.getenv('BADGE_IMAGE_MAX_BYTES', 5 * 1024 * 1024))
+REMOTE_IMAGE_TIMEOUT = 5
+
+MM_TO_INCH = 0.0393701
+
+
+def empty_if_dash(value) -> str:
+    """值為 '-' 或空則視為不顯示（與 Node 端 emptyIfDash 一致）"""
+    if value is None or value == '':
+        return ''
+    text = str(value).strip()
+    return '' if text == '-' else text
+
+
+class TextTemplate:
+    """預先解析的變量模板"""
+
+    def __init__(self, text: Optional[str]):
+        self.text = text or ''
+        self.variables = VARIABLE_PATTERN.findall(self.text)
+
+    @property
+    def dynamic(self) -> bool:
+        return bool(self.variables)
+
+    def render(self, data: Dict) -> str:
+        if not self.variables:
+            return self.text
+
+        def replace(match):
+            name = match.group(1)
+            if name.startswith('user.'):
+                user = data.get('user') or {}
+                return empty_if_dash(user.get(name[5:]))
+            if name in data:
+                return empty_if_dash(data[name])
+            # 未知變量保持原樣（與 Node 端 replaceVariables 一致）
+            return match.group(0)
+
+        return VARIABLE_PATTERN.sub(replace, self.text)
+
+
+def qr_payload(value: str) -> str:
+    """
+    QR Code 內容
+    Node 端默認的 qrcodeUrl 是 api.qrserver.com 的圖片 URL，這裡取出其 data 參數在本地生成，避免每次打印都請求外部服務
+    """
+    if value.startswith('http'):
+        query = urllib.parse.parse_qs(urllib.parse.urlparse(value).query)
+        if query.get('data'):
+            return query['data'][0]
+    return value
+
+
+def is_remote(url: str) -> bool:
+    return url.startswith('http://') or url.startswith('https://')
+
+
+def resolve_asset_path(url: str) -> str:
+    """
+    本地圖片的路徑: 一律相對於 BADGE_ASSET_ROOT（/uploads/logo.png 即 <root>/uploads/logo.png），
+    解析 .. 和符號鏈接後不在 BADGE_ASSET_ROOT 內時拋出 ValueError
+    """
+    root = os.path.realpath(BADGE_ASSET_ROOT)
+    path = os.path.realpath(os.path.join(root, url.lstrip('/\\')))
+    if os.path.commonpath([root, path]) != root:
+        raise ValueError(f'圖片路徑不在 BADGE_ASSET_ROOT 內: {url}')
+    return path
+
+
+def _read_limited(stream, source: str) -> bytes:
+    raw = stream.read(BADGE_IMAGE_MAX_BYTES + 1)
+    if len(raw) > BADGE_IMAGE_MAX_BYTES:
+        raise ValueError(f'圖片超過 {BADGE_IMAGE_MAX_BYTES} bytes: {source}')
+    return raw
+
+
+def fetch_remote_image(url: str) -> bytes:
+    """下載遠程圖片（只在註冊佈局時調用），超過 BADGE_IMAGE_MAX_BYTES 時拋出 ValueError"""
+    with urllib.request.urlopen(url, timeout=REMOTE_IMAGE_TIMEOUT) as response:
+        length = response.headers.get('Content-Length')
+        if length and length.isdigit() and int(length) > BADGE_IMAGE_MAX_BYTES:
+            raise ValueError(f'圖片超過 {BADGE_IMAGE_MAX_BYTES} bytes: {url}')
+        return _read_limited(response, url)
+
+
+def embed_remote_images(config: Dict) -> Dict:
+    """
+    註冊佈局時下載不含變量的遠程圖片（http(s)），替換為 data URL，
+    之後打印（包括渲染進程）不再請求網路；含變量的圖片 URL 打印時只能是 data URL 或本地圖片
+    """
+    elements = []
+    for element in config.get('elements') or []:
+        url = element.get('imageUrl') if isinstance(element, dict) and element.get('type') == 'image' else None
+        if isinstance(url, str) and is_remote(url) and not TextTemplate(url).dynamic:
+            raw = fetch_remote_image(url)
+            image_format = Image.open(io.BytesIO(raw)).format
+            mime = Image.MIME.get(image_format, 'application/octet-stream')
+            element = dict(element, imageUrl=f'data:{mime};base64,{base64.b64encode(raw).decode("ascii")}')
+        elements.append(element)
+    return dict(config, elements=elements)
+
+
+@lru_cache(maxsize=64)
+def load_image(url: str) -> Image.Image:
+    """
+    加載圖片（data URL 或 BADGE_ASSET_ROOT 內的本地圖片），結果按 URL 緩存
+    遠程圖片只在註冊佈局時下載（見 embed_remote_images），打印時不請求網路
+    返回的圖像為共享對象，只能讀取
+    """
+    if url.startswith('data:'):
+        encoded = url.split(',', 1)[1]
+        if len(encoded) * 3 // 4 > BADGE_IMAGE_MAX_BYTES:
+            raise ValueError(f'圖片超過 {BADGE_IMAGE_MAX_BYTES} bytes')
+        raw = base64.b64decode(encoded)
+    elif is_remote(url):
+        raise ValueError(f'遠程圖片需要在註冊佈局時下載（POST /layouts），打印時不請求: {url}')
+    else:
+        with open(resolve_asset_path(url), 'rb') as f:
+            raw = _read_limited(f, url)
+    img = Image.open(io.BytesIO(raw))
+    img.load()
+    return img.convert('RGBA')
+
+
+class RenderLayer:
+    """單個 BadgeConfig 元素編譯後的圖層"""
+
+    def __init__(self, element: Dict, canvas_width: int, color_mode: str):
+        self.type = element.get('type')
+        self.color_mode = color_mode
+        self.x = int(element.get('x') or 0)
+        self.y = int(element.get('y') or 0)
+        self.width = element.get('width')
+        self.height = element.get('height')
+        self.z_index = element.get('zIndex') or 0
+        self.asset = None
+
+        if self.type == 'text':
+            self.template = TextTemplate(element.get('content'))
+            font_size = round((element.get('fontSize') or 16) * (element.get('size') or 100) / 100)
+            bold = str(element.get('fontWeight') or 'normal').lower() in ('bold', '600', '700', '800', '900')
+            self.font = get_font(resolve_font_path(bold), font_size)
+            self.line_height = font_size * 1.2
+            self.color = ink(element.get('color') or '#000000', color_mode)
+            # fullWidth 時元素寬度為整個標籤寬度並強制置中
+            if element.get('fullWidth'):
+                self.x = 0
+                self.box_width = canvas_width
+                self.align = 'center'
+            else:
+                self.box_width = self.width or 300
+                self.align = element.get('textAlign') or 'center'
+        elif self.type == 'qrcode':
+            self.template = TextTemplate(element.get('qrData') or '{{qrcodeUrl}}')
+        elif self.type == 'image':
+            self.template = TextTemplate(element.get('imageUrl'))
+        else:
+            raise ValueError(f'未知的元素類型: {self.type}')
+
+        # 靜態 QR Code / 圖片在編譯時準備好
+        if not self.template.dynamic and self.type in ('qrcode', 'image'):
+            self.asset = self._prepare_asset(self.template.text)
+
+    @property
+    def dynamic(self) -> bool:
+        return self.template.dynamic
+
+    def inside(self, size: Tuple[int, int]) -> bool:
+        """
+        元素是否在畫布內（估計）: 文字只檢查首行的位置（文字框通常比文字寬），圖片和 QR Code 檢查整個範圍
+        """
+        if self.type == 'text':
+            anchor_x = self.x + {'left': 0, 'right': self.box_width}.get(self.align, self.box_width / 2)
+            return 0 <= anchor_x <= size[0] and 0 <= self.y and self.y + self.line_height <= size[1]
+        if self.type == 'qrcode':
+            width = int(self.width or 200)
+            height = int(self.height or width)
+        else:
+            width = int(self.width or (self.asset[0].width if self.asset else 0))
+            height = int(self.height or (self.asset[0].height if self.asset else 0))
+        return self.x >= 0 and self.y >= 0 and self.x + width <= size[0] and self.y + height <= size[1]
+
+    def _prepare_asset(self, value: str) -> Optional[Tuple[Image.Image, Optional[Image.Image]]]:
+        """準備圖片並轉換為標籤的顏色模式，返回 (圖像, 遮罩)"""
+        if not value.strip():
+            return None
+        try:
+            if self.type == 'qrcode':
+                size = int(self.width or 200)
+                asset = render_qr(qr_payload(value), size)
+                if self.height and int(self.height) != size:
+                    asset = asset.resize((size, int(self.height)), Image.Resampling.NEAREST)
+            else:
+                asset = load_image(value)
+                if self.width or self.height:
+                    size = (int(self.width or asset.width), int(self.height or asset.height))
+                    if size != asset.size:
+                        asset = asset.resize(size, Image.Resampling.LANCZOS)
+            return convert_image(asset, self.color_mode)
+        except Exception as e:
+            print(f"⚠️  標籤元素 {self.type} 加載失敗: {e}")
+            return None
+
+    def _wrap(self, text: str) -> List[str]:
+        """按空格換行（與 Node 端 wrapText 一致）"""
+        max_width = self.box_width - 10
+        words = text.split(' ')
+        lines = []
+        current = words[0]
+        for word in words[1:]:
+            if self.font.getlength(f'{current} {word}') < max_width:
+                current = f'{current} {word}'
+            else:
+                lines.append(current)
+                current = word
+        lines.append(current)
+        return lines
+
+    def draw(self, img: Image.Image, draw: ImageDraw.ImageDraw, data: Dict):
+        if self.type == 'text':
+            content = self.template.render(data)
+            if not content.strip():
+                return
+            if self.align == 'right':
+                x, anchor = self.x + self.box_width, 'ra'
+            elif self.align == 'left':
+                x, anchor = self.x, 'la'
+            else:
+                x, anchor = self.x + self.box_width / 2, 'ma'
+            for index, line in enumerate(self._wrap(content)):
+                draw.text((x, self.y + index * self.line_height), line, fill=self.color, font=self.font, anchor=anchor)
+            return
+
+        prepared = self.asset if not self.dynamic else self._prepare_asset(self.template.render(data))
+        if prepared is None:
+            return
+        asset, mask = prepared
+        img.paste(asset, (self.x, self.y), mask)
+
+
+class RenderPlan:
+    """
+    BadgeConfig 編譯後的渲染計劃
+    畫布為介質的可打印範圍，設計居中放在標籤上: 元素座標按兩側不可打印的邊距平移，
+    不縮放（縮放會使 QR Code 模塊變形）；超出可打印範圍的元素在編譯時警告
+    """
+
+    def __init__(self, config: Dict, color_mode: Optional[str] = None, media: str = DEFAULT_MEDIA):
+        self.color_mode = resolve_color_mode(color_mode)
+        self.media = media
+        self.name = config.get('name', 'Badge')
+        self.dpi = config.get('dpi') or 300
+        self.width_mm = config.get('width') or 100
+        self.height_mm = config.get('height') or 62
+        # 與 BadgeConfig.getPixelDimensions() 相同的換算
+        self.width_px = round(self.width_mm * MM_TO_INCH * self.dpi)
+        self.height_px = round(self.height_mm * MM_TO_INCH * self.dpi)
+
+        # 橫向設計（例如 100mm x 62mm）的高度方向對應打印頭，打印時旋轉 90 度
+        landscape = self.width_px > self.height_px
+        across, along = printable_size(media, self.width_px if landscape else self.height_px)
+        self.canvas_size = (along, across) if landscape else (across, along)
+        self.margin = ((self.width_px - self.canvas_size[0]) // 2, (self.height_px - self.canvas_size[1]) // 2)
+
+        elements = sorted(config.get('elements') or [], key=lambda e: e.get('zIndex') or 0)
+        layers = [RenderLayer(element, self.width_px, self.color_mode) for element in elements]
+        self.clipped = []
+        for layer in layers:
+            layer.x -= self.margin[0]
+            layer.y -= self.margin[1]
+            if not layer.inside(self.canvas_size):
+                self.clipped.append(layer.type)
+        if self.clipped:
+            print(f"⚠️  佈局 {self.name} 有 {len(self.clipped)} 個元素超出介質 {media} 的可打印範圍，超出部分不會打印")
+
+        # 第一個含變量的圖層之前的靜態圖層預先繪製到底圖
+        split = next((i for i, layer in enumerate(layers) if layer.dynamic), len(layers))
+        self.static_layers = layers[:split]
+        self.layers = layers[split:]
+
+        self.base = new_image(*self.canvas_size, self.color_mode)
+        base_draw = ImageDraw.Draw(self.base)
+        for layer in self.static_layers:
+            layer.draw(self.base, base_draw, {})
+
+    def render(self, data: Dict) -> Image.Image:
+        img = self.base.copy()
+        draw = ImageDraw.Draw(img)
+        for layer in self.layers:
+            layer.draw(img, draw, data)
+        return img
+
+    def to_dict(self) -> Dict:
+        return {
+            'name': self.name,
+            'width_mm': self.width_mm,
+            'height_mm': self.height_mm,
+            'dpi': self.dpi,
+            'color_mode': self.color_mode,
+            'width_px': self.width_px,
+            'height_px': self.height_px,
+            'media': self.media,
+            'canvas_px': list(self.canvas_size),
+            'margin_px': list(self.margin),
+            'clipped_elements': len(self.clipped),
+            'static_layers': len(self.static_layers),
+            'dynamic_layers': len(self.layers),
+            'variables': sorted({v for layer in self.layers for v in layer.template.variables}),
+        }
+
+
+def config_fingerprint(config: Dict) -> str:
+    """BadgeConfig 的穩定 JSON 表示"""
+    return json.dumps(config, sort_keys=True, ensure_ascii=False, default=str)
+
+
+def layout_id(config: Dict) -> str:
+    """根據內容生成佈局 ID（內容相同的配置共用同一個渲染計劃）"""
+    return hashlib.sha1(config_fingerprint(config).encode('utf-8')).hexdigest()[:12]
+
+
+@lru_cache(maxsize=32)
+def _compile_plan(fingerprint: str, color_mode: str, media: str) -> RenderPlan:
+    return RenderPlan(json.loads(fingerprint), color_mode, media)
+
+
+def get_render_plan(config: Dict, color_mode: Optional[str] = None, media: str = DEFAULT_MEDIA) -> RenderPlan:
+    """編譯 BadgeConfig（按內容、顏色模式和介質緩存，只編譯一次）"""
+    return _compile_plan(config_fingerprint(config), resolve_color_mode(color_mode), media)
+
+
+def badge_data(item: Dict) -> Dict:
+    """
+    從打印請求構建模板變量
+    可直接提供 data（與 Node 端 generateBadgeImage 的 data 相同），
+    否則使用 user / name / company / qrcode 欄位
+    """
+    if item.get('data'):
+        return item['data']
+    user = dict(item.get('user') or {})
+    user.setdefault('name', item.get('name', ''))
+    user.setdefault('company', item.get('company', ''))
+    return {
+        'user': user,
+        'qrcodeUrl': item.get('qrcode', user.get('name', '')),
+    }
+
+
+def render_item_image(item: Dict, media: str = DEFAULT_MEDIA) -> Image.Image:
+    """
+    渲染打印請求: 帶 badge_config 時使用佈局引擎，否則使用默認標籤（均按 media 的可打印範圍渲染）
+    可用 color_mode 欄位覆蓋默認的顏色模式
+    """
+    color_mode = item.get('color_mode')
+    config = item.get('badge_config')
+    with timed_stage('render'):
+        if config:
+            return get_render_plan(config, color_mode, media).render(badge_data(item))
+        name = item.get('name', '')
+        return create_label_image(name, item.get('company', ''), item.get('qrcode', name), color_mode, media)
@@ -0,0 +1,198 @@
+"""
+批量標籤渲染模組
+使用進程池並行渲染標籤，按提交順序逐張返回結果，供打印線程邊渲染邊發送
+"""
+
+import multiprocessing
+import os
+import time
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from functools import partial
+from typing import Callable, Dict, Iterable, Iterator, Optional, Sequence
+import threading
+
+from label_renderer import cache_counters, encode_label_png
+from badge_layout import render_item_image
+from print_metrics import collect_stages, timed_stage
+from brother_ql_raster import encode_label, encode_label_page, DEFAULT_MEDIA
+
+# 渲染進程的啟動方式: 進程池在打印線程、mDNS 和狀態監控線程啟動之後才創建，
+# fork 會複製其他線程持有的鎖，子進程可能因此死鎖；forkserver 從單線程的服務進程 fork（不支援時使用 spawn）
+START_METHOD = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+
+
+def render_label_payload(item: Dict, formats: Sequence[str] = ('png',), media: str = DEFAULT_MEDIA) -> Dict:
+    """
+    渲染單張標籤並編碼為打印數據（在子進程中執行）
+    formats: 'png'（CUPS 使用）、'raster'（直接網路打印使用）和/或 'page'（多頁任務串流使用的單頁數據）
+    """
+    start = time.perf_counter()
+    payload = {'name': item.get('name', '')}
+    # 各階段耗時隨結果返回，由主進程記錄到 /metrics
+    with collect_stages() as stages:
+        label_img = render_item_image(item, media)
+        if 'png' in formats:
+            with timed_stage('encode_png'):
+                payload['png'] = encode_label_png(label_img)
+        if 'raster' in formats:
+            with timed_stage('encode_raster'):
+                payload['raster'] = encode_label(label_img, media=media)
+        if 'page' in formats:
+            with timed_stage('encode_raster'):
+                payload['page'] = encode_label_page(label_img, media=media)
+
+    payload['stages'] = stages
+    payload['render_cache'] = cache_counters()
+    payload['render_ms'] = round((time.perf_counter() - start) * 1000, 3)
+    payload['pid'] = os.getpid()
+    return payload
+
+
+class BatchRenderer:
+    """
+    進程池批量渲染器
+    進程池在第一次使用時創建，大小默認為 CPU 核心數
+    """
+
+    def __init__(self, workers: Optional[int] = None, window: Optional[int] = None):
+        self.workers = workers or os.cpu_count() or 1
+        # 同時在進程池中的任務數，限制未發送結果佔用的記憶體
+        self.window = window or self.workers * 4
+        self._executor = None
+        self._lock = threading.Lock()
+        self.backlog = 0  # 已提交到進程池但未完成的批量渲染數
+        self.inline_renders = 0
+        self._worker_caches = {}  # 渲染進程 PID -> 最近一次返回的緩存統計
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                context = multiprocessing.get_context(START_METHOD)
+                if START_METHOD == 'forkserver':
+                    # 渲染模組（PIL、字體、QR Code）在服務進程中導入一次，每個渲染進程無需重新導入
+                    context.set_forkserver_preload(['batch_renderer'])
+                self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=context)
+            return self._executor
+
+    def warm_up(self):
+        """
+        預先啟動所有子進程
+        在啟動後台線程之前調用，避免第一個請求承擔進程啟動耗時
+        """
+        executor = self._get_executor()
+        for future in [executor.submit(os.getpid) for _ in range(self.workers)]:
+            future.result()
+
+    def _collect(self, item: Dict, future, submitted_at: float) -> Dict:
+        try:
+            payload = future.result()
+        except Exception as e:
+            payload = {'name': item.get('name', ''), 'error': str(e)}
+        counters = payload.pop('render_cache', None)
+        if counters and payload.get('pid') != os.getpid():
+            with self._lock:
+                self._worker_caches[payload['pid']] = counters
+        payload['wait_ms'] = round((time.perf_counter() - submitted_at) * 1000, 3)
+        return payload
+
+    def _track(self, future):
+        with self._lock:
+            self.backlog += 1
+        future.add_done_callback(self._untrack)
+        return future
+
+    def _untrack(self, future):
+        with self._lock:
+            self.backlog -= 1
+
+    def render_one(self, item: Dict, formats: Sequence[str] = ('png',), media: str = DEFAULT_MEDIA) -> Dict:
+        """
+        在進程池中渲染單張標籤並等待結果（可從多個線程同時調用）
+        進程池正忙於批量渲染時在當前線程渲染，不排在批量標籤之後
+        """
+        start = time.perf_counter()
+        if self.backlog < self.workers:
+            future = self._get_executor().submit(render_label_payload, item, tuple(formats), media)
+            return self._collect(item, future, start)
+
+        self.inline_renders += 1
+        future = Future()
+        try:
+            payload = render_label_payload(item, tuple(formats), media)
+            # 在本進程渲染時各階段耗時已直接記錄，不再隨結果返回
+            payload['stages'] = {}
+            future.set_result(payload)
+        except Exception as e:
+            future.set_exception(e)
+        return self._collect(item, future, start)
+
+    def render(self, items: Iterable[Dict], formats: Sequence[str] = ('png',),
+               media: str = DEFAULT_MEDIA,
+               lookup: Optional[Callable[[Dict], Optional[Dict]]] = None) -> Iterator[Dict]:
+        """
+        並行渲染，按輸入順序逐張產出結果
+        渲染異常時產出 {'name': ..., 'error': ...}
+        lookup(item) 返回已渲染的 payload（例如預渲染緩存）時不再提交到進程池
+        items 中的 None 表示暫時沒有新項目（流式輸入），先產出已完成的結果，然後產出 None，
+        讓調用者處理其他已完成的工作（例如已發送的標籤）
+        """
+        executor = self._get_executor()
+        task = partial(render_label_payload, formats=tuple(formats), media=media)
+        pending = deque()
+
+        for item in items:
+            if item is None:
+                while pending and pending[0][1].done():
+                    yield self._collect(*pending.popleft())
+                yield None
+                continue
+            payload = lookup(item) if lookup else None
+            if payload is not None:
+                future = Future()
+                future.set_result(payload)
+            else:
+                future = self._track(executor.submit(task, item))
+            pending.append((item, future, time.perf_counter()))
+            if len(pending) >= self.window:
+                yield self._collect(*pending.popleft())
+
+        while pending:
+            yield self._collect(*pending.popleft())
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(cancel_futures=True)
+                self._executor = None
+            self._worker_caches.clear()
+
+    def cache_stats(self) -> Dict:
+        """
+        各渲染進程的緩存命中統計匯總（每個進程最近一次渲染時的數字；size 為各進程之和，max_size 為每個進程的上限）
+        """
+        with self._lock:
+            workers = list(self._worker_caches.values())
+        stats = {'processes': len(workers)}
+        for cache_name in ('fonts', 'qrcodes'):
+            caches = [counters[cache_name] for counters in workers]
+            hits = sum(cache['hits'] for cache in caches)
+            misses = sum(cache['misses'] for cache in caches)
+            stats[cache_name] = {
+                'hits': hits,
+                'misses': misses,
+                'hit_rate': round(hits / (hits + misses), 4) if hits + misses else None,
+                'size': sum(cache['size'] for cache in caches),
+                'max_size': caches[0]['max_size'] if caches else None,
+            }
+        return stats
+
+    def stats(self) -> Dict:
+        return {
+            'workers': self.workers,
+            'window': self.window,
+            'started': self._executor is not None,
+            'start_method': START_METHOD,
+            'backlog': self.backlog,
+            'inline_renders': self.inline_renders,
+        }
@@ -0,0 +1,527 @@
+"""
+Brother QL 光柵命令編碼模組
+將標籤圖像轉換為 Brother QL-800 系列（QL-820NWB）可直接解析的光柵命令，
+可經由 9100 端口直接發送，無需 CUPS 驅動轉換
+
+參考: Brother QL-800/810W/820NWB Raster Command Reference
+"""
+
+import struct
+from typing import Dict, List, Optional, Tuple
+
+from PIL import Image
+
+# 打印頭總寬度（點），每行光柵數據 90 bytes
+HEAD_DOTS = 720
+LINE_BYTES = HEAD_DOTS // 8
+
+# 介質類型
+MEDIA_CONTINUOUS = 0x0A
+MEDIA_DIE_CUT = 0x0B
+
+# 支援的標籤規格（300 DPI）
+MEDIA_PROFILES = {
+    # DK-22205 62mm 連續標籤，長度由圖像決定
+    '62': {
+        'media_type': MEDIA_CONTINUOUS,
+        'width_mm': 62,
+        'length_mm': 0,
+        'printable_dots': 696,
+        'right_margin_dots': 12,
+        'length_dots': None,
+        'feed_margin': 35,
+    },
+    # DK-22251 62mm 紅黑雙色連續標籤（QL-800 系列雙色打印）
+    '62red': {
+        'media_type': MEDIA_CONTINUOUS,
+        'width_mm': 62,
+        'length_mm': 0,
+        'printable_dots': 696,
+        'right_margin_dots': 12,
+        'length_dots': None,
+        'feed_margin': 35,
+        'two_color': True,
+    },
+    # DK-11202 62mm x 100mm 預切標籤
+    '62x100': {
+        'media_type': MEDIA_DIE_CUT,
+        'width_mm': 62,
+        'length_mm': 100,
+        'printable_dots': 696,
+        'right_margin_dots': 12,
+        'length_dots': 1109,
+        'feed_margin': 0,
+    },
+}
+
+DEFAULT_MEDIA = '62'
+
+
+def printable_size(media: str = DEFAULT_MEDIA, length_dots: Optional[int] = None) -> Tuple[int, int]:
+    """
+    介質的可打印範圍: (打印頭方向點數, 進紙方向點數)
+    預切標籤的長度固定，連續標籤的長度由 length_dots（圖像長度）決定
+    """
+    profile = MEDIA_PROFILES[media]
+    return profile['printable_dots'], profile['length_dots'] or length_dots
+
+# 命令
+CMD_INVALIDATE = b'\x00' * 400
+CMD_INITIALIZE = b'\x1b@'
+CMD_RASTER_MODE = b'\x1bia\x01'
+CMD_PRINT_INFO = b'\x1biz'
+CMD_VARIOUS_MODE = b'\x1biM'
+CMD_CUT_EVERY = b'\x1biA'
+CMD_EXPANDED_MODE = b'\x1biK'
+CMD_MARGIN = b'\x1bid'
+CMD_COMPRESSION = b'M'
+CMD_RASTER_LINE = b'g\x00'
+CMD_BLACK_LINE = b'w\x01'  # 雙色模式: 第一色（黑）
+CMD_RED_LINE = b'w\x02'    # 雙色模式: 第二色（紅）
+CMD_ZERO_LINE = b'Z'
+CMD_PRINT = b'\x0c'
+CMD_PRINT_LAST = b'\x1a'
+CMD_STATUS_REQUEST = b'\x1biS'
+
+# 打印信息有效標記
+PI_KIND = 0x02
+PI_WIDTH = 0x04
+PI_LENGTH = 0x08
+PI_QUALITY = 0x40
+PI_RECOVER = 0x80
+
+# 各種模式 / 擴展模式位
+MODE_AUTO_CUT = 0x40
+EXPANDED_TWO_COLOR = 0x01
+EXPANDED_CUT_AT_END = 0x08
+EXPANDED_HIGH_RES = 0x40
+
+COMPRESSION_NONE = 0x00
+COMPRESSION_TIFF = 0x02
+
+ZERO_LINE = bytes(LINE_BYTES)
+PACKED_ZERO_LINE = b'\xa7\x00'  # packbits_encode(ZERO_LINE)
+
+# PIL 的 '1' 模式中 1 代表白色，打印機中 1 代表打印（黑色），需要反轉每個 bit
+_INVERT_TABLE = bytes(255 - i for i in range(256))
+
+
+def packbits_encode(data: bytes) -> bytes:
+    """
+    TIFF PackBits 壓縮（單行）
+    """
+    out = bytearray()
+    i = 0
+    n = len(data)
+    while i < n:
+        # 計算重複長度
+        run = 1
+        while i + run < n and run < 128 and data[i + run] == data[i]:
+            run += 1
+        if run > 1:
+            out.append((257 - run) & 0xFF)
+            out.append(data[i])
+            i += run
+            continue
+        # 收集不重複的字節，直到出現至少 2 個重複
+        start = i
+        i += 1
+        while i < n and i - start < 128:
+            if i + 1 < n and data[i] == data[i + 1]:
+                break
+            i += 1
+        out.append(i - start - 1)
+        out.extend(data[start:i])
+    return bytes(out)
+
+
+def packbits_decode(data: bytes) -> bytes:
+    """
+    TIFF PackBits 解壓
+    """
+    out = bytearray()
+    i = 0
+    n = len(data)
+    while i < n:
+        header = data[i]
+        i += 1
+        if header < 128:
+            count = header + 1
+            out.extend(data[i:i + count])
+            i += count
+        elif header > 128:
+            out.extend(data[i:i + 1] * (257 - header))
+            i += 1
+    return bytes(out)
+
+
+def is_red(rgb) -> bool:
+    r, g, b = rgb[:3]
+    return r >= 128 and r > 2 * max(g, b)
+
+
+def split_color_planes(img: Image.Image, two_color: bool = False) -> Tuple[Image.Image, Optional[Image.Image]]:
+    """
+    將圖像分為黑色和紅色兩個 1-bit 圖層（PIL '1' 模式，0 = 打印）
+    - '1' 模式直接作為黑色圖層
+    - 'P' 模式（例如 black_red 標籤）按調色板顏色查表，不需要逐像素轉換
+    - 其他模式轉為灰度後按 128 二值化
+    非雙色介質時紅色並入黑色圖層，返回的紅色圖層為 None
+    """
+    if img.mode == '1':
+        return img, None
+
+    if img.mode == 'P' and 'transparency' not in img.info:
+        palette = img.getpalette() or []
+        colors = [tuple(palette[i:i + 3]) for i in range(0, len(palette), 3)]
+        colors += [(255, 255, 255)] * (256 - len(colors))
+        red = [two_color and is_red(color) for color in colors]
+        dark = [(color[0] * 299 + color[1] * 587 + color[2] * 114) / 1000 < 128 or is_red(color) for color in colors]
+        black_plane = img.point([0 if dark[i] and not red[i] else 255 for i in range(256)], '1')
+        red_plane = img.point([0 if red[i] else 255 for i in range(256)], '1') if two_color else None
+        return black_plane, red_plane
+
+    return img.convert('L').point(lambda v: 255 if v >= 128 else 0).convert('1'), None
+
+
+def plane_to_raster_lines(mono: Image.Image, media: str = DEFAULT_MEDIA) -> List[bytes]:
+    """
+    將 1-bit 圖層轉換為光柵行（每行 90 bytes，1 = 打印）
+    圖層需要按介質的可打印範圍渲染（見 printable_size），尺寸不符時拋出 ValueError，
+    不縮放也不裁切（縮放會使 QR Code 模塊變形）
+    """
+    profile = MEDIA_PROFILES[media]
+    width, length = printable_size(media, mono.height)
+    if mono.size != (width, length):
+        raise ValueError(f'圖像尺寸 {mono.width}x{mono.height} 與介質 {media} 的可打印範圍 {width}x{length} 點不符')
+
+    # 打印頭方向與圖像左右相反，並按右邊距放入 720 點寬的畫布
+    mono = mono.transpose(Image.Transpose.FLIP_LEFT_RIGHT)
+    canvas = Image.new('1', (HEAD_DOTS, mono.height), 1)
+    canvas.paste(mono, (profile['right_margin_dots'], 0))
+
+    # 一次取得所有行的打包位數據，再整體反轉
+    packed = canvas.tobytes().translate(_INVERT_TABLE)
+    return [packed[offset:offset + LINE_BYTES] for offset in range(0, len(packed), LINE_BYTES)]
+
+
+def image_to_raster_planes(img: Image.Image, media: str = DEFAULT_MEDIA) -> Tuple[List[bytes], Optional[List[bytes]]]:
+    """
+    將圖像轉換為黑色光柵行和紅色光柵行（非雙色介質時紅色為 None）
+    圖像寬度方向對應打印頭，高度方向對應進紙方向
+    橫向圖像（例如 100mm x 62mm 的 BadgeConfig）會先旋轉 90 度
+    """
+    profile = MEDIA_PROFILES[media]
+    if img.width > img.height and img.width > profile['printable_dots']:
+        img = img.transpose(Image.Transpose.ROTATE_90)
+
+    black_plane, red_plane = split_color_planes(img, profile.get('two_color', False))
+    black_lines = plane_to_raster_lines(black_plane, media)
+    if not profile.get('two_color'):
+        return black_lines, None
+    if red_plane is None:
+        return black_lines, [ZERO_LINE] * len(black_lines)
+    return black_lines, plane_to_raster_lines(red_plane, media)
+
+
+def image_to_raster_lines(img: Image.Image, media: str = DEFAULT_MEDIA) -> List[bytes]:
+    """
+    將圖像轉換為光柵行（每行 90 bytes，1 = 打印），只返回黑色圖層
+    """
+    return image_to_raster_planes(img, media)[0]
+
+
+def encode_page(lines: List[bytes], media: str = DEFAULT_MEDIA, first_page: bool = True,
+                last_page: bool = True, compress: bool = True, cut: bool = True,
+                high_res: bool = False, red_lines: Optional[List[bytes]] = None) -> bytes:
+    """
+    編碼一頁的命令（不含 invalidate/initialize 前綴）
+    提供 red_lines 時使用雙色模式，每行依次發送黑色 (w 01) 和紅色 (w 02) 數據
+    """
+    two_color = red_lines is not None
+    if two_color and len(red_lines) != len(lines):
+        raise ValueError('黑色和紅色光柵行數不一致')
+    # 雙色打印不支援高解析度模式
+    high_res = high_res and not two_color
+
+    profile = MEDIA_PROFILES[media]
+    out = bytearray()
+
+    # 打印信息: 介質類型、寬度、長度、行數、頁序
+    out += CMD_PRINT_INFO
+    out += bytes([
+        PI_RECOVER | PI_QUALITY | PI_KIND | PI_WIDTH | PI_LENGTH,
+        profile['media_type'],
+        profile['width_mm'],
+        profile['length_mm'],
+    ])
+    out += struct.pack('<I', len(lines))
+    out += bytes([0 if first_page else 1, 0])
+
+    out += CMD_VARIOUS_MODE + bytes([MODE_AUTO_CUT if cut else 0])
+    if cut:
+        out += CMD_CUT_EVERY + b'\x01'
+    expanded = ((EXPANDED_CUT_AT_END if cut else 0) | (EXPANDED_HIGH_RES if high_res else 0)
+                | (EXPANDED_TWO_COLOR if two_color else 0))
+    out += CMD_EXPANDED_MODE + bytes([expanded])
+    out += CMD_MARGIN + struct.pack('<H', profile['feed_margin'])
+    out += CMD_COMPRESSION + bytes([COMPRESSION_TIFF if compress else COMPRESSION_NONE])
+
+    if two_color:
+        # 雙色模式沒有空行命令，每行都需要發送
+        for black, red in zip(lines, red_lines):
+            for command, line in ((CMD_BLACK_LINE, black), (CMD_RED_LINE, red)):
+                if compress:
+                    line = PACKED_ZERO_LINE if line == ZERO_LINE else packbits_encode(line)
+                out += command + bytes([len(line)]) + line
+        out += CMD_PRINT_LAST if last_page else CMD_PRINT
+        return bytes(out)
+
+    for line in lines:
+        if compress:
+            if line == ZERO_LINE:
+                out += CMD_ZERO_LINE
+                continue
+            line = packbits_encode(line)
+        out += CMD_RASTER_LINE + bytes([len(line)]) + line
+
+    out += CMD_PRINT_LAST if last_page else CMD_PRINT
+    return bytes(out)
+
+
+def encode_labels(images: List[Image.Image], media: str = DEFAULT_MEDIA, compress: bool = True,
+                  cut: bool = True, high_res: bool = False) -> bytes:
+    """
+    將多張標籤編碼為一個多頁打印任務
+    雙色介質（例如 62red）時紅色內容打印為紅色，其他介質時紅色打印為黑色
+    """
+    out = bytearray(CMD_INVALIDATE + CMD_INITIALIZE + CMD_RASTER_MODE)
+    for index, img in enumerate(images):
+        lines, red_lines = image_to_raster_planes(img, media)
+        out += encode_page(
+            lines,
+            media=media,
+            first_page=index == 0,
+            last_page=index == len(images) - 1,
+            compress=compress,
+            cut=cut,
+            high_res=high_res,
+            red_lines=red_lines,
+        )
+    return bytes(out)
+
+
+def encode_label(img: Image.Image, media: str = DEFAULT_MEDIA, compress: bool = True,
+                 cut: bool = True, high_res: bool = False) -> bytes:
+    """
+    將單張標籤圖像編碼為 Brother QL 光柵命令
+    """
+    return encode_labels([img], media=media, compress=compress, cut=cut, high_res=high_res)
+
+
+def encode_label_page(img: Image.Image, media: str = DEFAULT_MEDIA, first_page: bool = False,
+                      last_page: bool = False, compress: bool = True, cut: bool = True,
+                      high_res: bool = False) -> bytes:
+    """
+    將單張標籤編碼為一頁（不含任務前綴），供多頁任務串流發送
+    頁序標記可在發送時用 set_page_flags() 修改
+    """
+    lines, red_lines = image_to_raster_planes(img, media)
+    return encode_page(lines, media=media, first_page=first_page, last_page=last_page,
+                       compress=compress, cut=cut, high_res=high_res, red_lines=red_lines)
+
+
+# 打印信息命令中頁序字節的位置: ESC i z + 4 字節標記/介質 + 4 字節行數
+_PAGE_FLAG_OFFSET = len(CMD_PRINT_INFO) + 8
+
+
+def set_page_flags(page: bytes, first_page: bool, last_page: bool) -> bytes:
+    """
+    修改 encode_page() 結果的頁序: 是否為首頁，以及結束命令（最後一頁 0x1A，其他 0x0C）
+    """
+    if not page.startswith(CMD_PRINT_INFO):
+        raise ValueError('不是 encode_page() 編碼的頁')
+    out = bytearray(page)
+    out[_PAGE_FLAG_OFFSET] = 0 if first_page else 1
+    out[-1] = CMD_PRINT_LAST[0] if last_page else CMD_PRINT[0]
+    return bytes(out)
+
+
+def page_to_job(page: bytes) -> bytes:
+    """將 encode_label_page() 的單頁數據包裝為獨立的單頁任務"""
+    return CMD_INVALIDATE + CMD_INITIALIZE + CMD_RASTER_MODE + set_page_flags(page, first_page=True, last_page=True)
+
+
+# 狀態信息（打印機對 ESC i S 的回覆，打印完成或出錯時也會主動發送）
+STATUS_LENGTH = 32
+STATUS_HEADER = 0x80
+
+# 狀態類型（第 18 byte）
+STATUS_TYPE_REPLY = 0x00
+STATUS_TYPE_PRINTED = 0x01
+STATUS_TYPE_ERROR = 0x02
+STATUS_TYPE_NOTIFICATION = 0x05
+STATUS_TYPE_PHASE_CHANGE = 0x06
+
+# 階段（第 19 byte）
+PHASE_RECEIVING = 0x00
+PHASE_PRINTING = 0x01
+
+# 錯誤信息 1（第 8 byte）和錯誤信息 2（第 9 byte）的各個位
+STATUS_ERRORS_1 = ('no_media', 'end_of_media', 'cutter_jam', None, 'printer_in_use', 'printer_off',
+                   'high_voltage_adapter', 'fan_error')
+STATUS_ERRORS_2 = ('replace_media', 'expansion_buffer_full', 'communication_error', 'communication_buffer_full',
+                   'cover_open', 'cancel_key', 'feed_error', 'system_error')
+
+STATUS_MODELS = {0x38: 'QL-800', 0x39: 'QL-810W', 0x41: 'QL-820NWB'}
+STATUS_MEDIA_TYPES = {0x00: None, MEDIA_CONTINUOUS: 'continuous', MEDIA_DIE_CUT: 'die_cut'}
+
+
+def status_request() -> bytes:
+    """狀態查詢命令"""
+    return CMD_INVALIDATE + CMD_INITIALIZE + CMD_STATUS_REQUEST
+
+
+def parse_status(data: bytes) -> Dict:
+    """
+    解析 32 bytes 的狀態信息
+    errors 為錯誤代碼列表（例如 no_media、cover_open），printer_in_use 表示打印機忙碌而非錯誤
+    """
+    if len(data) < STATUS_LENGTH or data[0] != STATUS_HEADER:
+        raise ValueError(f'無效的狀態信息: {data[:STATUS_LENGTH].hex()}')
+    flags = [name for bit, name in enumerate(STATUS_ERRORS_1) if name and data[8] & (1 << bit)]
+    flags += [name for bit, name in enumerate(STATUS_ERRORS_2) if data[9] & (1 << bit)]
+    return {
+        'model': STATUS_MODELS.get(data[4], f'0x{data[4]:02x}'),
+        'errors': [flag for flag in flags if flag != 'printer_in_use'],
+        'busy': 'printer_in_use' in flags or data[19] == PHASE_PRINTING,
+        'media_width_mm': data[10],
+        'media_length_mm': data[17],
+        'media_type': STATUS_MEDIA_TYPES.get(data[11], f'0x{data[11]:02x}'),
+        'status_type': data[18],
+        'phase': data[19],
+    }
+
+
+def encode_status(model: int = 0x41, errors: Tuple[str, ...] = (), media_width_mm: int = 62,
+                  media_length_mm: int = 0, media_type: int = MEDIA_CONTINUOUS,
+                  status_type: int = STATUS_TYPE_REPLY, phase: int = PHASE_RECEIVING) -> bytes:
+    """生成狀態信息（用於測試和假打印機）"""
+    data = bytearray(STATUS_LENGTH)
+    data[0:8] = bytes((STATUS_HEADER, 0x20, 0x42, 0x34, model, 0x30, 0x30, 0x00))
+    for bit, name in enumerate(STATUS_ERRORS_1):
+        if name and name in errors:
+            data[8] |= 1 << bit
+    for bit, name in enumerate(STATUS_ERRORS_2):
+        if name in errors:
+            data[9] |= 1 << bit
+    data[10] = media_width_mm
+    data[11] = media_type if media_width_mm else 0
+    data[17] = media_length_mm
+    data[18] = status_type
+    data[19] = phase
+    return bytes(data)
+
+
+def decode_raster(data: bytes) -> List[Dict]:
+    """
+    解析光柵命令（用於測試和調試）
+    返回每一頁的打印信息和光柵行
+    """
+    pages = []
+    page = None
+    compression = COMPRESSION_NONE
+    i = 0
+    n = len(data)
+
+    def new_page():
+        return {'info': None, 'various_mode': None, 'expanded_mode': None, 'margin': None, 'lines': [],
+                'red_lines': []}
+
+    while i < n:
+        if data[i] == 0x00:
+            i += 1
+        elif data.startswith(CMD_INITIALIZE, i):
+            i += len(CMD_INITIALIZE)
+        elif data.startswith(CMD_RASTER_MODE, i):
+            i += len(CMD_RASTER_MODE)
+        elif data.startswith(CMD_PRINT_INFO, i):
+            i += len(CMD_PRINT_INFO)
+            flags, media_type, width_mm, length_mm = data[i:i + 4]
+            line_count = struct.unpack('<I', data[i + 4:i + 8])[0]
+            page = new_page()
+            page['info'] = {
+                'flags': flags,
+                'media_type': media_type,
+                'width_mm': width_mm,
+                'length_mm': length_mm,
+                'line_count': line_count,
+                'first_page': data[i + 8] == 0,
+            }
+            i += 10
+        elif data.startswith(CMD_VARIOUS_MODE, i):
+            page['various_mode'] = data[i + 3]
+            i += 4
+        elif data.startswith(CMD_CUT_EVERY, i):
+            i += 4
+        elif data.startswith(CMD_EXPANDED_MODE, i):
+            page['expanded_mode'] = data[i + 3]
+            i += 4
+        elif data.startswith(CMD_MARGIN, i):
+            page['margin'] = struct.unpack('<H', data[i + 3:i + 5])[0]
+            i += 5
+        elif data.startswith(CMD_COMPRESSION, i):
+            compression = data[i + 1]
+            i += 2
+        elif data.startswith(CMD_RASTER_LINE, i):
+            length = data[i + 2]
+            line = data[i + 3:i + 3 + length]
+            if compression == COMPRESSION_TIFF:
+                line = packbits_decode(line)
+            page['lines'].append(line)
+            i += 3 + length
+        elif data.startswith(CMD_BLACK_LINE, i) or data.startswith(CMD_RED_LINE, i):
+            length = data[i + 2]
+            line = data[i + 3:i + 3 + length]
+            if compression == COMPRESSION_TIFF:
+                line = packbits_decode(line)
+            page['lines' if data[i + 1] == CMD_BLACK_LINE[1] else 'red_lines'].append(line)
+            i += 3 + length
+        elif data.startswith(CMD_ZERO_LINE, i):
+            page['lines'].append(ZERO_LINE)
+            i += 1
+        elif data[i] in (CMD_PRINT[0], CMD_PRINT_LAST[0]):
+            page['last_page'] = data[i] == CMD_PRINT_LAST[0]
+            pages.append(page)
+            page = None
+            i += 1
+        else:
+            raise ValueError(f'未知命令 0x{data[i]:02x} @ {i}')
+
+    return pages
+
+
+def raster_lines_to_image(lines: List[bytes], media: Optional[str] = DEFAULT_MEDIA,
+                          red_lines: Optional[List[bytes]] = None) -> Image.Image:
+    """
+    將光柵行還原為圖像（encode 的逆操作，用於測試和預覽）
+    提供 red_lines 時返回白/黑/紅調色板圖像，否則返回 1-bit 圖像
+    """
+    def to_plane(plane_lines):
+        packed = b''.join(plane_lines).translate(_INVERT_TABLE)
+        canvas = Image.frombytes('1', (HEAD_DOTS, len(plane_lines)), packed)
+        if media:
+            profile = MEDIA_PROFILES[media]
+            left = profile['right_margin_dots']
+            canvas = canvas.crop((left, 0, left + profile['printable_dots'], len(plane_lines)))
+        return canvas.transpose(Image.Transpose.FLIP_LEFT_RIGHT)
+
+    black = to_plane(lines)
+    if not red_lines:
+        return black
+
+    preview = Image.new('P', black.size, 0)
+    preview.putpalette([255, 255, 255, 0, 0, 0, 255, 0, 0])
+    preview.paste(1, (0, 0), black.point(lambda v: 0 if v else 255, '1'))
+    preview.paste(2, (0, 0), to_plane(red_lines).point(lambda v: 0 if v else 255, '1'))
+    return preview
@@ -0,0 +1,454 @@
+"""
+IPP 客戶端模組
+直接以 IPP（HTTP POST application/ipp）與本機 cupsd 通信，取代每次調用 lpr / lpstat 子進程：
+HTTP 連接保持打開（keep-alive，每個同時打印的工作線程一個連接），打印數據直接從記憶體發送，一次請求即可查詢所有打印機
+只使用標準庫，實現打印橋接需要的最小子集（Print-Job、CUPS-Get-Printers）
+"""
+
+import getpass
+import http.client
+import itertools
+import os
+import select
+import socket
+import struct
+import threading
+from typing import Dict, Iterable, List, Optional, Tuple
+from urllib.parse import quote
+
+# cupsd 地址: host[:port] 或 Unix socket 路徑（例如 /run/cups/cups.sock），與 CUPS 的 CUPS_SERVER 相同
+CUPS_SERVER = os.getenv('CUPS_SERVER', 'localhost:631')
+CUPS_TIMEOUT = float(os.getenv('CUPS_TIMEOUT', 10))
+# 保留的閒置 IPP 連接數上限（同時打印的工作線程各用一個連接）
+CUPS_CONNECTIONS = int(os.getenv('CUPS_CONNECTIONS', 8))
+# CUPS 客戶端: ipp（默認）或 lpr（改回調用 lpr / lpstat 子進程）
+CUPS_CLIENT = os.getenv('CUPS_CLIENT', 'ipp').lower()
+IPP_PORT = 631
+
+IPP_VERSION = (2, 0)
+IPP_MIMETYPE = 'application/ipp'
+
+# 操作
+OP_PRINT_JOB = 0x0002
+OP_GET_PRINTER_ATTRIBUTES = 0x000B
+OP_CUPS_GET_PRINTERS = 0x4002
+
+# 屬性組分隔標籤
+TAG_OPERATION = 0x01
+TAG_JOB = 0x02
+TAG_END = 0x03
+TAG_PRINTER = 0x04
+TAG_UNSUPPORTED = 0x05
+
+# 值標籤
+TAG_NO_VALUE = 0x13
+TAG_INTEGER = 0x21
+TAG_BOOLEAN = 0x22
+TAG_ENUM = 0x23
+TAG_TEXT = 0x41
+TAG_NAME = 0x42
+TAG_KEYWORD = 0x44
+TAG_URI = 0x45
+TAG_CHARSET = 0x47
+TAG_LANGUAGE = 0x48
+TAG_MIME_TYPE = 0x49
+
+INTEGER_TAGS = (TAG_INTEGER, TAG_ENUM)
+STRING_TAGS = (TAG_TEXT, TAG_NAME, TAG_KEYWORD, TAG_URI, TAG_CHARSET, TAG_LANGUAGE, TAG_MIME_TYPE)
+
+# 狀態碼: 0x0000-0x00FF 為成功（包括 successful-ok-ignored-or-substituted-attributes）
+STATUS_OK = 0x0000
+STATUS_SUCCESS_MAX = 0x00FF
+STATUS_NOT_FOUND = 0x0406
+
+PRINTER_STATES = {3: 'idle', 4: 'processing', 5: 'stopped'}
+
+# CUPS-Get-Printers 查詢的屬性
+PRINTER_ATTRIBUTES = ('printer-name', 'device-uri', 'printer-uri-supported', 'printer-state',
+                      'printer-state-message', 'printer-is-accepting-jobs', 'printer-make-and-model')
+
+
+class IPPError(Exception):
+    """IPP 請求失敗（HTTP 錯誤或 IPP 狀態碼表示失敗）"""
+
+    def __init__(self, message: str, status: Optional[int] = None):
+        super().__init__(message)
+        self.status = status
+
+
+# ---- 編碼和解碼 ----
+
+def encode_value(tag: int, value) -> bytes:
+    if tag in INTEGER_TAGS:
+        return struct.pack('>i', value)
+    if tag == TAG_BOOLEAN:
+        return b'\x01' if value else b'\x00'
+    if tag == TAG_NO_VALUE:
+        return b''
+    return value.encode('utf-8') if isinstance(value, str) else bytes(value)
+
+
+def encode_attribute(tag: int, name: str, value) -> bytes:
+    """編碼一個屬性；value 為列表時第一個值之後的值以空名稱（1setOf）編碼"""
+    values = value if isinstance(value, (list, tuple)) else [value]
+    encoded = b''
+    for index, item in enumerate(values):
+        key = name.encode('ascii') if index == 0 else b''
+        data = encode_value(tag, item)
+        encoded += struct.pack('>BH', tag, len(key)) + key + struct.pack('>H', len(data)) + data
+    return encoded
+
+
+def encode_message(code: int, request_id: int,
+                   groups: Iterable[Tuple[int, Iterable[Tuple[int, str, object]]]], data: bytes = b'') -> bytes:
+    """
+    IPP 消息（請求時 code 為操作，響應時為狀態碼）
+    groups 為 [(組標籤, [(值標籤, 名稱, 值), ...]), ...]，data 為文件數據
+    """
+    parts = [struct.pack('>BBHi', IPP_VERSION[0], IPP_VERSION[1], code, request_id)]
+    for group_tag, attributes in groups:
+        parts.append(bytes((group_tag,)))
+        parts.extend(encode_attribute(tag, name, value) for tag, name, value in attributes)
+    parts.append(bytes((TAG_END,)))
+    parts.append(data)
+    return b''.join(parts)
+
+
+def decode_value(tag: int, data: bytes):
+    if tag in INTEGER_TAGS and len(data) == 4:
+        return struct.unpack('>i', data)[0]
+    if tag == TAG_BOOLEAN:
+        return data != b'\x00'
+    if tag in STRING_TAGS:
+        return data.decode('utf-8', errors='replace')
+    if tag == TAG_NO_VALUE:
+        return None
+    return data
+
+
+def decode_message(data: bytes) -> Dict:
+    """
+    解析 IPP 消息，返回 {version, code, request_id, groups: [(組標籤, {名稱: 值})], data}
+    多值屬性的值為列表
+    """
+    if len(data) < 9:
+        raise IPPError('IPP 消息太短')
+    try:
+        return _decode_message(data)
+    except struct.error as e:
+        raise IPPError(f'IPP 消息不完整: {e}') from e
+
+
+def _decode_message(data: bytes) -> Dict:
+    major, minor, code, request_id = struct.unpack_from('>BBHi', data)
+    offset = 8
+    groups = []
+    attributes = None
+    name = None
+    while offset < len(data):
+        tag = data[offset]
+        offset += 1
+        if tag == TAG_END:
+            break
+        if tag < 0x10:
+            attributes = {}
+            groups.append((tag, attributes))
+            continue
+        if attributes is None:
+            raise IPPError('IPP 屬性不在屬性組內')
+        name_length, = struct.unpack_from('>H', data, offset)
+        offset += 2
+        key = data[offset:offset + name_length].decode('ascii', errors='replace')
+        offset += name_length
+        value_length, = struct.unpack_from('>H', data, offset)
+        offset += 2
+        value = decode_value(tag, data[offset:offset + value_length])
+        offset += value_length
+        if key:
+            name = key
+            attributes[name] = value
+        elif name is not None:
+            # 空名稱: 上一個屬性的額外值
+            previous = attributes[name]
+            attributes[name] = (previous if isinstance(previous, list) else [previous]) + [value]
+    return {
+        'version': (major, minor),
+        'code': code,
+        'request_id': request_id,
+        'groups': groups,
+        'data': data[offset:],
+    }
+
+
+def group_attributes(message: Dict, group_tag: int) -> List[Dict]:
+    """返回消息中指定類型的所有屬性組（例如 CUPS-Get-Printers 每台打印機一組）"""
+    return [attributes for tag, attributes in message['groups'] if tag == group_tag]
+
+
+def option_attribute(name: str, value) -> Tuple[int, str, object]:
+    """lpr -o 風格的選項轉為任務屬性（整數、布爾值或 keyword）"""
+    if isinstance(value, bool):
+        return TAG_BOOLEAN, name, value
+    if isinstance(value, int):
+        return TAG_INTEGER, name, value
+    return TAG_KEYWORD, name, str(value)
+
+
+# ---- 連接 ----
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """經由 Unix socket 連接 cupsd（CUPS_SERVER 為路徑時）"""
+
+    def __init__(self, path: str, timeout: Optional[float] = None):
+        super().__init__('localhost', timeout=timeout)
+        self.socket_path = path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.socket_path)
+        except OSError:
+            sock.close()
+            raise
+        self.sock = sock
+
+
+class IPPClient:
+    """
+    與 cupsd 的 IPP 長連接池
+    每個請求取出一個閒置連接（沒有時新建），完成後放回，同時打印的工作線程各用一個連接；
+    閒置連接最多保留 max_idle 個
+    重用前檢查連接是否已被 cupsd 關閉（閒置超時）；查詢類請求在重用的連接上失敗時重新連接並重發一次，
+    Print-Job 請求發出後失敗不重發（cupsd 可能已經接受了任務，重發會重複打印）
+    """
+
+    def __init__(self, server: Optional[str] = None, timeout: float = CUPS_TIMEOUT,
+                 max_idle: int = CUPS_CONNECTIONS):
+        server = server or CUPS_SERVER
+        self.server = server
+        self.timeout = timeout
+        self.max_idle = max(1, max_idle)
+        if server.startswith('/'):
+            self.host, self.port = 'localhost', None
+        else:
+            host, _, port = server.partition(':')
+            self.host, self.port = host, int(port) if port else IPP_PORT
+        self.user = self._user()
+        self._idle = []
+        self._lock = threading.Lock()
+        self._request_ids = itertools.count(1)
+        self.requests = 0
+        self.connects = 0
+        self.reconnects = 0
+        self.stale = 0
+        self.active = 0
+        self.last_error = None
+
+    @staticmethod
+    def _user() -> str:
+        try:
+            return getpass.getuser()
+        except Exception:
+            return 'printer-bridge'
+
+    @property
+    def connected(self) -> bool:
+        with self._lock:
+            return self.active > 0 or any(conn.sock is not None for conn in self._idle)
+
+    def printer_uri(self, printer: str) -> str:
+        return f'ipp://{self.host}/printers/{quote(printer)}'
+
+    def _connect(self) -> http.client.HTTPConnection:
+        if self.server.startswith('/'):
+            conn = UnixHTTPConnection(self.server, timeout=self.timeout)
+        else:
+            conn = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        conn.connect()
+        if conn.sock.family != socket.AF_UNIX:
+            # 請求很小，關閉 Nagle 避免與延遲確認疊加
+            conn.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        with self._lock:
+            self.connects += 1
+        return conn
+
+    @staticmethod
+    def _is_alive(conn: http.client.HTTPConnection) -> bool:
+        """閒置連接上不應有數據；可讀表示 cupsd 已關閉連接"""
+        if conn.sock is None:
+            return False
+        try:
+            return not select.select([conn.sock], [], [], 0)[0]
+        except (OSError, ValueError):
+            return False
+
+    def _acquire(self) -> Tuple[http.client.HTTPConnection, bool]:
+        """取出一個閒置連接（丟棄已失效的連接），沒有時新建；返回 (連接, 是否重用)"""
+        while True:
+            with self._lock:
+                conn = self._idle.pop() if self._idle else None
+                self.active += 1
+            if conn is None:
+                try:
+                    return self._connect(), False
+                except OSError:
+                    with self._lock:
+                        self.active -= 1
+                    raise
+            if self._is_alive(conn):
+                return conn, True
+            conn.close()
+            with self._lock:
+                self.stale += 1
+                self.active -= 1
+
+    def _release(self, conn: http.client.HTTPConnection):
+        with self._lock:
+            self.active -= 1
+            if conn.sock is not None and len(self._idle) < self.max_idle:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    @staticmethod
+    def _post(conn: http.client.HTTPConnection, path: str, body: bytes) -> bytes:
+        conn.request('POST', path, body, {'Content-Type': IPP_MIMETYPE})
+        response = conn.getresponse()
+        payload = response.read()
+        if response.will_close:
+            conn.close()
+        if response.status != 200:
+            raise IPPError(f'HTTP {response.status} {response.reason}')
+        return payload
+
+    def request(self, operation: int, path: str, attributes: Iterable[Tuple[int, str, object]] = (),
+                job_attributes: Iterable[Tuple[int, str, object]] = (), data: bytes = b'',
+                retry: Optional[bool] = None) -> Dict:
+        """
+        發送一個 IPP 請求並返回解析後的響應，失敗時拋出 IPPError 或 OSError
+        attributes 為操作屬性（attributes-charset 等必需屬性自動加入）
+        retry 為請求發出後連接失敗時是否在新連接上重發一次；默認除 Print-Job 外都重發
+        """
+        if retry is None:
+            retry = operation != OP_PRINT_JOB
+        request_id = next(self._request_ids) & 0x7FFFFFFF
+        operation_attributes = [
+            (TAG_CHARSET, 'attributes-charset', 'utf-8'),
+            (TAG_LANGUAGE, 'attributes-natural-language', 'en'),
+            *attributes,
+        ]
+        groups = [(TAG_OPERATION, operation_attributes)]
+        job_attributes = list(job_attributes)
+        if job_attributes:
+            groups.append((TAG_JOB, job_attributes))
+        body = encode_message(operation, request_id, groups, data)
+
+        with self._lock:
+            self.requests += 1
+        try:
+            conn, reused = self._acquire()
+        except OSError as e:
+            self.last_error = str(e)
+            raise
+        try:
+            try:
+                payload = self._post(conn, path, body)
+            except (http.client.HTTPException, ConnectionError) as e:
+                # 重用的連接在檢查後才被 cupsd 關閉: 查詢可以重發，Print-Job 可能已被接受，不重發
+                conn.close()
+                if not (reused and retry):
+                    suffix = '（任務可能已提交，不自動重發）' if operation == OP_PRINT_JOB else ''
+                    raise IPPError(f'IPP 請求失敗: {e}{suffix}') from e
+                with self._lock:
+                    self.reconnects += 1
+                conn = self._connect()
+                payload = self._post(conn, path, body)
+        except (IPPError, OSError, http.client.HTTPException) as e:
+            conn.close()
+            self.last_error = str(e)
+            if isinstance(e, http.client.HTTPException):
+                raise IPPError(f'IPP 請求失敗: {e}') from e
+            raise
+        finally:
+            self._release(conn)
+
+        response = decode_message(payload)
+        if response['code'] > STATUS_SUCCESS_MAX:
+            operation_group = next(iter(group_attributes(response, TAG_OPERATION)), {})
+            message = operation_group.get('status-message') or f'IPP 狀態 0x{response["code"]:04x}'
+            self.last_error = message
+            raise IPPError(message, response['code'])
+        self.last_error = None
+        return response
+
+    def print_job(self, printer: str, data: bytes, document_format: str = 'image/png',
+                  job_name: str = 'label', options: Optional[Dict[str, object]] = None) -> Optional[int]:
+        """
+        Print-Job: 提交一個打印任務（文件數據在同一請求中發送），返回任務 ID
+        options 為任務屬性，例如 {'media': 'Custom.62x100mm'}（對應 lpr -o media=...）
+        """
+        response = self.request(
+            OP_PRINT_JOB, f'/printers/{quote(printer)}',
+            attributes=[
+                (TAG_URI, 'printer-uri', self.printer_uri(printer)),
+                (TAG_NAME, 'requesting-user-name', self.user),
+                (TAG_NAME, 'job-name', job_name),
+                (TAG_MIME_TYPE, 'document-format', document_format),
+            ],
+            job_attributes=[option_attribute(name, value) for name, value in (options or {}).items()],
+            data=data,
+        )
+        job = next(iter(group_attributes(response, TAG_JOB)), {})
+        return job.get('job-id')
+
+    def get_printers(self, attributes: Iterable[str] = PRINTER_ATTRIBUTES) -> List[Dict]:
+        """CUPS-Get-Printers: 一次請求返回所有打印機的屬性"""
+        try:
+            response = self.request(OP_CUPS_GET_PRINTERS, '/', attributes=[
+                (TAG_NAME, 'requesting-user-name', self.user),
+                (TAG_KEYWORD, 'requested-attributes', list(attributes)),
+            ])
+        except IPPError as e:
+            if e.status == STATUS_NOT_FOUND:
+                return []  # 沒有已安裝的打印機
+            raise
+        printers = group_attributes(response, TAG_PRINTER)
+        for printer in printers:
+            state = printer.get('printer-state')
+            if isinstance(state, int):
+                printer['printer-state'] = PRINTER_STATES.get(state, state)
+        return printers
+
+    def close(self):
+        """關閉所有閒置連接（使用中的連接在放回時保留，下次請求可繼續使用）"""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+    def stats(self) -> Dict:
+        return {
+            'server': self.server,
+            'connected': self.connected,
+            'idle_connections': len(self._idle),
+            'active_requests': self.active,
+            'requests': self.requests,
+            'connects': self.connects,
+            'reconnects': self.reconnects,
+            'stale_connections': self.stale,
+            'last_error': self.last_error,
+        }
+
+
+_default_client = None
+_default_client_lock = threading.Lock()
+
+
+def get_ipp_client() -> IPPClient:
+    """返回進程內共享的 IPP 客戶端（CUPS_SERVER）"""
+    global _default_client
+    with _default_client_lock:
+        if _default_client is None:
+            _default_client = IPPClient()
+        return _default_client
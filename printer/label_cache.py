@@ -0,0 +1,346 @@
+"""
+標籤預渲染緩存模組
+活動開始前預先渲染已報名參加者的標籤，打印時只需查找緩存並發送；
+緩存以標籤內容的指紋為鍵（姓名、公司、QR Code、佈局、顏色模式、介質），
+參加者資料或佈局變更後指紋不同，自動回退到即時渲染
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Iterable, Optional, Sequence
+
+from brother_ql_raster import page_to_job
+from label_renderer import resolve_color_mode
+
+# 記憶體緩存上限（MB），設為 0 則停用緩存
+DEFAULT_MEMORY_MB = float(os.getenv('PRERENDER_CACHE_MB', 256))
+# 磁盤緩存目錄和上限（MB），未設置目錄則只使用記憶體
+DEFAULT_DISK_PATH = os.getenv('PRERENDER_CACHE_DIR') or None
+DEFAULT_DISK_MB = float(os.getenv('PRERENDER_DISK_MB', 1024))
+# 磁盤緩存超過上限時刪除到上限的此比例，之後的寫入不會每次都觸發清理
+DISK_TRIM_RATIO = 0.9
+
+# 不影響標籤圖像的字段，不計入指紋
+NON_RENDER_KEYS = frozenset({'attendee_id'})
+
+# 緩存保存的格式: PNG（CUPS）和單頁光柵數據（網路打印，完整任務可由 page_to_job() 生成）
+CACHE_FORMATS = ('png', 'page')
+
+
+def attendee_key(item: Dict) -> Optional[str]:
+    """參加者 ID: attendee_id、id 或 user._id"""
+    user = (item.get('data') or {}).get('user') or item.get('user') or {}
+    key = item.get('attendee_id') or item.get('id') or user.get('_id') or user.get('id')
+    return str(key) if key else None
+
+
+def item_fingerprint(item: Dict, media: str) -> str:
+    """標籤內容指紋（prepare_item() 補全後的項目，BadgeConfig 佈局內容包含在內）"""
+    content = {key: value for key, value in item.items() if key not in NON_RENDER_KEYS}
+    content['color_mode'] = resolve_color_mode(item.get('color_mode'))
+    content['media'] = media
+    text = json.dumps(content, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def cache_formats(formats: Sequence[str]) -> tuple:
+    """打印需要的格式對應的緩存格式（'raster' 和 'page' 都由 'page' 提供）"""
+    needed = []
+    if 'png' in formats:
+        needed.append('png')
+    if 'raster' in formats or 'page' in formats:
+        needed.append('page')
+    return tuple(needed)
+
+
+class PrerenderCache:
+    """
+    有上限的預渲染緩存
+    記憶體部分按最近使用順序淘汰；設置了磁盤目錄時同時寫入磁盤（重啟後仍可使用），
+    磁盤超過上限時刪除最舊的文件（磁盤佔用以累計值追蹤，寫入時不掃描目錄）
+    """
+
+    def __init__(self, media: str, memory_mb: float = DEFAULT_MEMORY_MB,
+                 disk_path: Optional[str] = DEFAULT_DISK_PATH, disk_mb: float = DEFAULT_DISK_MB):
+        self.media = media
+        self.max_bytes = int(memory_mb * 1024 * 1024)
+        self.disk_path = disk_path
+        self.max_disk_bytes = int(disk_mb * 1024 * 1024)
+        self._entries = OrderedDict()  # 指紋 -> {格式: bytes}
+        self._bytes = 0
+        self._attendees = {}  # 參加者 ID -> 指紋
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self._disk_lock = threading.Lock()
+        self._disk_bytes = 0
+        self.disk_trims = 0
+        if disk_path:
+            os.makedirs(disk_path, exist_ok=True)
+            self._disk_bytes = sum(size for _, size, _ in self._disk_files())
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0 or bool(self.disk_path)
+
+    def _disk_file(self, fingerprint: str, fmt: str) -> str:
+        return os.path.join(self.disk_path, f'{fingerprint}.{fmt}')
+
+    def _remember(self, fingerprint: str, entry: Dict[str, bytes]):
+        """放入記憶體緩存並淘汰最久未使用的條目（需持有鎖）"""
+        if self.max_bytes <= 0:
+            return
+        previous = self._entries.pop(fingerprint, None)
+        if previous:
+            self._bytes -= sum(map(len, previous.values()))
+        self._entries[fingerprint] = entry
+        self._bytes += sum(map(len, entry.values()))
+        while self._bytes > self.max_bytes and self._entries:
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= sum(map(len, evicted.values()))
+
+    def _load_disk(self, fingerprint: str, formats: Sequence[str]) -> Optional[Dict[str, bytes]]:
+        if not self.disk_path:
+            return None
+        entry = {}
+        try:
+            for fmt in formats:
+                with open(self._disk_file(fingerprint, fmt), 'rb') as f:
+                    entry[fmt] = f.read()
+        except OSError:
+            return None
+        return entry
+
+    def _disk_files(self):
+        """磁盤緩存中的文件 [(修改時間, 大小, 路徑)]，每個文件只 stat 一次"""
+        files = []
+        try:
+            for entry in os.scandir(self.disk_path):
+                try:
+                    if entry.is_file():
+                        stat = entry.stat()
+                        files.append((stat.st_mtime, stat.st_size, entry.path))
+                except OSError:
+                    pass
+        except OSError:
+            pass
+        return files
+
+    def _remove_disk(self, path: str) -> int:
+        """刪除磁盤文件，返回釋放的字節數"""
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+        except OSError:
+            return 0
+        return size
+
+    def _save_disk(self, fingerprint: str, entry: Dict[str, bytes]) -> int:
+        """寫入磁盤，返回磁盤佔用的變化（覆蓋已有文件時扣除舊文件大小）"""
+        added = 0
+        try:
+            for fmt, data in entry.items():
+                path = self._disk_file(fingerprint, fmt)
+                temp_path = f'{path}.{os.getpid()}.tmp'
+                with open(temp_path, 'wb') as f:
+                    f.write(data)
+                try:
+                    added -= os.path.getsize(path)
+                except OSError:
+                    pass
+                os.replace(temp_path, path)
+                added += len(data)
+        except OSError as e:
+            print(f"⚠️  預渲染緩存寫入失敗 {self.disk_path}: {e}")
+        return added
+
+    def _trim_disk(self):
+        """
+        磁盤緩存超過上限時按修改時間刪除最舊的文件，直到低於上限的 DISK_TRIM_RATIO
+        未超過上限時不掃描目錄；清理時以掃描結果校正累計值（其他進程寫入或刪除的文件）
+        """
+        with self._disk_lock:
+            if self._disk_bytes <= self.max_disk_bytes:
+                return
+            self.disk_trims += 1
+            files = sorted(self._disk_files())
+            total = sum(size for _, size, _ in files)
+            target = int(self.max_disk_bytes * DISK_TRIM_RATIO)
+            for _, size, path in files:
+                if total <= target:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                total -= size
+            self._disk_bytes = total
+
+    def contains(self, item: Dict, formats: Sequence[str]) -> bool:
+        fingerprint = item_fingerprint(item, self.media)
+        needed = cache_formats(formats)
+        with self._lock:
+            entry = self._entries.get(fingerprint)
+        if entry and all(fmt in entry for fmt in needed):
+            return True
+        return bool(self.disk_path) and all(
+            os.path.exists(self._disk_file(fingerprint, fmt)) for fmt in needed)
+
+    def put(self, item: Dict, payload: Dict):
+        """保存 render_label_payload() 的結果（只保存 CACHE_FORMATS 中的格式）"""
+        entry = {fmt: payload[fmt] for fmt in CACHE_FORMATS if payload.get(fmt)}
+        if not entry or not self.enabled:
+            return
+        fingerprint = item_fingerprint(item, self.media)
+        key = attendee_key(item)
+        with self._lock:
+            replaced = self._attendees.get(key) if key else None
+            if key:
+                self._attendees[key] = fingerprint
+            # 參加者資料已變更，舊標籤不會再被使用
+            if replaced and replaced != fingerprint:
+                old = self._entries.pop(replaced, None)
+                if old:
+                    self._bytes -= sum(map(len, old.values()))
+            self._remember(fingerprint, entry)
+        if self.disk_path:
+            added = 0
+            if replaced and replaced != fingerprint:
+                for fmt in CACHE_FORMATS:
+                    added -= self._remove_disk(self._disk_file(replaced, fmt))
+            added += self._save_disk(fingerprint, entry)
+            with self._disk_lock:
+                self._disk_bytes += added
+            self._trim_disk()
+
+    def get(self, item: Dict, formats: Sequence[str]) -> Optional[Dict]:
+        """
+        查找已預渲染的標籤，返回與 render_label_payload() 相同結構的 payload
+        未命中（或參加者資料已變更）時返回 None
+        """
+        if not self.enabled:
+            return None
+        start = time.perf_counter()
+        fingerprint = item_fingerprint(item, self.media)
+        needed = cache_formats(formats)
+        with self._lock:
+            entry = self._entries.get(fingerprint)
+            if entry is not None:
+                self._entries.move_to_end(fingerprint)
+        if entry is None or not all(fmt in entry for fmt in needed):
+            entry = self._load_disk(fingerprint, needed)
+            if entry is not None:
+                with self._lock:
+                    self._remember(fingerprint, entry)
+
+        key = attendee_key(item)
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                if key and self._attendees.get(key) not in (None, fingerprint):
+                    self.stale += 1
+                return None
+            self.hits += 1
+
+        payload = {'name': item.get('name', ''), 'cached': True, 'stages': {}}
+        if 'png' in formats:
+            payload['png'] = entry['png']
+        if 'page' in formats:
+            payload['page'] = entry['page']
+        if 'raster' in formats:
+            payload['raster'] = page_to_job(entry['page'])
+        payload['render_ms'] = round((time.perf_counter() - start) * 1000, 3)
+        return payload
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._attendees.clear()
+            self._bytes = 0
+        if self.disk_path:
+            with self._disk_lock:
+                for entry in os.scandir(self.disk_path):
+                    if entry.name.endswith(tuple(f'.{fmt}' for fmt in CACHE_FORMATS)):
+                        try:
+                            os.remove(entry.path)
+                        except OSError:
+                            pass
+                self._disk_bytes = sum(size for _, size, _ in self._disk_files())
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                'enabled': self.enabled,
+                'entries': len(self._entries),
+                'attendees': len(self._attendees),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'disk_path': self.disk_path,
+                'disk_bytes': self._disk_bytes,
+                'max_disk_bytes': self.max_disk_bytes,
+                'disk_trims': self.disk_trims,
+                'hits': self.hits,
+                'misses': self.misses,
+                'stale': self.stale,
+            }
+
+
+class PrerenderRun:
+    """一次預渲染任務的進度（/prerender 返回）"""
+
+    def __init__(self, total: int):
+        self.total = total
+        self.rendered = 0
+        self.skipped = 0
+        self.failed = 0
+        self.errors = []
+        self.status = 'running'
+        self.started_at = time.time()
+        self.finished_at = None
+
+    def to_dict(self) -> Dict:
+        return {
+            'status': self.status,
+            'total': self.total,
+            'rendered': self.rendered,
+            'skipped': self.skipped,
+            'failed': self.failed,
+            'errors': self.errors[:20],
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+        }
+
+
+def prerender(cache: PrerenderCache, renderer, items: Iterable[Dict], formats: Sequence[str],
+              run: PrerenderRun):
+    """
+    渲染未緩存的標籤並放入緩存（在後台線程中執行）
+    renderer 為 BatchRenderer，與打印共用進程池；渲染窗口有限，打印任務不會被長時間擋住
+    """
+    render_formats = cache_formats(formats)
+    pending = []
+    for item in items:
+        if cache.contains(item, formats):
+            run.skipped += 1
+        else:
+            pending.append(item)
+
+    try:
+        for item, payload in zip(pending, renderer.render(pending, formats=render_formats, media=cache.media)):
+            if payload.get('error'):
+                run.failed += 1
+                run.errors.append({'name': payload.get('name', ''), 'error': payload['error']})
+                continue
+            cache.put(item, payload)
+            run.rendered += 1
+        run.status = 'done'
+    except Exception as e:
+        run.status = 'failed'
+        run.errors.append({'name': None, 'error': str(e)})
+    finally:
+        run.finished_at = time.time()
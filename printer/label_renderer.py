@@ -0,0 +1,344 @@
+"""
+標籤渲染模組
+生成 62mm x 100mm 標籤圖像（按介質的可打印範圍渲染，打印時不需要縮放），
+並緩存字體、QR Code 和空白底圖以加速重複渲染
+
+顏色模式（LABEL_COLOR_MODE 環境變量）:
+- mono: 1-bit 黑白圖像（默認，QL-820NWB 只能打印黑色）
+- black_red: 白/黑/紅三色調色板圖像，配合 DK-22251 紅黑標籤（PRINTER_MEDIA=62red）
+- rgb: 全彩 RGB 圖像（舊實現，打印時再轉換為黑白）
+"""
+
+import io
+import os
+import time
+from functools import lru_cache
+from typing import Dict, Optional, Tuple
+
+from PIL import Image, ImageColor, ImageDraw, ImageFont
+import qrcode
+
+from brother_ql_raster import DEFAULT_MEDIA, is_red, printable_size
+from print_metrics import observe_stage
+
+try:
+    import numpy as np
+    NUMPY_AVAILABLE = True
+except ImportError:
+    NUMPY_AVAILABLE = False
+
+# 標籤尺寸配置（62mm x 100mm），像素尺寸為整張標籤；實際渲染的畫布為介質的可打印範圍（見 label_canvas_size）
+LABEL_WIDTH_MM = 62
+LABEL_HEIGHT_MM = 100
+DPI = 300  # 打印解析度
+LABEL_WIDTH_PX = int(LABEL_WIDTH_MM * DPI / 25.4)
+LABEL_HEIGHT_PX = int(LABEL_HEIGHT_MM * DPI / 25.4)
+
+# 默認佈局
+QR_SIZE_MM = 38
+QR_SIZE_PX = int(QR_SIZE_MM * DPI / 25.4)
+QR_TOP_PX = 20  # 距離頂部 20px
+NAME_FONT_SIZE = 22
+COMPANY_FONT_SIZE = 16
+
+# 字體候選路徑（按順序嘗試），可透過 LABEL_FONT_PATH 環境變量指定
+FONT_CANDIDATES = [
+    '/System/Library/Fonts/Helvetica.ttc',                         # macOS
+    '/System/Library/Fonts/PingFang.ttc',                          # macOS 中文
+    '/usr/share/fonts/opentype/noto/NotoSansCJK-Regular.ttc',      # Linux 中文
+    '/usr/share/fonts/noto-cjk/NotoSansCJK-Regular.ttc',
+    '/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf',             # Debian/Ubuntu
+    '/usr/share/fonts/dejavu/DejaVuSans.ttf',                      # Fedora/CentOS
+]
+
+# 顏色模式
+COLOR_RGB = 'rgb'
+COLOR_MONO = 'mono'
+COLOR_BLACK_RED = 'black_red'
+COLOR_MODES = (COLOR_RGB, COLOR_MONO, COLOR_BLACK_RED)
+DEFAULT_COLOR_MODE = os.getenv('LABEL_COLOR_MODE', COLOR_MONO)
+
+# 各顏色模式對應的 PIL 圖像模式
+IMAGE_MODES = {COLOR_RGB: 'RGB', COLOR_MONO: '1', COLOR_BLACK_RED: 'P'}
+COLOR_MODES_BY_IMAGE_MODE = {image_mode: color_mode for color_mode, image_mode in IMAGE_MODES.items()}
+
+# black_red 模式的調色板索引
+PALETTE_WHITE = 0
+PALETTE_BLACK = 1
+PALETTE_RED = 2
+BLACK_RED_PALETTE = [255, 255, 255, 0, 0, 0, 255, 0, 0]
+
+# 亮度高於此值的顏色視為白色（不打印），其餘打印為黑色（或紅色）
+INK_LIGHTNESS_THRESHOLD = 200
+
+# QR Code 緩存大小（按內容計，重印和批量重印時直接命中）
+QR_CACHE_SIZE = int(os.getenv('QR_CACHE_SIZE', 2048))
+
+
+# 粗體字體候選路徑，可透過 LABEL_BOLD_FONT_PATH 環境變量指定；找不到時使用普通字體
+BOLD_FONT_CANDIDATES = [
+    '/System/Library/Fonts/Supplemental/Arial Bold.ttf',           # macOS
+    '/usr/share/fonts/opentype/noto/NotoSansCJK-Bold.ttc',         # Linux 中文
+    '/usr/share/fonts/noto-cjk/NotoSansCJK-Bold.ttc',
+    '/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf',        # Debian/Ubuntu
+    '/usr/share/fonts/dejavu/DejaVuSans-Bold.ttf',                 # Fedora/CentOS
+]
+
+
+@lru_cache(maxsize=2)
+def resolve_font_path(bold: bool = False) -> Optional[str]:
+    """
+    查找第一個存在的字體文件，結果只計算一次
+    """
+    if bold:
+        env_path = os.getenv('LABEL_BOLD_FONT_PATH')
+        candidates = [env_path] + BOLD_FONT_CANDIDATES if env_path else BOLD_FONT_CANDIDATES
+        for path in candidates:
+            if os.path.exists(path):
+                return path
+        return resolve_font_path()
+
+    env_path = os.getenv('LABEL_FONT_PATH')
+    candidates = [env_path] + FONT_CANDIDATES if env_path else FONT_CANDIDATES
+    for path in candidates:
+        if os.path.exists(path):
+            return path
+    print("⚠️  未找到 TrueType 字體，使用 PIL 默認字體")
+    return None
+
+
+@lru_cache(maxsize=64)
+def get_font(path: Optional[str], size: int):
+    """
+    按 (路徑, 大小) 緩存字體對象
+    """
+    if path:
+        try:
+            return ImageFont.truetype(path, size)
+        except OSError as e:
+            print(f"⚠️  字體加載失敗 {path}: {e}")
+    return ImageFont.load_default()
+
+
+def resolve_color_mode(color_mode: Optional[str] = None) -> str:
+    """驗證顏色模式，未指定時使用 LABEL_COLOR_MODE"""
+    color_mode = color_mode or DEFAULT_COLOR_MODE
+    if color_mode not in COLOR_MODES:
+        raise ValueError(f'未知的顏色模式: {color_mode}（可選: {", ".join(COLOR_MODES)}）')
+    return color_mode
+
+
+def ink(color, color_mode: str):
+    """
+    將 CSS 顏色轉換為指定顏色模式下的填充值
+    mono: 淺色為白色，其餘為黑色（例如 #666 的公司名稱打印為黑色）
+    black_red: 紅色系為紅色，淺色為白色，其餘為黑色
+    """
+    if color_mode == COLOR_RGB:
+        return color
+    rgb = ImageColor.getrgb(color) if isinstance(color, str) else color
+    light = (rgb[0] * 299 + rgb[1] * 587 + rgb[2] * 114) / 1000 > INK_LIGHTNESS_THRESHOLD
+    if color_mode == COLOR_MONO:
+        return 1 if light else 0
+    if light:
+        return PALETTE_WHITE
+    return PALETTE_RED if is_red(rgb) else PALETTE_BLACK
+
+
+@lru_cache(maxsize=1)
+def palette_image() -> Image.Image:
+    """black_red 模式的調色板，供 quantize() 使用"""
+    palette = Image.new('P', (1, 1))
+    palette.putpalette(BLACK_RED_PALETTE + [255, 255, 255] * 253)
+    return palette
+
+
+def new_image(width: int, height: int, color_mode: str) -> Image.Image:
+    """指定顏色模式的白色畫布"""
+    if color_mode == COLOR_BLACK_RED:
+        img = Image.new('P', (width, height), PALETTE_WHITE)
+        img.putpalette(BLACK_RED_PALETTE)
+        return img
+    return Image.new(IMAGE_MODES[color_mode], (width, height), 'white')
+
+
+def convert_image(asset: Image.Image, color_mode: str) -> Tuple[Image.Image, Optional[Image.Image]]:
+    """
+    將圖片（logo、QR Code 等）轉換為標籤的顏色模式
+    返回 (圖像, 遮罩)，透明圖片的遮罩由 alpha 通道生成
+    """
+    mask = None
+    if asset.mode in ('RGBA', 'LA', 'PA') or (asset.mode == 'P' and 'transparency' in asset.info):
+        asset = asset.convert('RGBA')
+        if color_mode == COLOR_RGB:
+            return asset, asset
+        mask = asset.getchannel('A').point(lambda a: 255 if a >= 128 else 0, '1')
+
+    if color_mode == COLOR_RGB or (color_mode == COLOR_MONO and asset.mode == '1'):
+        return asset, mask
+
+    if color_mode == COLOR_MONO:
+        return asset.convert('RGB').convert('1'), mask
+
+    if asset.mode == '1':
+        # 1-bit 圖像（例如 QR Code）直接映射為黑色，不需要量化
+        converted = new_image(asset.width, asset.height, COLOR_BLACK_RED)
+        converted.paste(PALETTE_BLACK, (0, 0), asset.point(lambda v: 0 if v else 255, '1'))
+        return converted, mask
+    # 按最接近的顏色映射，紅色 logo 等純色圖片不會被抖動成紅黑混合
+    return asset.convert('RGB').quantize(palette=palette_image(), dither=Image.Dither.NONE), mask
+
+
+def paste_image(img: Image.Image, asset: Image.Image, box: Tuple[int, int]):
+    """將圖片貼到標籤上（自動轉換為標籤的顏色模式）"""
+    asset, mask = convert_image(asset, COLOR_MODES_BY_IMAGE_MODE.get(img.mode, COLOR_RGB))
+    img.paste(asset, box, mask)
+
+
+def qr_matrix(qr_data: str):
+    """
+    生成 QR Code 模塊矩陣（含 4 個模塊的靜區），True 代表黑色模塊
+    """
+    qr = qrcode.QRCode(
+        version=1,
+        error_correction=qrcode.constants.ERROR_CORRECT_L,
+        border=4,
+    )
+    qr.add_data(qr_data)
+    qr.make(fit=True)
+    return qr.get_matrix()
+
+
+def rasterize_qr(matrix, size_px: int) -> Image.Image:
+    """
+    將模塊矩陣直接繪製為 size_px x size_px 的 1-bit 圖像
+    每個模塊使用相同的整數像素大小，邊緣清晰，不經過插值縮放；
+    剩餘的像素平均分配到四周作為額外的白邊
+    """
+    modules = len(matrix)
+    module_px = size_px // modules
+    if module_px < 1:
+        # 目標尺寸小於模塊數，只能縮小（打印時無法掃描，僅用於預覽）
+        module_px = 1
+
+    if NUMPY_AVAILABLE:
+        # PIL 的 '1' 模式中 True 為白色
+        cells = ~np.array(matrix, dtype=bool)
+        pixels = cells.repeat(module_px, axis=0).repeat(module_px, axis=1)
+        qr_img = Image.fromarray(pixels)
+    else:
+        cells = bytes(0 if dark else 255 for row in matrix for dark in row)
+        qr_img = Image.frombytes('L', (modules, modules), cells).convert('1')
+        qr_img = qr_img.resize((modules * module_px, modules * module_px), Image.Resampling.NEAREST)
+
+    if qr_img.width == size_px:
+        return qr_img
+    if qr_img.width > size_px:
+        return qr_img.resize((size_px, size_px), Image.Resampling.NEAREST)
+    canvas = Image.new('1', (size_px, size_px), 1)
+    offset = (size_px - qr_img.width) // 2
+    canvas.paste(qr_img, (offset, offset))
+    return canvas
+
+
+@lru_cache(maxsize=QR_CACHE_SIZE)
+def render_qr(qr_data: str, size_px: int) -> Image.Image:
+    """
+    按 (內容, 尺寸) 緩存 QR Code 圖像（1-bit）
+    返回的圖像為共享對象，只能讀取（paste 到標籤上），不可修改
+    """
+    start = time.perf_counter()
+    qr_img = rasterize_qr(qr_matrix(qr_data), size_px)
+    observe_stage('qr', time.perf_counter() - start)
+    return qr_img
+
+
+def label_canvas_size(media: str = DEFAULT_MEDIA) -> Tuple[int, int]:
+    """
+    默認標籤的畫布尺寸: 寬度為介質的可打印寬度（62mm 標籤為 696 點，不是 732），
+    高度為預切標籤的可打印長度，連續標籤為 LABEL_HEIGHT_MM
+    """
+    return printable_size(media, LABEL_HEIGHT_PX)
+
+
+def create_label_image(name, company, qr_data, color_mode: Optional[str] = None, media: str = DEFAULT_MEDIA):
+    """
+    創建標籤圖像（62mm x 100mm，按 media 的可打印範圍渲染）
+    color_mode: mono / black_red / rgb，默認為 LABEL_COLOR_MODE
+    """
+    color_mode = resolve_color_mode(color_mode)
+    width, height = label_canvas_size(media)
+
+    img = new_image(width, height, color_mode)
+    draw = ImageDraw.Draw(img)
+
+    # QR Code（38mm）置中貼上
+    qr_img = render_qr(qr_data, QR_SIZE_PX)
+    qr_x = (width - QR_SIZE_PX) // 2
+    paste_image(img, qr_img, (qr_x, QR_TOP_PX))
+
+    font_path = resolve_font_path()
+    font_large = get_font(font_path, NAME_FONT_SIZE)
+    font_small = get_font(font_path, COMPANY_FONT_SIZE)
+
+    # 計算文字位置（在 QR Code 下方）
+    text_y = QR_TOP_PX + QR_SIZE_PX + 20
+
+    # 繪製姓名（置中）
+    name_bbox = draw.textbbox((0, 0), name, font=font_large)
+    name_width = name_bbox[2] - name_bbox[0]
+    name_x = (width - name_width) // 2
+    draw.text((name_x, text_y), name, fill=ink('black', color_mode), font=font_large)
+
+    # 繪製公司名稱（置中）
+    company_bbox = draw.textbbox((0, 0), company, font=font_small)
+    company_width = company_bbox[2] - company_bbox[0]
+    company_x = (width - company_width) // 2
+    draw.text((company_x, text_y + 30), company, fill=ink('#666', color_mode), font=font_small)
+
+    return img
+
+
+def encode_label_png(img) -> bytes:
+    """
+    將標籤圖像編碼為 PNG bytes（全程在記憶體中，不寫入臨時文件）
+    """
+    buffer = io.BytesIO()
+    img.save(buffer, 'PNG')
+    return buffer.getvalue()
+
+
+def cache_counters() -> Dict:
+    """
+    本進程各緩存的命中統計（渲染進程隨渲染結果返回，見 BatchRenderer.cache_stats）
+    """
+    counters = {}
+    for cache_name, func in (('fonts', get_font), ('qrcodes', render_qr)):
+        info = func.cache_info()
+        counters[cache_name] = {
+            'hits': info.hits,
+            'misses': info.misses,
+            'size': info.currsize,
+            'max_size': info.maxsize,
+        }
+    return counters
+
+
+def cache_stats(workers: Optional[Dict] = None) -> Dict:
+    """
+    返回各緩存的命中統計
+    main_process 只包括主進程內的渲染（渲染進程池忙碌時的單張標籤等），
+    大部分標籤在渲染進程中渲染，其統計由調用方以 workers 提供
+    """
+    stats = {'main_process': cache_counters()}
+    if workers is not None:
+        stats['workers'] = workers
+    stats['font_path'] = resolve_font_path()
+    stats['color_mode'] = DEFAULT_COLOR_MODE
+    return stats
+
+
+def clear_caches():
+    """清空所有渲染緩存（例如更換字體後）"""
+    for func in (resolve_font_path, get_font, render_qr):
+        func.cache_clear()
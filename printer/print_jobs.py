@@ -0,0 +1,367 @@
+"""
+打印任務隊列模組
+在進程內以工作線程處理打印任務，HTTP 請求只需提交任務並立即取得任務 ID
+"""
+
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+# 任務狀態
+JOB_QUEUED = 'queued'        # 已排隊，等待工作線程
+JOB_RENDERING = 'rendering'  # 正在生成標籤圖像
+JOB_SENDING = 'sending'      # 正在發送到打印機
+JOB_SENT = 'sent'            # 已成功發送
+JOB_FAILED = 'failed'        # 失敗
+
+JOB_STATES = [JOB_QUEUED, JOB_RENDERING, JOB_SENDING, JOB_SENT, JOB_FAILED]
+FINISHED_STATES = (JOB_SENT, JOB_FAILED)
+
+# 優先級: 現場報到（interactive）總是排在批量預印（batch）之前
+PRIORITY_INTERACTIVE = 'interactive'
+PRIORITY_BATCH = 'batch'
+PRIORITIES = (PRIORITY_INTERACTIVE, PRIORITY_BATCH)
+# 打印機發送隊列使用的排序值（越小越先發送）
+PRIORITY_RANKS = {PRIORITY_INTERACTIVE: 0, PRIORITY_BATCH: 1}
+
+# 批量任務的公平策略: source（不同來源輪流執行）或 fifo（按提交順序）
+FAIRNESS_MODES = ('source', 'fifo')
+
+
+class PrintJob:
+    """單個打印任務（單張或批量）"""
+
+    def __init__(self, kind: str, items: List[Dict], streaming: bool = False,
+                 priority: Optional[str] = None, source: Optional[str] = None):
+        self.id = uuid.uuid4().hex
+        self.kind = kind  # 'single' 或 'batch'
+        self.items = items
+        # 單張打印默認為 interactive，批量默認為 batch
+        self.priority = priority or (PRIORITY_INTERACTIVE if kind == 'single' else PRIORITY_BATCH)
+        self.source = source or 'default'  # 提交任務的客戶端（批量任務按來源公平調度）
+        # 流式任務: 項目在處理期間陸續加入（NDJSON 輸入），close_input() 後結束
+        self.streaming = streaming
+        self._input_closed = not streaming
+        self.status = JOB_QUEUED
+        self.results = []
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._done = threading.Event()
+
+    def set_status(self, status: str, error: Optional[str] = None):
+        """更新任務狀態"""
+        with self._lock:
+            self.status = status
+            if error:
+                self.error = error
+            if status in (JOB_RENDERING, JOB_SENDING) and self.started_at is None:
+                self.started_at = time.time()
+            if status in FINISHED_STATES:
+                self.finished_at = time.time()
+            self._changed.notify_all()
+        if status in FINISHED_STATES:
+            self._done.set()
+
+    def add_result(self, result: Dict):
+        """記錄批量任務中單個項目的結果"""
+        with self._lock:
+            self.results.append(result)
+            self._changed.notify_all()
+
+    def add_item(self, item: Dict):
+        """流式任務: 加入一個項目"""
+        with self._lock:
+            self.items.append(item)
+            self._changed.notify_all()
+
+    def close_input(self):
+        """流式任務: 不再有新項目"""
+        with self._lock:
+            self._input_closed = True
+            self._changed.notify_all()
+
+    def notify(self):
+        """喚醒 wait_results() 的等待者（例如流式輸入中有需要立即返回的無效行）"""
+        with self._lock:
+            self._changed.notify_all()
+
+    def iter_items(self, idle: Optional[float] = None) -> Iterator[Optional[Dict]]:
+        """
+        逐個產出項目；流式任務等待新項目直到輸入結束
+        idle 不為空時，等待 idle 秒仍沒有新項目則產出 None，讓調用者先處理已完成的標籤
+        """
+        index = 0
+        while True:
+            with self._lock:
+                if index >= len(self.items) and not self._input_closed:
+                    self._changed.wait(idle)
+                if index < len(self.items):
+                    item = self.items[index]
+                    index += 1
+                elif self._input_closed:
+                    return
+                else:
+                    item = None
+            if item is not None or idle is not None:
+                yield item
+
+    def wait_results(self, start: int, timeout: Optional[float] = None) -> List[Dict]:
+        """返回第 start 個之後的結果；沒有新結果且任務未完成時最多等待 timeout 秒"""
+        with self._lock:
+            if len(self.results) <= start and self.status not in FINISHED_STATES:
+                self._changed.wait(timeout)
+            return self.results[start:]
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """等待任務完成，返回是否已完成"""
+        return self._done.wait(timeout)
+
+    @property
+    def finished(self) -> bool:
+        return self._done.is_set()
+
+    def to_dict(self) -> Dict:
+        with self._lock:
+            return {
+                'job_id': self.id,
+                'kind': self.kind,
+                'streaming': self.streaming,
+                'priority': self.priority,
+                'source': self.source,
+                'status': self.status,
+                'count': len(self.items),
+                'names': [item.get('name', '') for item in self.items],
+                'results': list(self.results),
+                'error': self.error,
+                'created_at': self.created_at,
+                'started_at': self.started_at,
+                'finished_at': self.finished_at,
+            }
+
+
+class PrintScheduler:
+    """
+    按優先級分配任務給工作線程
+    - interactive 任務總是先於 batch 任務取出
+    - batch 任務最多同時佔用 batch_workers 個工作線程，其餘線程保留給 interactive 任務
+    - fairness='source' 時每個來源最多同時執行 per_source 個 batch 任務，多個來源輪流執行；
+      'fifo' 時按提交順序
+    """
+
+    def __init__(self, batch_workers: int, per_source: int = 1, fairness: str = 'source'):
+        self.batch_workers = max(1, batch_workers)
+        self.per_source = max(1, per_source)
+        self.fairness = fairness if fairness in FAIRNESS_MODES else 'source'
+        self._interactive = deque()
+        self._batches = OrderedDict()  # 來源 -> deque，按輪流順序排列
+        self._running = {}             # 來源 -> 正在執行的 batch 任務數
+        self._cond = threading.Condition()
+
+    def _batch_key(self, job: PrintJob) -> str:
+        return job.source if self.fairness == 'source' else '*'
+
+    def put(self, job: PrintJob):
+        with self._cond:
+            if job.priority == PRIORITY_INTERACTIVE:
+                self._interactive.append(job)
+            else:
+                self._batches.setdefault(self._batch_key(job), deque()).append(job)
+            self._cond.notify_all()
+
+    def _next_batch(self) -> Optional[PrintJob]:
+        if sum(self._running.values()) >= self.batch_workers:
+            return None
+        limit = self.per_source if self.fairness == 'source' else self.batch_workers
+        for key, jobs in list(self._batches.items()):
+            if self._running.get(key, 0) >= limit:
+                continue
+            job = jobs.popleft()
+            # 取出後移到隊尾，下一次輪到其他來源
+            del self._batches[key]
+            if jobs:
+                self._batches[key] = jobs
+            self._running[key] = self._running.get(key, 0) + 1
+            return job
+        return None
+
+    def get(self) -> PrintJob:
+        """阻塞直到有可執行的任務"""
+        with self._cond:
+            while True:
+                if self._interactive:
+                    return self._interactive.popleft()
+                job = self._next_batch()
+                if job:
+                    return job
+                self._cond.wait()
+
+    def done(self, job: PrintJob):
+        """任務完成，釋放 batch 名額"""
+        if job.priority == PRIORITY_INTERACTIVE:
+            return
+        with self._cond:
+            key = self._batch_key(job)
+            self._running[key] -= 1
+            if not self._running[key]:
+                del self._running[key]
+            self._cond.notify_all()
+
+    def qsize(self) -> int:
+        with self._cond:
+            return len(self._interactive) + sum(map(len, self._batches.values()))
+
+    def stats(self) -> Dict:
+        with self._cond:
+            return {
+                'fairness': self.fairness,
+                'batch_workers': self.batch_workers,
+                'per_source': self.per_source,
+                'pending_interactive': len(self._interactive),
+                'pending_batch': {key: len(jobs) for key, jobs in self._batches.items()},
+                'running_batch': dict(self._running),
+            }
+
+
+class PrintJobQueue:
+    """
+    打印任務隊列
+    handler(job) 在工作線程中執行，負責渲染和發送，並透過 job.set_status 回報進度
+    reserved_workers 個工作線程只處理 interactive 任務，大批量任務進行時現場報到仍可立即打印
+    start=False 時工作線程在調用 start() 後才啟動，之前提交的任務留在隊列中
+    """
+
+    def __init__(self, handler: Callable[[PrintJob], None], workers: int = 2, max_history: int = 1000,
+                 reserved_workers: int = 1, per_source: int = 1, fairness: str = 'source', start: bool = True):
+        self.handler = handler
+        self.max_history = max_history
+        self.workers = max(1, workers)
+        self._scheduler = PrintScheduler(self.workers - min(reserved_workers, self.workers - 1), per_source, fairness)
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+        self._threads = []
+
+        if start:
+            self.start()
+
+    def start(self) -> bool:
+        """啟動工作線程，已啟動時返回 False"""
+        with self._lock:
+            if self._threads:
+                return False
+            for i in range(self.workers):
+                t = threading.Thread(target=self._worker, name=f'print-worker-{i}', daemon=True)
+                t.start()
+                self._threads.append(t)
+        return True
+
+    def submit(self, kind: str, items: List[Dict], streaming: bool = False,
+               priority: Optional[str] = None, source: Optional[str] = None) -> PrintJob:
+        """提交任務，立即返回（流式任務之後以 add_item() 加入項目）"""
+        job = PrintJob(kind, items, streaming, priority, source)
+        with self._lock:
+            self._jobs[job.id] = job
+            self._trim_history()
+        self._scheduler.put(job)
+        return job
+
+    def get(self, job_id: str) -> Optional[PrintJob]:
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def list_jobs(self, status: Optional[str] = None, limit: int = 100) -> List[PrintJob]:
+        """按提交時間倒序列出任務"""
+        with self._lock:
+            jobs = list(self._jobs.values())
+        if status:
+            jobs = [job for job in jobs if job.status == status]
+        return list(reversed(jobs))[:limit]
+
+    def stats(self) -> Dict:
+        with self._lock:
+            jobs = list(self._jobs.values())
+        counts = {state: 0 for state in JOB_STATES}
+        for job in jobs:
+            counts[job.status] = counts.get(job.status, 0) + 1
+        return {
+            'workers': len(self._threads),
+            'pending': self._scheduler.qsize(),
+            'jobs': counts,
+            'scheduler': self._scheduler.stats(),
+        }
+
+    def _trim_history(self):
+        # 只淘汰已完成的舊任務，未完成的任務必須保留以便查詢
+        if len(self._jobs) <= self.max_history:
+            return
+        for job_id in list(self._jobs.keys()):
+            if len(self._jobs) <= self.max_history:
+                break
+            if self._jobs[job_id].finished:
+                del self._jobs[job_id]
+
+    def _worker(self):
+        while True:
+            job = self._scheduler.get()
+            try:
+                self.handler(job)
+                if not job.finished:
+                    job.set_status(JOB_SENT)
+            except Exception as e:
+                print(f"❌ 打印任務 {job.id} 錯誤: {e}")
+                job.set_status(JOB_FAILED, str(e))
+            finally:
+                self._scheduler.done(job)
+
+
+class JobDeduplicator:
+    """
+    重複請求去重（記憶體中的 TTL 映射: 請求鍵 -> 任務）
+    同一鍵在有效期內再次提交時返回原任務，不再重新渲染和打印；
+    原任務失敗時允許重新提交（重試是合理的）
+    """
+
+    def __init__(self, ttl: float, max_entries: int = 10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # 鍵 -> (過期時間, 任務)，按插入順序即過期順序
+        self._lock = threading.Lock()
+        self.hits = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.ttl > 0
+
+    def _expire(self, now: float):
+        while self._entries:
+            key, (expires_at, _) = next(iter(self._entries.items()))
+            if expires_at > now and len(self._entries) <= self.max_entries:
+                break
+            del self._entries[key]
+
+    def submit(self, key: str, submit: Callable[[], PrintJob]) -> Tuple[PrintJob, bool]:
+        """
+        返回 (任務, 是否重複)
+        檢查和提交在同一把鎖內完成，同時到達的重試只會創建一個任務
+        """
+        now = time.time()
+        with self._lock:
+            self._expire(now)
+            entry = self._entries.get(key)
+            if entry and entry[1].status != JOB_FAILED:
+                self.hits += 1
+                return entry[1], True
+            job = submit()
+            self._entries.pop(key, None)
+            self._entries[key] = (now + self.ttl, job)
+            return job, False
+
+    def stats(self) -> Dict:
+        with self._lock:
+            self._expire(time.time())
+            return {'ttl': self.ttl, 'entries': len(self._entries), 'hits': self.hits}
@@ -0,0 +1,246 @@
+"""
+打印指標模組
+記錄打印流程各階段的耗時直方圖和計數器，並輸出 Prometheus 文本格式（/metrics）
+
+階段（print_stage_duration_seconds 的 stage 標籤）:
+- render: 生成標籤圖像（包括 QR Code）
+- qr: 生成 QR Code（只在緩存未命中時記錄）
+- encode_png / encode_raster: 編碼為 PNG（CUPS）或 Brother 光柵命令（網路打印）
+- spool: 交給 lpr
+- transmit: 寫入打印機 9100 端口
+- queue_wait: 任務在隊列中等待工作線程的時間
+
+渲染可能在子進程中進行，子進程用 collect_stages() 收集耗時並隨結果返回，
+由主進程調用 observe_stages() 記錄
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterable, Optional, Sequence, Tuple
+
+# 默認直方圖區間（秒），覆蓋 1ms 的渲染到數秒的 lpr/網路超時
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+DISCOVERY_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """指標基類，按標籤值分別保存數據"""
+
+    kind = 'untyped'
+
+    def __init__(self, name: str, help_text: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help_text
+        self.label_names = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict) -> Tuple[str, ...]:
+        if set(labels) != set(self.label_names):
+            raise ValueError(f'{self.name} 需要標籤 {self.label_names}，收到 {tuple(labels)}')
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def _samples(self) -> Iterable[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.kind}']
+        lines.extend(self._samples())
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(self, name: str, help_text: str, labels: Sequence[str] = ()):
+        # 計數器名稱以 _total 結尾
+        super().__init__(name if name.endswith('_total') else f'{name}_total', help_text, labels)
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def _samples(self):
+        with self._lock:
+            values = dict(self._values)
+        for key, value in sorted(values.items()):
+            yield f'{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}'
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def _samples(self):
+        with self._lock:
+            values = dict(self._values)
+        for key, value in sorted(values.items()):
+            yield f'{self.name}{_format_labels(self.label_names, key)} {_format_value(value)}'
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, help_text: str, labels: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = {'counts': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry['counts'][index] += 1
+            entry['sum'] += value
+            entry['count'] += 1
+
+    def snapshot(self, **labels) -> Optional[Dict]:
+        with self._lock:
+            entry = self._values.get(self._key(labels))
+            return None if entry is None else {'count': entry['count'], 'sum': entry['sum']}
+
+    def _samples(self):
+        with self._lock:
+            values = {key: dict(entry, counts=list(entry['counts'])) for key, entry in self._values.items()}
+        for key, entry in sorted(values.items()):
+            for bound, count in zip(self.buckets, entry['counts']):
+                labels = _format_labels(self.label_names, key, ('le', _format_value(bound)))
+                yield f'{self.name}_bucket{labels} {count}'
+            labels = _format_labels(self.label_names, key, ('le', '+Inf'))
+            yield f'{self.name}_bucket{labels} {entry["count"]}'
+            yield f'{self.name}_sum{_format_labels(self.label_names, key)} {_format_value(entry["sum"])}'
+            yield f'{self.name}_count{_format_labels(self.label_names, key)} {entry["count"]}'
+
+
+class MetricsRegistry:
+    """進程內的指標集合"""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric: Metric) -> Metric:
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name: str, help_text: str, labels: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(name, help_text, labels))
+
+    def gauge(self, name: str, help_text: str, labels: Sequence[str] = ()) -> Gauge:
+        return self._register(Gauge(name, help_text, labels))
+
+    def histogram(self, name: str, help_text: str, labels: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, help_text, labels, buckets))
+
+    def render(self) -> str:
+        """Prometheus 文本格式（text/plain; version=0.0.4）"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return '\n'.join(metric.render() for metric in metrics) + '\n'
+
+
+REGISTRY = MetricsRegistry()
+
+STAGE_SECONDS = REGISTRY.histogram(
+    'print_stage_duration_seconds', 'Duration of each stage of the print path', labels=('stage',))
+PRINT_RESULTS = REGISTRY.counter(
+    'print_labels', 'Labels handed to a transport, by transport and result', labels=('transport', 'result'))
+DISCOVERY_SECONDS = REGISTRY.histogram(
+    'printer_discovery_duration_seconds', 'Duration of each printer discovery method', labels=('method',),
+    buckets=DISCOVERY_BUCKETS)
+DISCOVERY_FOUND = REGISTRY.counter(
+    'printer_discovery_found', 'Printers found, by discovery method', labels=('method',))
+DEDUPLICATED = REGISTRY.counter(
+    'print_requests_deduplicated', 'Repeated print requests answered with the original job', labels=('reason',))
+
+# collect_stages() 的收集器（每個線程獨立）
+_collectors = threading.local()
+
+
+def observe_stage(stage: str, seconds: float):
+    """記錄一個階段的耗時（秒）"""
+    STAGE_SECONDS.observe(seconds, stage=stage)
+    collector = getattr(_collectors, 'stages', None)
+    if collector is not None:
+        collector[stage] = collector.get(stage, 0.0) + seconds
+
+
+def observe_stages(stages: Dict[str, float]):
+    """記錄子進程返回的各階段耗時"""
+    for stage, seconds in stages.items():
+        STAGE_SECONDS.observe(seconds, stage=stage)
+
+
+@contextmanager
+def timed_stage(stage: str):
+    """計時 with 區塊並記錄為指定階段"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(stage, time.perf_counter() - start)
+
+
+@contextmanager
+def collect_stages():
+    """
+    收集當前線程在 with 區塊內記錄的階段耗時，返回 {stage: 秒}
+    用於子進程渲染: 結果隨 payload 返回主進程
+    """
+    previous = getattr(_collectors, 'stages', None)
+    stages = {}
+    _collectors.stages = stages
+    try:
+        yield stages
+    finally:
+        _collectors.stages = previous
+
+
+def record_result(transport: str, success: bool, count: int = 1):
+    """記錄交給傳輸方式（cups / network）的標籤數量和結果"""
+    PRINT_RESULTS.inc(count, transport=transport, result='success' if success else 'failure')
+
+
+def record_discovery(method: str, seconds: float, found: int):
+    """記錄一個發現方法的耗時和發現的打印機數量"""
+    DISCOVERY_SECONDS.observe(seconds, method=method)
+    DISCOVERY_FOUND.inc(found, method=method)
+
+
+def render_metrics() -> str:
+    return REGISTRY.render()
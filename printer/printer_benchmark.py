@@ -0,0 +1,863 @@
+"""
+打印橋接性能測試
+比較不同實現的單張標籤耗時，並以假打印機（9100 端口）和假 cupsd（IPP）測試整個打印橋接服務
+
+使用方式:
+    python printer/printer_benchmark.py [--count 200] [--only bridge] [--kiosks 8] [--json results.json]
+
+--json 將結果保存為 JSON，方便比較修改前後的數據
+"""
+
+import argparse
+import asyncio
+import contextlib
+import http.server
+import io
+import ipaddress
+import json
+import os
+import socket
+import statistics
+import stat
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import qrcode
+from PIL import Image
+
+import label_renderer
+from label_renderer import create_label_image, encode_label_png, rasterize_qr, qr_matrix, QR_SIZE_PX
+
+
+# 結果（--json 輸出）: {測試名稱: {項目: 數據}}
+RESULTS = {}
+_current_bench = None
+
+
+def record(title, **values):
+    """保存一項結果到 RESULTS"""
+    RESULTS.setdefault(_current_bench or 'misc', {})[title.strip()] = values
+
+
+def percentile(samples, fraction):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+def timed(func, count):
+    """執行 func count 次，返回每次耗時（毫秒）"""
+    samples = []
+    for i in range(count):
+        start = time.perf_counter()
+        func(i)
+        samples.append((time.perf_counter() - start) * 1000)
+    return samples
+
+
+def report(title, samples):
+    mean = statistics.mean(samples)
+    p50 = percentile(samples, 0.5)
+    p99 = percentile(samples, 0.99)
+    print(f"   {title:<28} 平均 {mean:7.3f} ms  p50 {p50:7.3f} ms  p99 {p99:7.3f} ms")
+    record(title, mean_ms=round(mean, 3), p50_ms=round(p50, 3), p99_ms=round(p99, 3), count=len(samples))
+    return mean
+
+
+def report_rate(title, count, seconds):
+    """輸出吞吐量（張/秒）"""
+    rate = count / seconds if seconds else float('inf')
+    print(f"   {title:<28} {rate:8.1f} 張/秒  ({count} 張, {seconds:.3f} s)")
+    record(title, labels_per_s=round(rate, 2), count=count, seconds=round(seconds, 3))
+    return rate
+
+
+def current_rss():
+    """當前進程的常駐記憶體（bytes）；非 Linux 時使用峰值"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def bench_label_io(count=200):
+    """
+    比較標籤輸出方式：
+    - 臨時文件: 保存 PNG 到 /tmp，再讀回並刪除（舊實現）
+    - 記憶體: 編碼到 BytesIO（新實現）
+    """
+    print(f"\n📦 標籤輸出 ({count} 張)")
+    label_img = create_label_image('張三 Benchmark', 'ABC 公司', 'USER123')
+    tmp_dir = tempfile.gettempdir()
+
+    def via_temp_file(i):
+        temp_path = os.path.join(tmp_dir, f'label_bench_{i}.png')
+        label_img.save(temp_path, 'PNG')
+        with open(temp_path, 'rb') as f:
+            f.read()
+        os.remove(temp_path)
+
+    def via_memory(i):
+        encode_label_png(label_img)
+
+    legacy = report('臨時文件', timed(via_temp_file, count))
+    memory = report('記憶體 (BytesIO)', timed(via_memory, count))
+    print(f"   每張節省 {legacy - memory:.3f} ms ({(1 - memory / legacy) * 100:.1f}%)")
+
+
+def bench_render_cache(count=200):
+    """
+    比較冷啟動渲染（每次清空緩存）和重印同一位參加者（緩存命中）
+    """
+    print(f"\n🗂️  渲染緩存 ({count} 張)")
+
+    def cold(i):
+        label_renderer.clear_caches()
+        create_label_image('張三 Benchmark', 'ABC 公司', 'USER123')
+
+    def warm(i):
+        create_label_image('張三 Benchmark', 'ABC 公司', 'USER123')
+
+    cold_ms = report('無緩存', timed(cold, count))
+    warm_ms = report('緩存命中', timed(warm, count))
+    print(f"   每張節省 {cold_ms - warm_ms:.3f} ms ({(1 - warm_ms / cold_ms) * 100:.1f}%)")
+
+
+def bench_color_modes(count=200):
+    """
+    比較顏色模式: RGB（舊實現）vs 1-bit vs 紅黑調色板
+    包括渲染、PNG 編碼、光柵編碼耗時，以及批量保存在記憶體中的圖像和 PNG 大小
+    """
+    from brother_ql_raster import encode_label
+
+    print(f"\n🎨 顏色模式 ({count} 張)")
+    for color_mode in label_renderer.COLOR_MODES:
+        images = []
+
+        def render(i):
+            images.append(create_label_image(f'Attendee {i}', 'ABC 公司', 'USER123', color_mode))
+
+        report(f'{color_mode} 渲染', timed(render, count))
+        pngs = []
+        report(f'{color_mode} PNG 編碼', timed(lambda i: pngs.append(encode_label_png(images[i])), count))
+        media = '62red' if color_mode == label_renderer.COLOR_BLACK_RED else '62'
+        report(f'{color_mode} 光柵編碼', timed(lambda i: encode_label(images[i], media=media), count))
+
+        # tobytes(): RGB 每像素 3 bytes，調色板每像素 1 byte，1-bit 每 8 像素 1 byte
+        image_bytes = sum(len(img.tobytes()) for img in images)
+        png_bytes = sum(len(png) for png in pngs)
+        print(f"   {color_mode:<28} 圖像 {image_bytes / 1024 / 1024:7.2f} MB  PNG {png_bytes / 1024:8.1f} KB")
+
+
+def measure_label_memory(color_mode, count):
+    """
+    在獨立進程中渲染 count 張標籤並全部保留，返回 (耗時秒, 記憶體增長 bytes)
+    PIL 的圖像緩衝區不經過 Python 的記憶體分配器，只能按進程 RSS 計算
+    """
+    create_label_image('warmup', 'ABC 公司', 'USER0', color_mode)
+    before = current_rss()
+    start = time.perf_counter()
+    images = [create_label_image(f'Attendee {i}', 'ABC 公司', f'USER{i:05d}', color_mode) for i in range(count)]
+    elapsed = time.perf_counter() - start
+    grown = current_rss() - before
+    del images
+    return elapsed, grown
+
+
+def bench_label_memory(count=200):
+    """
+    create_label_image 吞吐量和記憶體佔用（每種顏色模式在新進程中測試，互不影響）
+    """
+    print(f"\n🧠 標籤渲染吞吐量和記憶體 ({count} 張，全部保留在記憶體)")
+    for color_mode in label_renderer.COLOR_MODES:
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            elapsed, grown = executor.submit(measure_label_memory, color_mode, count).result()
+        rate = count / elapsed
+        per_label = grown / count
+        print(f"   {color_mode:<28} {rate:8.1f} 張/秒  記憶體 {grown / 1024 / 1024:7.2f} MB"
+              f"（每張 {per_label / 1024:7.1f} KB）")
+        record(color_mode, labels_per_s=round(rate, 2), rss_bytes=grown, bytes_per_label=round(per_label))
+
+
+def bench_batch_render(count=200):
+    """
+    比較批量渲染: 串行 vs 進程池（大小為 CPU 核心數）
+    """
+    from batch_renderer import BatchRenderer, render_label_payload
+
+    print(f"\n🏭 批量渲染 ({count} 張, {os.cpu_count()} 核心)")
+    items = [{'name': f'Attendee {i}', 'company': 'ABC 公司', 'qrcode': f'USER{i:05d}'} for i in range(count)]
+
+    start = time.perf_counter()
+    for item in items:
+        render_label_payload(item, formats=('png',))
+    serial = time.perf_counter() - start
+
+    renderer = BatchRenderer()
+    list(renderer.render(items[:renderer.workers], formats=('png',)))  # 預熱進程池
+    start = time.perf_counter()
+    for _ in renderer.render(items, formats=('png',)):
+        pass
+    pooled = time.perf_counter() - start
+    renderer.shutdown()
+
+    print(f"   串行    {count / serial:8.1f} 張/秒")
+    print(f"   進程池  {count / pooled:8.1f} 張/秒 ({renderer.workers} 進程)")
+
+
+def bench_qr_render(count=200):
+    """
+    比較 QR Code 生成方式（不經過緩存，每次使用不同內容）：
+    - 縮放: box_size=10 生成 RGB 大圖，再用 LANCZOS 縮小到 38mm（舊實現）
+    - 直接: 取模塊矩陣，按整數模塊大小直接生成 1-bit 圖像（新實現）
+    """
+    backend = 'NumPy' if label_renderer.NUMPY_AVAILABLE else 'PIL'
+    print(f"\n🔳 QR Code 生成 ({count} 張, {QR_SIZE_PX}px, {backend})")
+
+    def via_resize(i):
+        qr = qrcode.QRCode(version=1, error_correction=qrcode.constants.ERROR_CORRECT_L, box_size=10, border=4)
+        qr.add_data(f'USER{i:05d}')
+        qr.make(fit=True)
+        qr.make_image(fill_color="black", back_color="white").resize((QR_SIZE_PX, QR_SIZE_PX), Image.Resampling.LANCZOS)
+
+    def via_matrix(i):
+        rasterize_qr(qr_matrix(f'USER{i:05d}'), QR_SIZE_PX)
+
+    matrix = qr_matrix('USER00000')
+
+    def raster_only(i):
+        rasterize_qr(matrix, QR_SIZE_PX)
+
+    legacy = report('LANCZOS 縮放', timed(via_resize, count))
+    direct = report('直接 1-bit', timed(via_matrix, count))
+    report('直接 1-bit（僅繪製）', timed(raster_only, count))
+    print(f"   每張節省 {legacy - direct:.3f} ms ({(1 - direct / legacy) * 100:.1f}%)")
+
+
+class SinkPrinter:
+    """
+    本地假打印機: 接受 9100 連接並丟棄收到的數據
+    read_delay 不為 0 時每讀取 4 KB 等待該秒數，模擬接收緩慢的打印機
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, read_delay=0.0):
+        self.read_delay = read_delay
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, port))
+        self.sock.listen(128)
+        self.port = self.sock.getsockname()[1]
+        self.connections = 0
+        self.bytes_received = 0
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            self.connections += 1
+            threading.Thread(target=self._drain, args=(conn,), daemon=True).start()
+
+    def _drain(self, conn):
+        with conn:
+            while True:
+                data = conn.recv(4096 if self.read_delay else 65536)
+                if not data:
+                    return
+                self.bytes_received += len(data)
+                if self.read_delay:
+                    time.sleep(self.read_delay)
+
+    def close(self):
+        self.sock.shutdown(socket.SHUT_RDWR)
+        self.sock.close()
+
+
+def bench_connection_reuse(count=200):
+    """
+    比較發送到 9100 端口的方式（本地假打印機）：
+    - 每張新連接（舊實現）
+    - 長連接，每張一個任務
+    - 長連接，整批串流為一個多頁任務
+    """
+    from brother_ql_raster import encode_label, encode_label_page
+    from printer_connection import PrinterConnection
+
+    print(f"\n🔗 9100 連接 ({count} 張)")
+    label_img = create_label_image('張三 Benchmark', 'ABC 公司', 'USER123')
+    raster = encode_label(label_img)
+    page = encode_label_page(label_img)
+    sink = SinkPrinter()
+
+    def new_connection(i):
+        sock = socket.create_connection(('127.0.0.1', sink.port), timeout=10)
+        sock.sendall(raster)
+        sock.close()
+
+    connection = PrinterConnection('127.0.0.1', sink.port, idle_timeout=60)
+
+    try:
+        legacy = report('每張新連接', timed(new_connection, count))
+        persistent = report('長連接', timed(lambda i: connection.send(raster), count))
+        start = time.perf_counter()
+        connection.stream_pages(page for _ in range(count))
+        streamed = (time.perf_counter() - start) * 1000 / count
+        print(f"   {'長連接 + 多頁串流':<28} 平均 {streamed:7.3f} ms")
+        print(f"   長連接每張節省 {legacy - persistent:.3f} ms ({(1 - persistent / legacy) * 100:.1f}%)，"
+              f"假打印機共接受 {sink.connections} 個連接")
+    finally:
+        connection.close()
+        sink.close()
+
+
+# 假 lpr: 讀取 stdin 後退出，LPR_STUB_DELAY 秒可模擬 CUPS 排隊耗時
+STUB_LPR = """#!/bin/sh
+cat > /dev/null
+if [ -n "$LPR_STUB_DELAY" ]; then sleep "$LPR_STUB_DELAY"; fi
+exit 0
+"""
+
+
+# 假 lpstat: -p -d 列出 LPSTAT_STUB_PRINTERS 台打印機，-p <名稱> -v 返回其 device-uri
+STUB_LPSTAT = """#!/bin/sh
+if [ "$3" = "-v" ]; then echo "device for $2: socket://127.0.0.1:9100"; exit 0; fi
+i=0
+while [ $i -lt "${LPSTAT_STUB_PRINTERS:-1}" ]; do echo "printer QL$i is idle.  enabled since Jan 1"; i=$((i+1)); done
+echo "system default destination: QL0"
+"""
+
+
+def install_stub_lpr():
+    """在臨時目錄中創建假 lpr 和 lpstat 並加入 PATH 最前面，返回目錄"""
+    stub_dir = tempfile.mkdtemp(prefix='lpr_stub_')
+    for name, script in (('lpr', STUB_LPR), ('lpstat', STUB_LPSTAT)):
+        path = os.path.join(stub_dir, name)
+        with open(path, 'w') as f:
+            f.write(script)
+        os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    os.environ['PATH'] = stub_dir + os.pathsep + os.environ.get('PATH', '')
+    return stub_dir
+
+
+class FakeCupsServer:
+    """
+    本地假 cupsd: 以 HTTP/1.1 keep-alive 回應 IPP Print-Job（丟棄文件數據）和 CUPS-Get-Printers
+    printers 為 CUPS-Get-Printers 返回的打印機數量
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, printers=1):
+        import ipp_client
+
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def setup(self):
+                super().setup()
+                server.connections += 1
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                request = ipp_client.decode_message(body)
+                groups = [(ipp_client.TAG_OPERATION, [
+                    (ipp_client.TAG_CHARSET, 'attributes-charset', 'utf-8'),
+                    (ipp_client.TAG_LANGUAGE, 'attributes-natural-language', 'en'),
+                ])]
+                if request['code'] == ipp_client.OP_PRINT_JOB:
+                    server.jobs += 1
+                    server.bytes_received += len(request['data'])
+                    groups.append((ipp_client.TAG_JOB, [
+                        (ipp_client.TAG_INTEGER, 'job-id', server.jobs),
+                        (ipp_client.TAG_ENUM, 'job-state', 3),
+                    ]))
+                elif request['code'] == ipp_client.OP_CUPS_GET_PRINTERS:
+                    for i in range(server.printers):
+                        groups.append((ipp_client.TAG_PRINTER, [
+                            (ipp_client.TAG_NAME, 'printer-name', f'QL{i}'),
+                            (ipp_client.TAG_URI, 'device-uri', f'socket://127.0.0.{i + 1}:9100'),
+                            (ipp_client.TAG_ENUM, 'printer-state', 3),
+                            (ipp_client.TAG_BOOLEAN, 'printer-is-accepting-jobs', True),
+                        ]))
+                payload = ipp_client.encode_message(ipp_client.STATUS_OK, request['request_id'], groups)
+                self.send_response(200)
+                self.send_header('Content-Type', ipp_client.IPP_MIMETYPE)
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args):
+                pass
+
+        self.printers = printers
+        self.connections = 0
+        self.jobs = 0
+        self.bytes_received = 0
+        self.httpd = http.server.ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self.address = f'{host}:{self.httpd.server_address[1]}'
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def bench_cups_client(count=200, printers=8):
+    """
+    比較 CUPS 打印和查詢的方式（假 lpr / lpstat 和假 cupsd）：
+    - 每張標籤調用 lpr 子進程（舊實現）
+    - IPP Print-Job，每張新連接
+    - IPP Print-Job，keep-alive 長連接
+    - 查詢打印機: lpstat -p -d 加每台打印機一次 lpstat -v，對比一個 CUPS-Get-Printers 請求
+    """
+    import shutil
+    import subprocess
+    from ipp_client import IPPClient
+    from printer_discovery import PrinterDiscovery
+
+    print(f"\n🧾 CUPS 客戶端 ({count} 張, {printers} 台打印機)")
+    png = encode_label_png(create_label_image('張三 Benchmark', 'ABC 公司', 'USER123'))
+    stub_dir = install_stub_lpr()
+    os.environ['LPSTAT_STUB_PRINTERS'] = str(printers)
+    cupsd = FakeCupsServer(printers=printers)
+    client = IPPClient(cupsd.address)
+
+    def lpr(i):
+        subprocess.run(['lpr', '-P', 'QL0', '-o', 'media=Custom.62x100mm'], input=png, check=True)
+
+    def ipp_new_connection(i):
+        one_shot = IPPClient(cupsd.address)
+        one_shot.print_job('QL0', png, options={'media': 'Custom.62x100mm'})
+        one_shot.close()
+
+    try:
+        legacy = report('lpr 子進程', timed(lpr, count))
+        report('IPP 每張新連接', timed(ipp_new_connection, count))
+        persistent = report('IPP 長連接', timed(
+            lambda i: client.print_job('QL0', png, options={'media': 'Custom.62x100mm'}), count))
+        print(f"   IPP 長連接每張節省 {legacy - persistent:.3f} ms ({(1 - persistent / legacy) * 100:.1f}%)")
+
+        discovery = PrinterDiscovery()
+        queries = max(1, count // 20)
+        lpstat = report('lpstat 查詢打印機', timed(lambda i: discovery._discover_via_lpstat(), queries))
+        ipp = report('CUPS-Get-Printers', timed(lambda i: client.get_printers(), queries))
+        print(f"   查詢 {printers} 台打印機快 {lpstat / ipp:.1f} 倍，假 cupsd 共接受 {cupsd.connections} 個連接")
+    finally:
+        client.close()
+        cupsd.close()
+        shutil.rmtree(stub_dir, ignore_errors=True)
+
+
+def bench_bridge(count=200, kiosks=8):
+    """
+    端到端測試打印橋接服務（Flask test client，不經過 HTTP 服務器）：
+    - /print 單張吞吐量
+    - /print/batch 吞吐量
+    - 多個登記處同時打印（每個線程模擬一台 kiosk，逐張 /print?wait）的延遲 p50/p99
+    分別測試 network（假 9100 打印機）和 cups（假 cupsd）兩種打印方式
+    """
+    import shutil
+
+    printer_ip = '127.0.0.91'
+    sink = SinkPrinter(printer_ip, 9100)
+    cupsd = FakeCupsServer()
+    stub_dir = install_stub_lpr()
+    os.environ.update({
+        'PRINTER_IP': printer_ip,
+        'MDNS_BROWSER': 'false',
+        'PRINT_DEDUP_SECONDS': '0',
+        'PRINTER_CACHE_PATH': os.path.join(stub_dir, 'printers.json'),
+    })
+    import ipp_client
+    import printer_bridge
+
+    ipp_client.CUPS_SERVER = cupsd.address
+    print(f"\n🖨️  打印橋接服務 ({count} 張, {kiosks} 台 kiosk, {printer_bridge.BATCH_PROCESSES} 渲染進程)")
+    client = printer_bridge.app.test_client()
+    failures = 0
+
+    def post_print(i, test_client=client):
+        nonlocal failures
+        response = test_client.post('/print?wait=30', json={
+            'name': f'Attendee {i}', 'company': 'ABC 公司', 'qrcode': f'USER{i:05d}'})
+        if response.status_code != 200:
+            failures += 1
+
+    def kiosk(kiosk_id, per_kiosk):
+        kiosk_client = printer_bridge.app.test_client()
+        samples = []
+        for n in range(per_kiosk):
+            start = time.perf_counter()
+            post_print(kiosk_id * per_kiosk + n, kiosk_client)
+            samples.append((time.perf_counter() - start) * 1000)
+        return samples
+
+    try:
+        for transport in ('network', 'cups'):
+            printer_bridge.PRINT_TRANSPORT = transport
+            print(f"   [{transport}]")
+            post_print(0)  # 預熱（字體、連接）
+
+            start = time.perf_counter()
+            for i in range(count):
+                post_print(i)
+            report_rate(f'{transport} /print', count, time.perf_counter() - start)
+
+            batch = [{'name': f'Attendee {i}', 'company': 'ABC 公司', 'qrcode': f'BATCH{i:05d}'}
+                     for i in range(count)]
+            start = time.perf_counter()
+            response = client.post('/print/batch?wait=600', json=batch)
+            if response.status_code != 200:
+                failures += 1
+            report_rate(f'{transport} /print/batch', count, time.perf_counter() - start)
+
+            per_kiosk = max(1, count // kiosks)
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=kiosks) as executor:
+                samples = [s for result in executor.map(kiosk, range(kiosks), [per_kiosk] * kiosks) for s in result]
+            report_rate(f'{transport} {kiosks} kiosk', len(samples), time.perf_counter() - start)
+            report(f'{transport} {kiosks} kiosk 延遲', samples)
+
+        if failures:
+            print(f"   ⚠️  {failures} 個請求失敗")
+        print(f"   假打印機收到 {sink.bytes_received / 1024 / 1024:.1f} MB，{sink.connections} 個連接")
+    finally:
+        printer_bridge.printer_connections.close()
+        printer_bridge.batch_renderer.shutdown()
+        sink.close()
+        cupsd.close()
+        shutil.rmtree(stub_dir, ignore_errors=True)
+
+
+def bench_priority(count=200, walk_ups=10):
+    """
+    大批量打印進行中，現場報到（/print?wait）的延遲
+    假打印機接收緩慢（約 400 KB/s），批量任務會持續佔用打印機
+    """
+    printer_ip = '127.0.0.92'
+    sink = SinkPrinter(printer_ip, 9100, read_delay=0.01)
+    os.environ.update({'MDNS_BROWSER': 'false', 'PRINT_DEDUP_SECONDS': '0'})
+    import printer_bridge
+
+    printer_bridge.PRINT_TRANSPORT = 'network'
+    printer_bridge.set_printer_ip(printer_ip)
+    batch_size = count * 2
+    print(f"\n🚦 批量打印中的現場報到延遲（批量 {batch_size} 張，{walk_ups} 次現場打印）")
+    client = printer_bridge.app.test_client()
+    try:
+        client.post('/print?wait=30', json={'name': 'Warm up'})
+        batch = [{'name': f'Attendee {i}', 'company': 'ABC 公司', 'qrcode': f'BULK{i:05d}'} for i in range(batch_size)]
+        job_id = client.post('/print/batch', json=batch, headers={'X-Print-Source': 'bulk'}).get_json()['job_id']
+        time.sleep(1.0)
+
+        samples = []
+        for i in range(walk_ups):
+            start = time.perf_counter()
+            client.post('/print?wait=60', json={'name': f'Walk-up {i}', 'qrcode': f'WALK{i:03d}'})
+            samples.append((time.perf_counter() - start) * 1000)
+            time.sleep(0.2)
+        remaining = batch_size - len(client.get(f'/jobs/{job_id}').get_json()['results'])
+        report('現場報到延遲', samples)
+        print(f"   現場打印完成時批量任務尚餘 {remaining} 張")
+
+        start = time.perf_counter()
+        client.get(f'/jobs/{job_id}?wait=600')
+        print(f"   批量任務剩餘部分耗時 {time.perf_counter() - start:.3f} s")
+    finally:
+        printer_bridge.printer_connections.close()
+        printer_bridge.batch_renderer.shutdown()
+        sink.close()
+
+
+class FakePrinterListeners:
+    """
+    在 127.x.x.x 上開啟若干 TCP 監聽，模擬網路上的打印機
+    silent_ips 模擬不回應的主機: 監聽隊列被佔滿後新的連接會一直等待到超時，
+    與真實網路上不存在的主機行為一致
+    """
+
+    def __init__(self, ips, port=9100, silent_ips=(), silent_ports=(9100, 515, 631)):
+        self.sockets = []
+        for ip in ips:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind((ip, port))
+            sock.listen(128)
+            self.sockets.append(sock)
+
+        for ip in silent_ips:
+            for silent_port in silent_ports:
+                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                sock.bind((ip, silent_port))
+                sock.listen(0)
+                self.sockets.append(sock)
+                # 佔滿監聽隊列
+                for _ in range(2):
+                    filler = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                    filler.setblocking(False)
+                    filler.connect_ex((ip, silent_port))
+                    self.sockets.append(filler)
+
+    def close(self):
+        for sock in self.sockets:
+            sock.close()
+
+
+def legacy_thread_scan(discovery, hosts, ports, timeout):
+    """舊實現: 每個 IP 一個線程，每 50 個一波，端口逐個探測"""
+    results = []
+    threads = []
+
+    def scan_ip(ip_str):
+        for port in ports:
+            if discovery.check_printer_port(ip_str, port, timeout):
+                results.append({'ip': ip_str, 'port': port})
+                break
+
+    for ip in hosts:
+        if len(threads) >= 50:
+            for t in threads:
+                t.join()
+            threads = []
+        t = threading.Thread(target=scan_ip, args=(ip,))
+        t.start()
+        threads.append(t)
+    for t in threads:
+        t.join()
+    return results
+
+
+def bench_network_scan(count=200, prefix=22):
+    """
+    比較網路掃描: 線程波次 vs asyncio（本地假打印機監聽）
+    """
+    from printer_discovery import PrinterDiscovery, PRINTER_PORTS
+
+    network = ipaddress.IPv4Network(f'127.20.0.0/{prefix}')
+    hosts = [str(ip) for ip in network.hosts()]
+    printer_ips = hosts[::max(1, len(hosts) // 8)][:8]
+    silent_ips = [ip for ip in hosts[1::max(1, len(hosts) // 64)] if ip not in printer_ips][:64]
+    print(f"\n🌐 網路掃描 ({network}, {len(hosts)} 個主機, {len(printer_ips)} 台假打印機, "
+          f"{len(silent_ips)} 個不回應主機)")
+
+    listeners = FakePrinterListeners(printer_ips, silent_ips=silent_ips)
+    time.sleep(0.1)
+    discovery = PrinterDiscovery()
+    try:
+        start = time.perf_counter()
+        legacy = legacy_thread_scan(discovery, hosts, PRINTER_PORTS, 0.5)
+        legacy_s = time.perf_counter() - start
+
+        async def collect():
+            return [p async for p in discovery.scan_hosts_async(hosts, timeout_per_ip=0.5)]
+
+        start = time.perf_counter()
+        found = asyncio.run(collect())
+        async_s = time.perf_counter() - start
+    finally:
+        listeners.close()
+
+    print(f"   線程波次  {legacy_s:7.3f} s  發現 {len(legacy)}")
+    print(f"   asyncio   {async_s:7.3f} s  發現 {len(found)}")
+
+
+def bench_scan_sizes(count=200, prefixes=(24, 22, 20)):
+    """
+    不同網段大小的 asyncio 掃描耗時（每個網段 8 台假打印機、16 個不回應主機）
+    """
+    from printer_discovery import PrinterDiscovery
+
+    print("\n📶 網段掃描耗時")
+    discovery = PrinterDiscovery()
+    for index, prefix in enumerate(prefixes):
+        network = ipaddress.IPv4Network(f'127.{30 + index}.0.0/{prefix}')
+        hosts = [str(ip) for ip in network.hosts()]
+        printer_ips = hosts[::max(1, len(hosts) // 8)][:8]
+        silent_ips = [ip for ip in hosts[1::max(1, len(hosts) // 16)] if ip not in printer_ips][:16]
+        listeners = FakePrinterListeners(printer_ips, silent_ips=silent_ips)
+        time.sleep(0.1)
+        try:
+            async def collect():
+                return [p async for p in discovery.scan_hosts_async(hosts, timeout_per_ip=0.5)]
+
+            start = time.perf_counter()
+            found = asyncio.run(collect())
+            elapsed = time.perf_counter() - start
+        finally:
+            listeners.close()
+        print(f"   /{prefix:<3} {len(hosts):6d} 個主機  {elapsed:7.3f} s  發現 {len(found)}/{len(printer_ips)}")
+        record(f'/{prefix}', hosts=len(hosts), seconds=round(elapsed, 3), found=len(found))
+
+
+def bench_scan_plan(count=200, prefix=22):
+    """
+    找到 Brother 打印機的耗時: 按地址順序逐個網段掃描（舊實現）vs 掃描計劃
+    兩個網段模擬兩個網路介面，Brother 打印機在第二個網段，另有非 Brother 打印機和不回應主機；
+    Brother MAC 以模擬的 ARP 表提供（掃描計劃在探測後讀取鄰居表確認）
+    """
+    from printer_discovery import PrinterDiscovery
+    from scan_planner import ScanPlan
+
+    ranges = [f'127.40.0.0/{prefix}', f'127.41.0.0/{prefix}']
+    networks = [ipaddress.IPv4Network(r) for r in ranges]
+    hosts = [str(ip) for network in networks for ip in network.hosts()]
+    brother_ip = str(networks[1].network_address + 40)
+    other_ips = [str(networks[0].network_address + 7), str(networks[1].network_address + 300)]
+    silent_ips = [ip for ip in hosts[3::max(1, len(hosts) // 32)] if ip not in other_ips + [brother_ip]][:32]
+    brother_mac = {brother_ip: '00:80:77:12:34:56'}
+    print(f"\n🧭 掃描計劃 ({' + '.join(ranges)}, {len(hosts)} 個主機, Brother 打印機 {brother_ip})")
+
+    listeners = FakePrinterListeners(other_ips + [brother_ip], silent_ips=silent_ips)
+    time.sleep(0.1)
+    discovery = PrinterDiscovery()
+
+    async def first_brother(scan, is_brother):
+        start = time.perf_counter()
+        first = None
+        found = 0
+        async for printer in scan:
+            found += 1
+            if first is None and is_brother(printer):
+                first = time.perf_counter() - start
+        return first, time.perf_counter() - start, found
+
+    def run(title, make_scan, is_brother=lambda p: p.get('confirmed')):
+        first, total, found = asyncio.run(first_brother(make_scan(), is_brother))
+        first_text = f'{first:7.3f} s' if first is not None else '   未找到'
+        print(f"   {title:<24} 找到 Brother {first_text}  掃描結束 {total:7.3f} s  發現 {found}")
+        record(title, first_brother_s=round(first, 3) if first is not None else None,
+               total_s=round(total, 3), found=found)
+
+    def planned(neighbours, learned=None, stop_early=True):
+        def make_scan():
+            plan = ScanPlan(ranges, neighbours=neighbours)
+            if learned:
+                plan.neighbours.update(learned)  # 探測後系統鄰居表中出現的 MAC
+            return discovery.scan_plan_async(plan, timeout_per_ip=0.5, stop_early=stop_early)
+        return make_scan
+
+    try:
+        run('逐個網段掃描', lambda: discovery.scan_hosts_async(hosts, timeout_per_ip=0.5),
+            is_brother=lambda p: p['ip'] == brother_ip)
+        run('掃描計劃（不提前停止）', planned({}, brother_mac, stop_early=False))
+        run('掃描計劃（子網掃描）', planned({}, brother_mac))
+        run('掃描計劃（ARP 表命中）', planned(brother_mac))
+    finally:
+        listeners.close()
+
+
+def bench_discovery(count=200):
+    """
+    發現打印機的耗時: 各方法依次運行（舊實現）vs 同時運行 vs 找到第一台 Brother 打印機即返回
+    以固定延遲模擬各方法: mDNS 0.2 秒收到 Brother 打印機的廣播但等待 1 秒，CUPS 0.15 秒，網路掃描 0.8 秒
+    """
+    from printer_discovery import PrinterDiscovery
+    brother = {'ip': '127.50.0.40', 'name': 'Brother QL-820NWB', 'model': 'QL-820NWB'}
+    print("\n🛰️  發現方法並發 (mDNS 1 s / CUPS 0.15 s / 網路掃描 0.8 s)")
+
+    class SimulatedDiscovery(PrinterDiscovery):
+        def discover_via_mdns(self, timeout=5, on_printer=None, cancel=None):
+            cancel = cancel or threading.Event()
+            if cancel.wait(0.2):
+                return []
+            if on_printer:
+                on_printer(brother)
+            cancel.wait(0.8)
+            return [brother]
+
+        def discover_via_cups(self):
+            time.sleep(0.15)
+            return [{'ip': '127.50.0.9', 'name': 'Office Laser'}]
+
+        def discover_via_network_scan(self, timeout_per_ip=0.5, stop_early=False, on_printer=None,
+                                      cancel=None, **kwargs):
+            (cancel or threading.Event()).wait(0.8)
+            return [] if cancel and cancel.is_set() else [dict(brother, name='Printer at 127.50.0.40')]
+
+    discovery = SimulatedDiscovery()
+
+    def sequential():
+        printers = []
+        for method in (discovery.discover_via_mdns, discovery.discover_via_cups,
+                       discovery.discover_via_network_scan):
+            printers += method()
+        return printers
+
+    def run(title, discover):
+        start = time.perf_counter()
+        first = None
+
+        def on_printer(printer):
+            nonlocal first
+            if first is None and PrinterDiscovery.is_brother_ql(printer):
+                first = time.perf_counter() - start
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            printers = discover(on_printer)
+        total = time.perf_counter() - start
+        if first is None and any(map(PrinterDiscovery.is_brother_ql, printers)):
+            first = total  # 舊實現在全部方法完成後才有結果
+        found = len({printer['ip'] for printer in printers})
+        print(f"   {title:<20} 找到 Brother {first:6.3f} s  返回 {total:6.3f} s  發現 {found}")
+        record(title, first_brother_s=round(first, 3), total_s=round(total, 3), found=found)
+
+    run('依次運行', lambda on_printer: sequential())
+    run('同時運行', lambda on_printer: discovery.discover_all(on_printer=on_printer))
+    run('同時運行（首個匹配）', lambda on_printer: discovery.discover_all(on_printer=on_printer, first_match=True))
+
+
+BENCHMARKS = {
+    'label_io': bench_label_io,
+    'render_cache': bench_render_cache,
+    'qr_render': bench_qr_render,
+    'color_modes': bench_color_modes,
+    'batch_render': bench_batch_render,
+    'connection_reuse': bench_connection_reuse,
+    'network_scan': bench_network_scan,
+    'scan_sizes': bench_scan_sizes,
+    'scan_plan': bench_scan_plan,
+    'discovery': bench_discovery,
+    'label_memory': bench_label_memory,
+    'bridge': bench_bridge,
+    'priority': bench_priority,
+    'cups_client': bench_cups_client,
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='打印橋接性能測試')
+    parser.add_argument('--count', type=int, default=200, help='每項測試的重複次數')
+    parser.add_argument('--only', choices=sorted(BENCHMARKS.keys()), help='只運行指定測試')
+    parser.add_argument('--kiosks', type=int, default=8, help='bridge 測試中同時打印的 kiosk 數量')
+    parser.add_argument('--json', help='將結果保存為 JSON 文件')
+    args = parser.parse_args()
+
+    print("⏱️  打印橋接性能測試")
+    for bench_name, bench in BENCHMARKS.items():
+        if args.only and args.only != bench_name:
+            continue
+        _current_bench = bench_name
+        if bench_name == 'bridge':
+            bench(count=args.count, kiosks=args.kiosks)
+        else:
+            bench(count=args.count)
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({
+                'count': args.count,
+                'cpu_count': os.cpu_count(),
+                'python': sys.version.split()[0],
+                'results': RESULTS,
+            }, f, ensure_ascii=False, indent=2)
+        print(f"\n💾 結果已保存到 {args.json}")
@@ -3,16 +3,33 @@ Brother QL-820NWB Printer Bridge
 使用 Flask 建立打印橋接服務，控制 Brother QL-820NWB 標籤打印機
 """
 
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, stream_with_context
 from flask_cors import CORS
-import socket
-import struct
+from PIL import Image
+import io
+import json
+import math
 import subprocess
 import os
-from PIL import Image, ImageDraw, ImageFont
-import qrcode
-import io
-from printer_discovery import PrinterDiscovery, discover_printer_ip
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from printer_discovery import PrinterDiscovery, dependency_warnings, get_mdns_browser, SCAN_STOP_EARLY
+from printer_cache import get_printer_cache
+from label_renderer import encode_label_png, cache_stats, COLOR_MODES, DEFAULT_COLOR_MODE, LABEL_WIDTH_MM, LABEL_HEIGHT_MM
+from badge_layout import embed_remote_images, render_item_image, get_render_plan, layout_id
+from brother_ql_raster import encode_label, page_to_job, DEFAULT_MEDIA
+from batch_renderer import BatchRenderer
+from label_cache import PrerenderCache, PrerenderRun, prerender
+from printer_pool import PrinterPool
+from printer_connection import ConnectionManager
+from ipp_client import CUPS_CLIENT, IPPError, get_ipp_client
+from printer_status import PrinterStatusMonitor, ERROR_HOLD_SECONDS, STATUS_INTERVAL
+import print_metrics
+from print_metrics import observe_stages, record_result, timed_stage
+from print_jobs import PrintJobQueue, JobDeduplicator, PRIORITIES, PRIORITY_INTERACTIVE, PRIORITY_RANKS, JOB_STATES, JOB_RENDERING, JOB_SENDING, JOB_SENT, JOB_FAILED
 
 app = Flask(__name__)
 CORS(app)  # 允許跨域請求
@@ -20,13 +37,74 @@ CORS(app)  # 允許跨域請求
 # 打印機配置 - 嘗試自動發現
 _PRINTER_IP = None
 PRINTER_PORT = 9100  # Brother 打印機的標準端口
+DEFAULT_PRINTER_IP = '192.168.1.100'
+
+# 持續運行 mDNS 瀏覽器，即時追蹤打印機上線、IP 變更和離線
+MDNS_BROWSER_ENABLED = os.getenv('MDNS_BROWSER', 'true').lower() == 'true'
+
+# 自動發現在後台線程進行，打印請求最多等待的秒數
+PRINTER_WAIT_SECONDS = float(os.getenv('PRINTER_WAIT_SECONDS', 3))
+
+# 後台發現狀態（/health 返回）
+discovery_state = {
+    'status': 'idle',  # idle / running / done / failed
+    'source': None,    # cache / revalidated / discovery
+    'completed_methods': [],
+    'found': 0,
+    'started_at': None,
+    'finished_at': None,
+    'error': None,
+}
+_discovery_lock = threading.Lock()
+_printer_ready = threading.Event()
+
+# 打印方式: auto（先 CUPS 後網路）、cups、network（直接發送光柵命令）
+PRINT_TRANSPORT = os.getenv('PRINT_TRANSPORT', 'auto').lower()
+# 標籤介質: 62（連續標籤）或 62x100（預切標籤），見 brother_ql_raster.MEDIA_PROFILES
+PRINTER_MEDIA = os.getenv('PRINTER_MEDIA', DEFAULT_MEDIA)
+
+
+# 9100 端口長連接（每台打印機一個，閒置 PRINTER_KEEPALIVE_IDLE 秒後關閉）
+printer_connections = ConnectionManager()
+
+# 只有一台打印機時，批量任務在同一連接上以多頁任務串流發送
+STREAM_BATCHES = os.getenv('PRINT_STREAM_BATCH', 'true').lower() == 'true'
+
+# NDJSON 批量輸入: 等待新項目超過此秒數時先發送已渲染的標籤；沒有新結果時每隔此秒數返回一次進度
+STREAM_FLUSH_SECONDS = 0.05
+STREAM_PROGRESS_SECONDS = float(os.getenv('PRINT_STREAM_PROGRESS', 5))
+NDJSON_MIMETYPES = ('application/x-ndjson', 'application/ndjson', 'application/jsonl')
+# 流式響應（NDJSON 或 SSE）的 Accept 類型
+STREAM_MIMETYPES = ('application/x-ndjson', 'text/event-stream')
+# 在調用應用之前讀取整個請求體的 WSGI 服務器（SERVER_SOFTWARE 前綴）: NDJSON 輸入在上傳結束後才開始處理
+BUFFERING_SERVERS = ('waitress',)
 
-def get_printer_ip():
+
+def send_to_printer_via_network(raster_data, printer_ip, printer_port=9100):
+    """
+    透過網路發送打印數據到 Brother 打印機
+    raster_data 為 brother_ql_raster 編碼的光柵命令，打印機可直接解析
+    連接在多次打印之間保持，斷開時自動重連
     """
-    獲取打印機 IP，優先使用環境變量，否則自動發現
+    with timed_stage('transmit'):
+        return printer_connections.send(raster_data, printer_ip, printer_port)
+
+
+def set_printer_ip(ip, name=None, method=None):
+    """
+    設置當前打印機 IP，並加入打印機池
     """
     global _PRINTER_IP
-    
+    _PRINTER_IP = ip
+    printer_pool.add(ip, PRINTER_PORT, name, method)
+    _printer_ready.set()
+
+
+def get_printer_ip(wait=None):
+    """
+    獲取打印機 IP，優先使用環境變量，否則使用後台自動發現的結果
+    發現尚未完成時最多等待 wait 秒（默認 PRINTER_WAIT_SECONDS），超時則使用默認 IP
+    """
     # 如果已經發現過，直接返回
     if _PRINTER_IP:
         return _PRINTER_IP
@@ -34,133 +112,202 @@ def get_printer_ip():
     # 優先使用環境變量
     env_ip = os.getenv('PRINTER_IP')
     if env_ip:
-        _PRINTER_IP = env_ip
+        set_printer_ip(env_ip, name='PRINTER_IP', method='env')
         return _PRINTER_IP
     
-    # 自動發現
-    print("🔍 自動發現打印機 IP...")
-    discovered_ip = discover_printer_ip()
-    if discovered_ip:
-        _PRINTER_IP = discovered_ip
-        print(f"✅ 發現打印機: {_PRINTER_IP}")
+    # 自動發現在後台進行，短暫等待結果
+    start_background_discovery()
+    wait = PRINTER_WAIT_SECONDS if wait is None else wait
+    if wait > 0 and _printer_ready.wait(wait):
         return _PRINTER_IP
     
-    # 如果都失敗，使用默認值
-    _PRINTER_IP = '192.168.1.100'
-    print(f"⚠️  使用默認 IP: {_PRINTER_IP}")
-    return _PRINTER_IP
-
-# 初始化時獲取 IP
-PRINTER_IP = get_printer_ip()
+    # 發現尚未完成或失敗，使用默認值（不記錄，發現完成後會被替換）
+    return DEFAULT_PRINTER_IP
 
-# 標籤尺寸配置（62mm x 100mm）
-LABEL_WIDTH_MM = 62
-LABEL_HEIGHT_MM = 100
-DPI = 300  # 打印解析度
-LABEL_WIDTH_PX = int(LABEL_WIDTH_MM * DPI / 25.4)
-LABEL_HEIGHT_PX = int(LABEL_HEIGHT_MM * DPI / 25.4)
 
-
-def create_label_image(name, company, qr_data):
+def run_background_discovery():
     """
-    創建標籤圖像（62mm x 100mm）
+    後台發現打印機（在獨立線程中執行）
     """
-    # 創建白色背景
-    img = Image.new('RGB', (LABEL_WIDTH_PX, LABEL_HEIGHT_PX), 'white')
-    draw = ImageDraw.Draw(img)
-    
-    # 生成 QR Code
-    qr = qrcode.QRCode(
-        version=1,
-        error_correction=qrcode.constants.ERROR_CORRECT_L,
-        box_size=10,
-        border=4,
-    )
-    qr.add_data(qr_data)
-    qr.make(fit=True)
-    qr_img = qr.make_image(fill_color="black", back_color="white")
-    
-    # 調整 QR Code 大小（38mm）
-    qr_size_mm = 38
-    qr_size_px = int(qr_size_mm * DPI / 25.4)
-    qr_img = qr_img.resize((qr_size_px, qr_size_px), Image.Resampling.LANCZOS)
-    
-    # 計算位置
-    qr_x = (LABEL_WIDTH_PX - qr_size_px) // 2
-    qr_y = 20  # 距離頂部 20px
+    def on_progress(method, printers):
+        with _discovery_lock:
+            discovery_state['completed_methods'].append(method)
+            discovery_state['found'] += len(printers)
     
-    # 貼上 QR Code
-    img.paste(qr_img, (qr_x, qr_y))
-    
-    # 添加姓名（22px 字體）
-    try:
-        font_large = ImageFont.truetype("/System/Library/Fonts/Helvetica.ttc", 22)
-    except:
-        font_large = ImageFont.load_default()
+    def on_printer(printer):
+        # 先找到的 Brother 打印機立即可用，無需等待任何發現方法完成
+        if not PrinterDiscovery.is_brother_ql(printer):
+            return
+        printer_pool.update([printer], PRINTER_PORT)
+        if not _PRINTER_IP:
+            set_printer_ip(printer['ip'], printer.get('name'), printer.get('method'))
+            print(f"✅ 發現打印機: {_PRINTER_IP}")
     
-    # 添加公司名稱（16px 字體）
+    print("🔍 後台自動發現打印機 IP...")
     try:
-        font_small = ImageFont.truetype("/System/Library/Fonts/Helvetica.ttc", 16)
-    except:
-        font_small = ImageFont.load_default()
-    
-    # 計算文字位置（在 QR Code 下方）
-    text_y = qr_y + qr_size_px + 20
-    
-    # 繪製姓名（置中）
-    name_bbox = draw.textbbox((0, 0), name, font=font_large)
-    name_width = name_bbox[2] - name_bbox[0]
-    name_x = (LABEL_WIDTH_PX - name_width) // 2
-    draw.text((name_x, text_y), name, fill='black', font=font_large)
+        # 優先使用上次保存的打印機（重新驗證後），避免重啟時重新掃描
+        discovery = PrinterDiscovery()
+        printers = discovery.discover_cached(on_progress=on_progress, on_printer=on_printer,
+                                             scan_stop_early=SCAN_STOP_EARLY)
+        with _discovery_lock:
+            discovery_state['source'] = discovery.last_source
+        printer_pool.update([p for p in printers if PrinterDiscovery.is_brother_ql(p)], PRINTER_PORT)
+        printer = PrinterDiscovery.select_brother_ql820nwb(printers)
+        if printer and not _PRINTER_IP:
+            set_printer_ip(printer['ip'], printer.get('name'), printer.get('method'))
+            print(f"✅ 發現打印機: {_PRINTER_IP}")
+        elif not printer:
+            print(f"⚠️  未發現打印機，使用默認 IP: {DEFAULT_PRINTER_IP}")
+        status, error = 'done', None
+    except Exception as e:
+        print(f"❌ 後台發現打印機錯誤: {e}")
+        status, error = 'failed', str(e)
     
-    # 繪製公司名稱（置中）
-    company_bbox = draw.textbbox((0, 0), company, font=font_small)
-    company_width = company_bbox[2] - company_bbox[0]
-    company_x = (LABEL_WIDTH_PX - company_width) // 2
-    draw.text((company_x, text_y + 30), company, fill='#666', font=font_small)
+    with _discovery_lock:
+        discovery_state['status'] = status
+        discovery_state['error'] = error
+        discovery_state['finished_at'] = time.time()
+
+
+def on_mdns_change(event, printer):
+    """
+    持續 mDNS 瀏覽器的事件處理: 打印機上線/IP 變更時加入打印機池，離線時標記為不健康
+    """
+    if event == 'removed':
+        printer_pool.mark_down(printer['ip'], 'mDNS 報告離線')
+        return
     
-    return img
+    printer_pool.add(printer['ip'], PRINTER_PORT, printer.get('name'), printer.get('method'))
+    get_printer_cache().record([printer])
+    if not _PRINTER_IP:
+        set_printer_ip(printer['ip'], printer.get('name'), printer.get('method'))
+
 
+def start_mdns_browser():
+    """啟動持續運行的 mDNS 瀏覽器（只啟動一次）"""
+    if not MDNS_BROWSER_ENABLED:
+        return None
+    browser = get_mdns_browser(start=False)
+    if browser and browser.running:
+        return browser
+    return get_mdns_browser(start=True, on_change=on_mdns_change)
 
-def send_to_printer_via_network(image_data, printer_ip, printer_port=9100):
+
+def start_background_discovery():
     """
-    透過網路發送打印數據到 Brother 打印機
-    使用 ESC/P 命令或 P-touch Editor 格式
+    啟動後台發現（只啟動一次），返回是否新啟動
     """
-    try:
-        # 轉換圖像為打印機可接受的格式
-        # Brother QL 系列使用特殊的打印格式
-        # 這裡需要根據 Brother SDK 進行轉換
-        
-        # 方法 1: 使用 socket 直接連接
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.settimeout(10)
-        sock.connect((printer_ip, printer_port))
-        
-        # 發送打印命令（需要根據 Brother 協議格式）
-        # 這裡是簡化版本，實際需要 Brother SDK
-        sock.send(image_data)
-        sock.close()
-        
-        return True
-    except Exception as e:
-        print(f"網路打印錯誤: {e}")
+    start_mdns_browser()
+    status_monitor.start()
+    if _PRINTER_IP or os.getenv('PRINTER_IP'):
         return False
+    with _discovery_lock:
+        if discovery_state['status'] != 'idle':
+            return False
+        discovery_state['status'] = 'running'
+        discovery_state['started_at'] = time.time()
+    threading.Thread(target=run_background_discovery, name='printer-discovery', daemon=True).start()
+    return True
+
+
+def get_discovery_state():
+    with _discovery_lock:
+        state = dict(discovery_state)
+        state['completed_methods'] = list(discovery_state['completed_methods'])
+    if state['started_at']:
+        end = state['finished_at'] or time.time()
+        state['elapsed_s'] = round(end - state['started_at'], 3)
+    return state
+
+
+# 網路打印機池: 任務發送到負載最低的健康打印機，失敗時轉到其他打印機
+printer_pool = PrinterPool(send_to_printer_via_network)
+
+def status_targets():
+    """狀態監控的打印機（打印機池中的所有打印機）"""
+    return [(printer.ip, printer.port) for printer in printer_pool.printers()]
+
+
+def pool_ips():
+    return [ip for ip, _ in status_targets()]
+
+
+def printer_active(ip):
+    """打印機正在接收任務（發送隊列中有任務或 9100 連接正被使用），狀態監控跳過查詢"""
+    if any(printer.ip == ip and printer.pending for printer in printer_pool.printers()):
+        return True
+    return any(connection.ip == ip and connection.in_use for connection in printer_connections.connections())
+
 
+def on_printer_status(ip, status):
+    """狀態監控結果: 有錯誤的打印機不再分配任務，恢復後重新加入"""
+    error = status['reason'] if status_monitor.is_blocking(status) else None
+    printer_pool.set_status(ip, error, status['busy'])
 
-def send_to_printer_via_cups(image_path, printer_name='QL-820NWB'):
+
+# 打印機狀態監控（PRINTER_STATUS_METHOD=auto|raster|snmp|off，每 PRINTER_STATUS_INTERVAL 秒查詢一次）
+status_monitor = PrinterStatusMonitor(status_targets, printer_connections, on_update=on_printer_status,
+                                      active=printer_active)
+
+
+def wait_for_printer():
+    """
+    背壓: 所有打印機都報告錯誤（缺紙、蓋子打開等）時，工作線程暫停發送，
+    任務留在隊列中，最多等待 PRINTER_ERROR_HOLD 秒讓操作人員處理
+    返回是否有可用的打印機；超時後不應發送（見 send_error）
+    """
+    start = time.perf_counter()
+    ready = status_monitor.wait_ready(pool_ips, ERROR_HOLD_SECONDS)
+    waited = time.perf_counter() - start
+    if waited > 0.001:
+        print_metrics.observe_stage('printer_hold', waited)
+    return ready
+
+
+def send_error():
+    """發送失敗的說明: 所有打印機都報告錯誤時返回原因"""
+    reason = status_monitor.blocked_reason(pool_ips())
+    return f'打印機暫停: {reason}' if reason else '打印失敗，請檢查打印機連接'
+
+
+def printer_backpressure():
+    """所有打印機都報告錯誤時拒絕新任務（503 + Retry-After），否則返回 None"""
+    reason = status_monitor.blocked_reason(pool_ips())
+    if not reason:
+        return None
+    response = jsonify({'status': 'error', 'error': f'打印機暫停: {reason}', 'printer_status': status_monitor.stats()})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(max(1, math.ceil(STATUS_INTERVAL)))
+    return response
+
+
+# CUPS 打印時的介質選項（lpr -o media=...）
+CUPS_MEDIA = 'Custom.62x100mm'
+
+
+def send_to_printer_via_cups(image_data, printer_name='QL-820NWB'):
     """
     透過 CUPS (Unix 打印系統) 發送打印任務
     適用於 Mac/Linux
+    image_data 為 PNG bytes，以 IPP Print-Job 經由與 cupsd 的長連接直接發送（CUPS_CLIENT=lpr 時經由 stdin 傳給 lpr）
     """
+    if CUPS_CLIENT != 'lpr':
+        try:
+            with timed_stage('spool'):
+                get_ipp_client().print_job(printer_name, image_data, 'image/png', options={'media': CUPS_MEDIA})
+            return True
+        except (IPPError, OSError) as e:
+            print(f"CUPS 打印錯誤: {e}")
+            return False
+    
     try:
-        # 使用 lpr 命令打印
-        subprocess.run([
-            'lpr',
-            '-P', printer_name,
-            '-o', 'media=Custom.62x100mm',
-            image_path
-        ], check=True)
+        # 使用 lpr 命令打印（不指定文件時 lpr 從 stdin 讀取）
+        with timed_stage('spool'):
+            subprocess.run([
+                'lpr',
+                '-P', printer_name,
+                '-o', f'media={CUPS_MEDIA}'
+            ], input=image_data, check=True)
         return True
     except subprocess.CalledProcessError as e:
         print(f"CUPS 打印錯誤: {e}")
@@ -170,29 +317,84 @@ def send_to_printer_via_cups(image_path, printer_name='QL-820NWB'):
         return False
 
 
+@app.before_request
+def ensure_discovery_started():
+    """由其他服務器（例如 flask run）啟動時，在第一個請求時啟動後台發現"""
+    start_background_discovery()
+
+
 @app.route('/health', methods=['GET'])
 def health_check():
-    """健康檢查端點"""
-    current_ip = get_printer_ip()
+    """健康檢查端點（不等待打印機發現）"""
+    current_ip = get_printer_ip(wait=0)
+    browser = get_mdns_browser(start=False)
     return jsonify({
         'status': 'ok',
         'service': 'Printer Bridge',
-        'printer_ip': current_ip
+        'printer_ip': current_ip,
+        'printer_ready': _printer_ready.is_set(),
+        'discovery': get_discovery_state(),
+        'discovery_cache': get_printer_cache().stats(),
+        'mdns_browser': browser.stats() if browser else None,
+        'queue': job_queue.stats(),
+        'dedup': {'idempotency_keys': idempotent_jobs.stats(), 'recent_prints': recent_prints.stats()},
+        'render_cache': cache_stats(workers=batch_renderer.cache_stats()),
+        'batch_renderer': batch_renderer.stats(),
+        'prerender_cache': prerender_cache.stats(),
+        'printer_pool': printer_pool.stats(),
+        'printer_status': status_monitor.stats(),
+        'cups': get_ipp_client().stats() if CUPS_CLIENT != 'lpr' else {'client': 'lpr'},
+        'connections': printer_connections.stats()
     })
 
 
+# /metrics 中按抓取時計算的指標
+QUEUE_JOBS = print_metrics.REGISTRY.gauge('print_jobs', 'Print jobs currently held by the queue, by status', labels=('status',))
+QUEUE_PENDING = print_metrics.REGISTRY.gauge('print_queue_pending', 'Jobs waiting for a worker thread')
+POOL_PRINTERS = print_metrics.REGISTRY.gauge('printer_pool_printers', 'Printers in the pool, by health', labels=('state',))
+OPEN_CONNECTIONS = print_metrics.REGISTRY.gauge('printer_connections_open', 'Open persistent 9100 connections')
+PRINTER_READY = print_metrics.REGISTRY.gauge('printer_ready', 'Whether the printer reported no errors at the last status poll', labels=('ip',))
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """
+    Prometheus 文本格式的指標
+    包括各階段耗時直方圖、按打印方式的成功/失敗數、各發現方法的耗時，以及隊列和打印機池狀態
+    """
+    queue_stats = job_queue.stats()
+    for status, count in queue_stats['jobs'].items():
+        QUEUE_JOBS.set(count, status=status)
+    QUEUE_PENDING.set(queue_stats['pending'])
+    pool_stats = printer_pool.stats()
+    POOL_PRINTERS.set(pool_stats['healthy'], state='healthy')
+    POOL_PRINTERS.set(pool_stats['count'] - pool_stats['healthy'], state='unhealthy')
+    OPEN_CONNECTIONS.set(printer_connections.stats()['open'])
+    for status in status_monitor.stats()['printers']:
+        PRINTER_READY.set(1 if status['ready'] else 0, ip=status['ip'])
+    return Response(print_metrics.render_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
 @app.route('/discover', methods=['GET'])
 def discover_printers():
     """
     發現打印機 API
-    返回所有發現的打印機列表
+    返回所有發現的打印機列表（優先使用緩存，?refresh=1 強制重新發現）
+    Accept 為 application/x-ndjson 或 text/event-stream 時改為流式返回（見 discover_stream）
     """
+    if request.accept_mimetypes.best in STREAM_MIMETYPES:
+        return discover_stream()
+    
     try:
         discovery = PrinterDiscovery()
-        printers = discovery.discover_all()
+        printers = discovery.discover_cached(force_refresh=request.args.get('refresh') == '1')
+        
+        # Brother QL 打印機加入打印機池
+        printer_pool.update([p for p in printers if PrinterDiscovery.is_brother_ql(p)], PRINTER_PORT)
         
         return jsonify({
             'status': 'success',
+            'source': discovery.last_source,
             'count': len(printers),
             'printers': printers
         })
@@ -203,22 +405,73 @@ def discover_printers():
         }), 500
 
 
+def discover_stream():
+    """
+    流式發現打印機: 各發現方法同時運行，每發現一台打印機立即返回一個 printer 事件
+    （同一 IP 之後由更可靠的方法發現時會再次返回），最後返回 done 事件
+    """
+    sse = request.accept_mimetypes.best == 'text/event-stream'
+    force_refresh = request.args.get('refresh') == '1'
+    discovery = PrinterDiscovery()
+    events = queue.Queue()
+    
+    def run():
+        try:
+            printers = discovery.discover_cached(force_refresh=force_refresh,
+                                                 on_printer=lambda printer: events.put(('printer', printer)))
+        except Exception as e:
+            events.put(('error', str(e)))
+        else:
+            events.put(('done', printers))
+    
+    def generate():
+        threading.Thread(target=run, name='discover-stream', daemon=True).start()
+        sent = set()
+        while True:
+            kind, data = events.get()
+            if kind == 'printer':
+                sent.add(data['ip'])
+                yield format_event('printer', {'printer': data}, sse)
+            elif kind == 'error':
+                yield format_event('error', {'message': data}, sse)
+                return
+            else:
+                break
+        
+        # 緩存命中時沒有逐個通知
+        for printer in data:
+            if printer.get('ip') not in sent:
+                yield format_event('printer', {'printer': printer}, sse)
+        printer_pool.update([p for p in data if PrinterDiscovery.is_brother_ql(p)], PRINTER_PORT)
+        yield format_event('done', {
+            'source': discovery.last_source,
+            'count': len(data),
+            'printers': data
+        }, sse)
+    
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream' if sse else 'application/x-ndjson',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+
 @app.route('/discover/brother', methods=['GET'])
 def discover_brother():
     """
-    專門發現 Brother QL-820NWB 打印機
+    專門發現 Brother QL-820NWB 打印機（優先使用緩存，?refresh=1 強制重新發現）
     """
     try:
         discovery = PrinterDiscovery()
-        printer = discovery.find_brother_ql820nwb()
+        printer = discovery.find_brother_ql820nwb(use_cache=True, force_refresh=request.args.get('refresh') == '1')
         
         if printer:
             # 更新全局 IP
-            global _PRINTER_IP
-            _PRINTER_IP = printer.get('ip')
+            set_printer_ip(printer.get('ip'), printer.get('name'), printer.get('method'))
             
             return jsonify({
                 'status': 'success',
+                'source': discovery.last_source,
                 'printer': printer
             })
         else:
@@ -233,16 +486,510 @@ def discover_brother():
         }), 500
 
 
+def transport_formats():
+    """根據打印方式返回需要預先編碼的數據格式"""
+    return {
+        'cups': ('png',),
+        'network': ('raster',),
+    }.get(PRINT_TRANSPORT, ('png', 'raster'))
+
+
+def single_formats():
+    """
+    單張打印時子進程需要編碼的格式
+    auto 模式只編碼 PNG，CUPS 失敗時再在主進程中編碼光柵命令
+    """
+    return ('raster',) if PRINT_TRANSPORT == 'network' else ('png',)
+
+
+def send_payload(payload, label_img=None, priority=PRIORITY_INTERACTIVE):
+    """
+    發送已編碼的打印數據，返回 (是否成功, 打印目標)
+    payload 中缺少的格式會在需要時從 label_img 即時編碼
+    priority 決定在打印機發送隊列中的順序
+    """
+    success = False
+    target = None
+    
+    # 方法 1: 嘗試使用 CUPS 打印（Mac/Linux），PNG 在記憶體中編碼
+    if PRINT_TRANSPORT in ('auto', 'cups'):
+        image_data = payload.get('png')
+        if not image_data:
+            with timed_stage('encode_png'):
+                image_data = encode_label_png(label_img)
+        success = send_to_printer_via_cups(image_data)
+        record_result('cups', success)
+        target = 'cups'
+    
+    # 方法 2: 直接發送 Brother 光柵命令到 9100 端口（無需 CUPS）
+    if not success and PRINT_TRANSPORT in ('auto', 'network'):
+        raster_data = payload.get('raster')
+        if not raster_data:
+            with timed_stage('encode_raster'):
+                # 子進程只渲染了 PNG 時（auto 模式下 CUPS 失敗），從 PNG 還原圖像
+                if label_img is None:
+                    label_img = Image.open(io.BytesIO(payload['png']))
+                raster_data = encode_label(label_img, media=PRINTER_MEDIA)
+        if not wait_for_printer():
+            print(f"⚠️  {send_error()}，等待恢復超時")
+            record_result('network', False)
+            return False, None
+        if printer_pool.size():
+            success, target = printer_pool.send(raster_data, priority=PRIORITY_RANKS[priority])
+        else:
+            target = get_printer_ip()  # 使用動態獲取的 IP
+            success = send_to_printer_via_network(raster_data, target)
+        record_result('network', success)
+    
+    return success, target
+
+
+def timing_ms(start):
+    return round((time.perf_counter() - start) * 1000, 3)
+
+
+def print_item(item, job=None):
+    """
+    渲染並發送單張標籤，返回打印結果
+    job 不為空時會更新任務狀態
+    """
+    name = item.get('name', '')
+    
+    if job:
+        job.set_status(JOB_RENDERING)
+    
+    # 已預渲染的標籤直接發送
+    payload = prerender_cache.get(item, transport_formats())
+    if payload:
+        render_ms = payload['render_ms']
+        label_img = None
+    elif BATCH_PROCESSES:
+        # 在進程池中渲染和編碼，多個工作線程同時打印時可使用所有 CPU 核心
+        payload = batch_renderer.render_one(item, formats=single_formats(), media=PRINTER_MEDIA)
+        if payload.get('error'):
+            raise RuntimeError(payload['error'])
+        observe_stages(payload['stages'])
+        render_ms = payload['render_ms']
+        label_img = None
+    else:
+        # 創建標籤圖像（默認佈局或 BadgeConfig 佈局，具體格式在發送時按需編碼）
+        start = time.perf_counter()
+        label_img = render_item_image(item, PRINTER_MEDIA)
+        render_ms = timing_ms(start)
+        payload = {}
+    
+    if job:
+        job.set_status(JOB_SENDING)
+    
+    start = time.perf_counter()
+    success, target = send_payload(payload, label_img, job.priority if job else PRIORITY_INTERACTIVE)
+    
+    return {
+        'name': name,
+        'status': 'success' if success else 'failed',
+        'error': None if success else send_error(),
+        'printer': target,
+        'cached': bool(payload.get('cached')),
+        'render_ms': render_ms,
+        'send_ms': timing_ms(start)
+    }
+
+
+def cached_lookup(formats):
+    """批量渲染時先查找預渲染緩存"""
+    return lambda item: prerender_cache.get(item, formats)
+
+
+def send_timed(payload, priority):
+    """發送並記錄耗時（在發送線程中執行）"""
+    start = time.perf_counter()
+    success, target = send_payload(payload, priority=priority)
+    return success, target, timing_ms(start)
+
+
+def stream_target():
+    """
+    批量任務是否串流發送: 直接網路打印且只有一台可用打印機時返回 (IP, 端口)，否則返回 None
+    多台打印機時逐張分配到打印機池更快
+    """
+    if not STREAM_BATCHES or PRINT_TRANSPORT != 'network':
+        return None
+    if printer_pool.size() > 1:
+        return None
+    printer = printer_pool.pick()
+    if printer:
+        return printer.ip, printer.port
+    if printer_pool.size():
+        return None
+    return get_printer_ip(), PRINTER_PORT
+
+
+def stream_batch_items(job, ip, port):
+    """
+    批量任務: 進程池並行渲染，渲染完成的標籤在同一連接上作為一個多頁任務發送
+    連接中斷時，未發送的標籤改為逐張發送（自動重連或轉到其他打印機）
+    """
+    job.set_status(JOB_RENDERING)
+    rendered = []
+    
+    def pages():
+        for payload in batch_renderer.render(job.items, formats=('page',), media=PRINTER_MEDIA,
+                                             lookup=cached_lookup(('page',))):
+            if payload.get('error'):
+                job.add_result({
+                    'name': payload['name'],
+                    'status': 'failed',
+                    'error': payload['error'],
+                    'wait_ms': payload['wait_ms']
+                })
+                continue
+            observe_stages(payload['stages'])
+            job.set_status(JOB_SENDING)
+            rendered.append(payload)
+            yield payload['page']
+    
+    def on_page(index, send_ms):
+        print_metrics.observe_stage('transmit', send_ms / 1000)
+        payload = rendered[index]
+        job.add_result({
+            'name': payload['name'],
+            'status': 'success',
+            'error': None,
+            'printer': ip,
+            'cached': bool(payload.get('cached')),
+            'render_ms': payload['render_ms'],
+            'wait_ms': payload['wait_ms'],
+            'send_ms': send_ms
+        })
+    
+    page_iter = pages()
+    if not wait_for_printer():
+        # 打印機在等待時間內沒有恢復: 不發送，渲染完成的標籤全部記為失敗
+        error = send_error()
+        print(f"⚠️  {error}，等待恢復超時")
+        for _ in page_iter:
+            payload = rendered[-1]
+            job.add_result({
+                'name': payload['name'],
+                'status': 'failed',
+                'error': error,
+                'printer': ip,
+                'render_ms': payload['render_ms'],
+                'wait_ms': payload['wait_ms']
+            })
+        if rendered:
+            record_result('network', False, count=len(rendered))
+        return
+    try:
+        sent = printer_connections.get(ip, port).stream_pages(page_iter, on_page)
+        printer_pool.record_result(ip, True, count=sent)
+        record_result('network', True, count=sent)
+        return
+    except OSError as e:
+        sent = getattr(e, 'pages_sent', 0)
+        printer_pool.record_result(ip, False, str(e))
+        record_result('network', True, count=sent)
+        record_result('network', False)
+        print(f"⚠️  批量串流中斷（已發送 {sent} 頁）: {e}，其餘標籤逐張發送")
+    
+    def remaining():
+        yield from rendered[sent:]
+        for _ in page_iter:
+            yield rendered[-1]
+    
+    for payload in remaining():
+        success, target, send_ms = send_timed({'raster': page_to_job(payload['page'])}, job.priority)
+        job.add_result({
+            'name': payload['name'],
+            'status': 'success' if success else 'failed',
+            'error': None if success else send_error(),
+            'printer': target,
+            'render_ms': payload['render_ms'],
+            'wait_ms': payload['wait_ms'],
+            'send_ms': send_ms
+        })
+
+
+def print_batch_items(job):
+    """
+    批量任務: 進程池並行渲染，按順序發送
+    打印機池中有多台打印機時，同時向多台打印機發送；只有一台時串流為一個多頁任務
+    """
+    # 流式輸入的任務不知道何時結束，不能長時間佔用打印機連接，逐張發送
+    target = None if job.streaming else stream_target()
+    if target:
+        stream_batch_items(job, *target)
+        return
+    
+    job.set_status(JOB_RENDERING)
+    senders = max(1, printer_pool.size()) if PRINT_TRANSPORT == 'network' else 1
+    in_flight = deque()
+    
+    def collect(entry):
+        payload, future = entry
+        success, target, send_ms = future.result()
+        job.add_result({
+            'name': payload['name'],
+            'status': 'success' if success else 'failed',
+            'error': None if success else send_error(),
+            'printer': target,
+            'cached': bool(payload.get('cached')),
+            'render_ms': payload['render_ms'],
+            'wait_ms': payload['wait_ms'],
+            'send_ms': send_ms
+        })
+    
+    with ThreadPoolExecutor(max_workers=senders) as executor:
+        items = job.iter_items(idle=STREAM_FLUSH_SECONDS) if job.streaming else job.items
+        for payload in batch_renderer.render(items, formats=transport_formats(), media=PRINTER_MEDIA,
+                                             lookup=cached_lookup(transport_formats())):
+            if payload is None:
+                # 流式輸入暫時沒有新項目: 先返回已發送完成的結果，不必等到下一個項目
+                while in_flight and in_flight[0][1].done():
+                    collect(in_flight.popleft())
+                continue
+            if payload.get('error'):
+                job.add_result({
+                    'name': payload['name'],
+                    'status': 'failed',
+                    'error': payload['error'],
+                    'wait_ms': payload['wait_ms']
+                })
+                continue
+            
+            observe_stages(payload['stages'])
+            job.set_status(JOB_SENDING)
+            in_flight.append((payload, executor.submit(send_timed, payload, job.priority)))
+            # 限制已渲染但未發送的標籤數量
+            if len(in_flight) > senders * 2:
+                collect(in_flight.popleft())
+        
+        while in_flight:
+            collect(in_flight.popleft())
+
+
+def handle_print_job(job):
+    """
+    打印任務處理函數（在工作線程中執行）
+    """
+    print_metrics.observe_stage('queue_wait', time.time() - job.created_at)
+    if job.kind == 'batch' and (job.streaming or len(job.items) > 1) and BATCH_PROCESSES != 0:
+        print_batch_items(job)
+    else:
+        for item in job.iter_items():
+            try:
+                result = print_item(item, job)
+            except Exception as e:
+                result = {'name': item.get('name', ''), 'status': 'failed', 'error': str(e)}
+            job.add_result(result)
+    
+    failed = [r for r in job.results if r['status'] != 'success']
+    if failed:
+        job.set_status(JOB_FAILED, failed[0]['error'])
+    else:
+        job.set_status(JOB_SENT)
+
+
+# 渲染進程池（單張和批量任務共用，默認使用所有 CPU 核心，設為 0 則在工作線程中渲染）
+BATCH_PROCESSES = int(os.getenv('BATCH_PROCESSES', os.cpu_count() or 1))
+batch_renderer = BatchRenderer(workers=BATCH_PROCESSES or 1)
+
+# 預渲染緩存（記憶體上限 PRERENDER_CACHE_MB，設置 PRERENDER_CACHE_DIR 時同時保存到磁盤）
+prerender_cache = PrerenderCache(PRINTER_MEDIA)
+prerender_runs = deque(maxlen=20)
+_prerender_lock = threading.Lock()
+
+# 打印任務隊列（工作線程數可透過環境變量調整，默認不少於渲染進程數，讓每個核心都有任務）
+# PRINT_RESERVED_WORKERS 個線程只處理現場報到（interactive）任務；
+# 批量任務按來源輪流執行（PRINT_BATCH_FAIRNESS=source），每個來源最多同時 PRINT_BATCH_PER_SOURCE 個
+PRINT_WORKERS = int(os.getenv('PRINT_WORKERS', max(2, BATCH_PROCESSES)))
+# 工作線程由 init() 啟動
+job_queue = PrintJobQueue(
+    handle_print_job,
+    workers=PRINT_WORKERS,
+    reserved_workers=int(os.getenv('PRINT_RESERVED_WORKERS', 1)),
+    per_source=int(os.getenv('PRINT_BATCH_PER_SOURCE', 1)),
+    fairness=os.getenv('PRINT_BATCH_FAIRNESS', 'source').lower(),
+    start=False
+)
+
+
+def request_scheduling():
+    """
+    從請求中讀取調度參數，返回 (參數, 錯誤信息)
+    來源: X-Print-Source 請求頭（例如 kiosk 編號），默認為客戶端 IP
+    優先級: ?priority=interactive|batch，默認單張為 interactive、批量為 batch
+    """
+    priority = request.args.get('priority')
+    if priority and priority not in PRIORITIES:
+        return None, f'未知的優先級: {priority}'
+    return {'priority': priority, 'source': request.headers.get('X-Print-Source') or request.remote_addr}, None
+
+
+# 重複請求去重: 帶 Idempotency-Key 的請求在 PRINT_IDEMPOTENCY_TTL 秒內只打印一次；
+# 沒有鍵的單張打印按 (qrcode, name, company) 在 PRINT_DEDUP_SECONDS 秒內去重（設為 0 停用）
+idempotent_jobs = JobDeduplicator(float(os.getenv('PRINT_IDEMPOTENCY_TTL', 600)))
+recent_prints = JobDeduplicator(float(os.getenv('PRINT_DEDUP_SECONDS', 10)))
+
+
+def content_key(item):
+    """自動去重的鍵: QR Code、姓名和公司"""
+    user = (item.get('data') or {}).get('user') or item.get('user') or {}
+    parts = (item.get('qrcode'), item.get('name') or user.get('name'), item.get('company') or user.get('company'))
+    if not any(parts):
+        return None
+    return json.dumps(parts, ensure_ascii=False, default=str)
+
+
+def submit_job(kind, items, scheduling, key=None, auto_key=None):
+    """
+    提交任務（去重），返回 (任務, 是否重複)
+    scheduling 為 request_scheduling() 的結果，key 為客戶端提供的冪等鍵，auto_key 為按內容自動生成的鍵
+    """
+    submit = lambda: job_queue.submit(kind, items, **scheduling)
+    if key and idempotent_jobs.enabled:
+        job, duplicate = idempotent_jobs.submit(f'{kind}:{key}', submit)
+        reason = 'idempotency_key'
+    elif auto_key and recent_prints.enabled:
+        job, duplicate = recent_prints.submit(auto_key, submit)
+        reason = 'content'
+    else:
+        return submit(), False
+    if duplicate:
+        print_metrics.DEDUPLICATED.inc(reason=reason)
+        print(f"♻️  重複的打印請求，返回原任務 {job.id}")
+    return job, duplicate
+
+
+def job_response(job, status_code=202, duplicate=False, query=False, extra=None):
+    """
+    返回任務狀態
+    如果請求帶有 ?wait=秒數，則最多等待該時間直到任務完成
+    重複的請求返回原任務的狀態，並帶有 "deduplicated": true 和 Idempotent-Replayed 響應頭
+    extra 中的欄位（例如批量打印被拒絕的項目）加入響應體
+    query 為 True（查詢任務）時總是返回 200，失敗的任務只在響應體中以 status: failed 表示；
+    打印請求完成時返回 200（成功）或 500（失敗）
+    """
+    wait = request.args.get('wait', type=float)
+    if wait:
+        job.wait(min(wait, 60))
+    
+    payload = job.to_dict()
+    if extra:
+        payload.update(extra)
+    if job.finished and not query:
+        status_code = 200 if job.status == JOB_SENT else 500
+    headers = {}
+    if duplicate:
+        payload['deduplicated'] = True
+        headers['Idempotent-Replayed'] = 'true'
+    return jsonify(payload), status_code, headers
+
+
+# 已註冊的 BadgeConfig 佈局（佈局 ID -> 配置 JSON）
+layouts = {}
+_layouts_lock = threading.Lock()
+
+
+def prepare_item(item):
+    """
+    校驗並補全打印項目，返回 (項目, 錯誤信息)
+    帶 layout 時附上對應的 BadgeConfig，供渲染（包括子進程）使用；
+    只接受已註冊的佈局，請求中的 badge_config（可引用任意圖片路徑和 URL）會被拒絕
+    """
+    if not isinstance(item, dict):
+        return None, '項目需要 JSON 對象'
+    
+    if 'badge_config' in item:
+        return None, '不接受 badge_config，請先以 POST /layouts 註冊佈局，打印時以 layout 引用'
+    
+    if item.get('color_mode') and item['color_mode'] not in COLOR_MODES:
+        return None, f'未知的顏色模式: {item["color_mode"]}'
+    
+    layout = item.get('layout')
+    if layout:
+        with _layouts_lock:
+            config = layouts.get(layout)
+        if not config:
+            return None, f'佈局不存在: {layout}'
+        item = dict(item, badge_config=config)
+    
+    if item.get('badge_config'):
+        user = (item.get('data') or {}).get('user') or item.get('user') or {}
+        item.setdefault('name', user.get('name', item.get('name', '')))
+        return item, None
+    
+    if not item.get('name', ''):
+        return None, '缺少姓名參數'
+    return item, None
+
+
+@app.route('/layouts', methods=['POST'])
+def register_layout():
+    """
+    註冊 BadgeConfig 佈局（Node 端 model/BadgeConfig.js 的 JSON）
+    佈局會立即編譯，之後打印時以 "layout": "<佈局 ID>" 引用
+    遠程圖片在此時下載一次並保存在佈局中，打印時不再請求
+    """
+    config = request.get_json()
+    if not isinstance(config, dict) or not isinstance(config.get('elements'), list):
+        return jsonify({'error': '需要 BadgeConfig JSON（包含 elements 數組）'}), 400
+    
+    new_id = str(config.get('_id') or layout_id(config))
+    try:
+        config = embed_remote_images(config)
+    except Exception as e:
+        return jsonify({'status': 'error', 'message': f'圖片下載失敗: {e}'}), 400
+    try:
+        plan = get_render_plan(config, media=PRINTER_MEDIA)
+    except Exception as e:
+        return jsonify({'status': 'error', 'message': f'佈局編譯失敗: {e}'}), 400
+    
+    with _layouts_lock:
+        layouts[new_id] = config
+    return jsonify({'status': 'success', 'layout': new_id, 'plan': plan.to_dict()})
+
+
+@app.route('/layouts', methods=['GET'])
+def list_layouts():
+    """列出已註冊的佈局"""
+    with _layouts_lock:
+        registered = dict(layouts)
+    return jsonify({
+        'status': 'success',
+        'layouts': [dict(get_render_plan(config, media=PRINTER_MEDIA).to_dict(), layout=key) for key, config in registered.items()]
+    })
+
+
+@app.route('/layouts/<layout>', methods=['DELETE'])
+def remove_layout(layout):
+    with _layouts_lock:
+        removed = layouts.pop(layout, None)
+    if not removed:
+        return jsonify({'error': '佈局不存在'}), 404
+    return jsonify({'status': 'success'})
+
+
 @app.route('/print', methods=['POST'])
 def print_label():
     """
-    打印標籤 API
+    打印標籤 API（異步）
     接收 JSON 格式：
     {
         "name": "用戶姓名",
         "company": "公司名稱",
         "qrcode": "QR Code 數據"
     }
+    或使用已註冊的佈局：
+    {
+        "layout": "佈局 ID",
+        "user": {"name": "用戶姓名", ...},
+        "qrcode": "QR Code 數據"
+    }
+    立即返回任務 ID，可透過 GET /jobs/<job_id> 查詢狀態
+    
+    重試時帶相同的 Idempotency-Key 請求頭（或 "idempotency_key" 欄位）返回原任務，不會重複打印；
+    沒有鍵時相同的 (qrcode, name, company) 在短時間內也只打印一次，需要補印時加 "reprint": true
     """
     try:
         data = request.get_json()
@@ -250,46 +997,26 @@ def print_label():
         if not data:
             return jsonify({'error': '無請求數據'}), 400
         
-        name = data.get('name', '')
-        company = data.get('company', '')
-        qr_data = data.get('qrcode', name)  # 如果沒有提供，使用姓名
-        
-        if not name:
-            return jsonify({'error': '缺少姓名參數'}), 400
+        key = request.headers.get('Idempotency-Key')
+        reprint = False
+        if isinstance(data, dict):
+            data = dict(data)
+            key = key or data.pop('idempotency_key', None)
+            reprint = bool(data.pop('reprint', False))
         
-        # 創建標籤圖像
-        label_img = create_label_image(name, company, qr_data)
+        item, error = prepare_item(data)
+        if error:
+            return jsonify({'error': error}), 400
+        scheduling, error = request_scheduling()
+        if error:
+            return jsonify({'error': error}), 400
+        blocked = printer_backpressure()
+        if blocked:
+            return blocked
         
-        # 保存為臨時文件
-        temp_path = f'/tmp/label_{name.replace(" ", "_")}.png'
-        label_img.save(temp_path, 'PNG')
-        
-        # 方法 1: 嘗試使用 CUPS 打印（Mac/Linux）
-        success = send_to_printer_via_cups(temp_path)
-        
-        # 方法 2: 如果 CUPS 失敗，嘗試網路打印
-        if not success:
-            with open(temp_path, 'rb') as f:
-                image_data = f.read()
-            current_ip = get_printer_ip()  # 使用動態獲取的 IP
-            success = send_to_printer_via_network(image_data, current_ip)
-        
-        # 清理臨時文件
-        if os.path.exists(temp_path):
-            os.remove(temp_path)
-        
-        if success:
-            return jsonify({
-                'status': 'success',
-                'message': f'已發送打印任務: {name}',
-                'name': name,
-                'company': company
-            })
-        else:
-            return jsonify({
-                'status': 'error',
-                'message': '打印失敗，請檢查打印機連接'
-            }), 500
+        auto_key = None if reprint else content_key(item)
+        job, duplicate = submit_job('single', [item], scheduling, key=key, auto_key=auto_key)
+        return job_response(job, duplicate=duplicate)
             
     except Exception as e:
         return jsonify({
@@ -301,39 +1028,35 @@ def print_label():
 @app.route('/print/batch', methods=['POST'])
 def print_batch():
     """
-    批量打印標籤
-    接收 JSON 數組格式
+    批量打印標籤（異步）
+    接收 JSON 數組格式，整批作為一個任務排隊；
+    Content-Type 為 application/x-ndjson 時改為流式輸入和輸出（見 print_batch_stream）
     """
+    if request.mimetype in NDJSON_MIMETYPES:
+        return print_batch_stream()
+    
     try:
         data = request.get_json()
         
         if not isinstance(data, list):
             return jsonify({'error': '需要數組格式'}), 400
         
-        results = []
-        for item in data:
-            name = item.get('name', '')
-            company = item.get('company', '')
-            qr_data = item.get('qrcode', name)
-            
-            if name:
-                label_img = create_label_image(name, company, qr_data)
-                temp_path = f'/tmp/label_{name.replace(" ", "_")}.png'
-                label_img.save(temp_path, 'PNG')
-                
-                success = send_to_printer_via_cups(temp_path)
-                if os.path.exists(temp_path):
-                    os.remove(temp_path)
-                
-                results.append({
-                    'name': name,
-                    'status': 'success' if success else 'failed'
-                })
+        prepared = [prepare_item(item) for item in data]
+        items = [item for item, error in prepared if not error]
+        # 被拒絕的項目（在數組中的位置和原因）隨響應返回，其餘項目照常打印
+        invalid = [{'index': index, 'error': error} for index, (_, error) in enumerate(prepared) if error]
+        if not items:
+            return jsonify({'error': '沒有可打印的項目', 'invalid': invalid}), 400
+        scheduling, error = request_scheduling()
+        if error:
+            return jsonify({'error': error}), 400
+        blocked = printer_backpressure()
+        if blocked:
+            return blocked
         
-        return jsonify({
-            'status': 'completed',
-            'results': results
-        })
+        # 批量任務只按 Idempotency-Key 去重（整批）
+        job, duplicate = submit_job('batch', items, scheduling, key=request.headers.get('Idempotency-Key'))
+        return job_response(job, duplicate=duplicate, extra={'invalid': invalid})
         
     except Exception as e:
         return jsonify({
@@ -342,22 +1065,303 @@ def print_batch():
         }), 500
 
 
-if __name__ == '__main__':
-    # 從環境變量讀取配置
-    port = int(os.getenv('PRINTER_BRIDGE_PORT', 5000))
-    debug = os.getenv('FLASK_DEBUG', 'False').lower() == 'true'
+def run_prerender(items, run):
+    """後台預渲染（多次提交按順序執行）"""
+    with _prerender_lock:
+        prerender(prerender_cache, batch_renderer, items, transport_formats(), run)
+    print(f"🗂️  預渲染完成: {run.rendered} 張，已緩存 {run.skipped} 張，失敗 {run.failed} 張")
+
+
+@app.route('/prerender', methods=['POST'])
+def prerender_labels():
+    """
+    預渲染參加者標籤（活動開始前調用）
+    接收與 /print/batch 相同的 JSON 數組（或 {"items": [...]}），建議每項帶 attendee_id；
+    標籤在後台渲染為打印數據並放入緩存，之後 /print 命中緩存時只需發送
+    """
+    data = request.get_json()
+    if isinstance(data, dict):
+        data = data.get('items')
+    if not isinstance(data, list):
+        return jsonify({'error': '需要數組格式'}), 400
+    
+    prepared = [prepare_item(item) for item in data]
+    items = [item for item, error in prepared if not error]
+    if not items:
+        return jsonify({'error': '沒有可渲染的項目'}), 400
+    if not prerender_cache.enabled:
+        return jsonify({'error': '預渲染緩存已停用（PRERENDER_CACHE_MB=0）'}), 400
+    
+    run = PrerenderRun(len(items))
+    prerender_runs.append(run)
+    threading.Thread(target=run_prerender, args=(items, run), name='prerender', daemon=True).start()
+    return jsonify({
+        'status': 'accepted',
+        'invalid': len(prepared) - len(items),
+        'run': run.to_dict()
+    }), 202
+
+
+@app.route('/prerender', methods=['GET'])
+def prerender_status():
+    """預渲染進度和緩存命中情況"""
+    return jsonify({
+        'status': 'success',
+        'cache': prerender_cache.stats(),
+        'runs': [run.to_dict() for run in prerender_runs]
+    })
+
+
+@app.route('/prerender', methods=['DELETE'])
+def clear_prerender():
+    """清空預渲染緩存"""
+    prerender_cache.clear()
+    return jsonify({'status': 'success'})
+
+
+def format_event(event, data, sse=False):
+    """流式響應的一行: NDJSON 或 Server-Sent Events"""
+    body = json.dumps(dict(data, event=event), ensure_ascii=False)
+    return f'event: {event}\ndata: {body}\n\n' if sse else body + '\n'
+
+
+def input_buffered() -> bool:
+    """WSGI 服務器是否已在調用應用之前讀取了整個請求體（例如 waitress）"""
+    return request.environ.get('SERVER_SOFTWARE', '').lower().startswith(BUFFERING_SERVERS)
+
+
+def print_batch_stream():
+    """
+    流式批量打印: 請求體為 NDJSON（每行一個打印項目），邊讀取邊打印
+    響應逐行返回每個項目的結果（Accept: text/event-stream 時使用 SSE），最後返回 done 事件
+    只有不緩衝請求體的服務器（gunicorn、Flask 開發服務器）才能在上傳過程中處理項目，
+    accepted 事件的 input 欄位表示 streamed 或 buffered
+    """
+    sse = request.accept_mimetypes.best == 'text/event-stream'
+    scheduling, error = request_scheduling()
+    if error:
+        return jsonify({'error': error}), 400
+    blocked = printer_backpressure()
+    if blocked:
+        return blocked
+    job = job_queue.submit('batch', [], streaming=True, **scheduling)
+    stream = request.stream
+    invalid = queue.Queue()
+    
+    def read_input():
+        try:
+            for line_no, line in enumerate(stream, 1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    item, error = prepare_item(json.loads(line))
+                except ValueError as e:
+                    item, error = None, f'JSON 格式錯誤: {e}'
+                if error:
+                    invalid.put({'line': line_no, 'error': error})
+                    job.notify()
+                else:
+                    job.add_item(item)
+        except Exception as e:
+            print(f"⚠️  NDJSON 輸入中斷: {e}")
+        finally:
+            # 客戶端斷開時也結束輸入，已收到的項目繼續打印
+            job.close_input()
     
-    # 初始化時獲取打印機 IP
-    initial_ip = get_printer_ip()
+    def generate():
+        sent = 0
+        
+        def new_results(timeout=0):
+            nonlocal sent
+            for result in job.wait_results(sent, timeout):
+                yield format_event('result', dict(result, index=sent), sse)
+                sent += 1
+        
+        yield format_event('accepted', {'job_id': job.id, 'input': 'buffered' if input_buffered() else 'streamed'}, sse)
+        # 在獨立線程中讀取輸入，結果不必等到下一行到達才返回
+        threading.Thread(target=read_input, name=f'ndjson-{job.id[:8]}', daemon=True).start()
+        
+        last_event = time.monotonic()
+        while True:
+            before = sent
+            while not invalid.empty():
+                yield format_event('invalid', invalid.get(), sse)
+            yield from new_results(STREAM_PROGRESS_SECONDS)
+            if job.finished and sent == len(job.results) and invalid.empty():
+                break
+            if sent != before:
+                last_event = time.monotonic()
+            elif time.monotonic() - last_event >= STREAM_PROGRESS_SECONDS:
+                last_event = time.monotonic()
+                yield format_event('progress', {
+                    'status': job.status,
+                    'count': len(job.items),
+                    'done': sent
+                }, sse)
+        
+        failed = sum(1 for result in job.results if result['status'] != 'success')
+        yield format_event('done', {
+            'job_id': job.id,
+            'status': job.status,
+            'count': len(job.items),
+            'failed': failed,
+            'error': job.error
+        }, sse)
     
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream' if sse else 'application/x-ndjson',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+
+@app.route('/printers', methods=['GET'])
+def list_printers():
+    """查看打印機池狀態"""
+    return jsonify({
+        'status': 'success',
+        **printer_pool.stats()
+    })
+
+
+@app.route('/printers/status', methods=['GET'])
+def printers_status():
+    """
+    打印機狀態（介質、錯誤、忙碌），由後台監控定期查詢
+    ?refresh=1 立即查詢一次
+    """
+    if request.args.get('refresh', '').lower() in ('1', 'true', 'yes'):
+        status_monitor.poll_all(force=True)
+    return jsonify({
+        'status': 'success',
+        **status_monitor.stats()
+    })
+
+
+@app.route('/printers', methods=['POST'])
+def add_printer():
+    """
+    手動加入打印機到打印機池
+    接收 JSON 格式: {"ip": "192.168.1.101", "name": "Desk 2"}
+    """
+    data = request.get_json() or {}
+    ip = data.get('ip')
+    if not ip:
+        return jsonify({'error': '缺少 ip 參數'}), 400
+    printer = printer_pool.add(ip, int(data.get('port', PRINTER_PORT)), data.get('name'), 'manual')
+    return jsonify({'status': 'success', 'printer': printer.to_dict()})
+
+
+@app.route('/printers/<ip>', methods=['DELETE'])
+def remove_printer(ip):
+    """從打印機池移除打印機"""
+    if not printer_pool.remove(ip):
+        return jsonify({'error': '打印機不存在'}), 404
+    printer_connections.close(ip)
+    return jsonify({'status': 'success'})
+
+
+@app.route('/jobs', methods=['GET'])
+def list_jobs():
+    """
+    列出最近的打印任務
+    可選參數: ?status=queued|rendering|sending|sent|failed&limit=100
+    """
+    status = request.args.get('status')
+    if status and status not in JOB_STATES:
+        return jsonify({'error': f'未知狀態: {status}'}), 400
+    
+    limit = request.args.get('limit', 100, type=int)
+    jobs = job_queue.list_jobs(status=status, limit=limit)
+    return jsonify({
+        'status': 'success',
+        'count': len(jobs),
+        'jobs': [job.to_dict() for job in jobs]
+    })
+
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """查詢單個打印任務狀態"""
+    job = job_queue.get(job_id)
+    if not job:
+        return jsonify({'error': '任務不存在'}), 404
+    return job_response(job, status_code=200, query=True)
+
+
+_init_lock = threading.Lock()
+_initialized = False
+
+
+def init():
+    """
+    啟動服務: 渲染進程池、打印線程和環境變量中的打印機，返回 Flask 應用（可重複調用）
+
+    導入本模組不啟動任何線程或進程，只有服務入口（本文件的 __main__ 和 wsgi.py）調用 init()。
+    渲染進程以 __mp_main__ 重新導入入口腳本時因此不會各自啟動打印線程、打印機池或讀取打印機配置
+    """
+    global _initialized
+    with _init_lock:
+        if _initialized:
+            return app
+        _initialized = True
+
+        # 預先啟動渲染進程，第一個打印請求無需等待進程啟動
+        if BATCH_PROCESSES:
+            batch_renderer.warm_up()
+        job_queue.start()
+
+        # 額外的打印機（逗號分隔），例如 PRINTER_IPS=192.168.1.101,192.168.1.102
+        for extra_ip in filter(None, (ip.strip() for ip in os.getenv('PRINTER_IPS', '').split(','))):
+            printer_pool.add(extra_ip, PRINTER_PORT, name='PRINTER_IPS', method='env')
+
+        # 優先使用環境變量中的打印機 IP（不觸發自動發現）
+        if os.getenv('PRINTER_IP'):
+            get_printer_ip()
+    return app
+
+
+@app.before_request
+def ensure_started():
+    """以其他方式載入應用（例如 gunicorn wsgi:app 或測試客戶端）時，在第一個請求前啟動服務"""
+    if not _initialized:
+        init()
+
+
+def print_startup_banner(port, server='Flask 開發服務器'):
+    """
+    啟動後台發現並輸出服務配置（開發服務器和 wsgi.py 共用）
+    """
+    # 打印機發現在後台進行，不阻塞服務啟動
+    if start_background_discovery():
+        printer_status = '自動發現中（GET /health 查看進度）'
+    else:
+        printer_status = get_printer_ip(wait=0)
+    
+    for warning in dependency_warnings():
+        print(warning)
     print(f"🚀 Printer Bridge 啟動中...")
-    print(f"📡 監聽端口: {port}")
-    print(f"🖨️  打印機 IP: {initial_ip}")
-    print(f"📏 標籤尺寸: {LABEL_WIDTH_MM}mm x {LABEL_HEIGHT_MM}mm")
+    print(f"📡 監聽端口: {port} ({server})")
+    print(f"⚙️  渲染進程: {BATCH_PROCESSES}，打印線程: {PRINT_WORKERS}")
+    print(f"🖨️  打印機 IP: {printer_status}")
+    print(f"📏 標籤尺寸: {LABEL_WIDTH_MM}mm x {LABEL_HEIGHT_MM}mm (顏色模式: {DEFAULT_COLOR_MODE})")
+    print(f"🔌 打印方式: {PRINT_TRANSPORT} (介質: {PRINTER_MEDIA})")
     print(f"\n💡 提示:")
     print(f"   - GET /discover - 發現所有打印機")
     print(f"   - GET /discover/brother - 發現 Brother QL-820NWB")
-    print(f"   - POST /print - 打印標籤")
+    print(f"   - POST /print - 打印標籤（返回任務 ID）")
+    print(f"   - GET /jobs/<job_id> - 查詢打印任務狀態")
+
+
+if __name__ == '__main__':
+    # 從環境變量讀取配置
+    port = int(os.getenv('PRINTER_BRIDGE_PORT', 5000))
+    debug = os.getenv('FLASK_DEBUG', 'False').lower() == 'true'
+    
+    init()
+    print_startup_banner(port)
+    print("   - 生產環境請使用: python printer/wsgi.py")
     
     app.run(host='0.0.0.0', port=port, debug=debug)
 
@@ -0,0 +1,140 @@
+"""
+打印機發現緩存模組
+將發現的打印機及最後發現時間保存到 JSON 文件，重啟後仍可使用
+"""
+
+import json
+import os
+import threading
+import time
+from typing import Dict, Iterable, List, Optional
+
+# 默認緩存文件位置和有效期（秒）
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'printer_bridge', 'printers.json')
+DEFAULT_CACHE_TTL = 300
+
+
+class PrinterCache:
+    """
+    持久化打印機緩存（以 IP 為鍵）
+    每個條目保存 discover_all() 返回的打印機信息，以及 first_seen / last_seen 時間戳
+    complete_at 記錄最近一次完整發現（列出所有打印機）的時間，提前返回的部分結果只合併條目
+    """
+
+    def __init__(self, path: Optional[str] = None, ttl: Optional[float] = None):
+        self.path = path or os.getenv('PRINTER_CACHE_PATH', DEFAULT_CACHE_PATH)
+        self.ttl = ttl if ttl is not None else float(os.getenv('PRINTER_CACHE_TTL', DEFAULT_CACHE_TTL))
+        self._lock = threading.Lock()
+        self.complete_at = None
+        self._entries = self._load()
+
+    def _load(self) -> Dict[str, Dict]:
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            self.complete_at = data.get('complete_at')
+            return {entry['ip']: entry for entry in data.get('printers', []) if entry.get('ip')}
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            print(f"⚠️  打印機緩存讀取失敗 {self.path}: {e}")
+            return {}
+
+    def _save(self):
+        # 先寫入臨時文件再替換，避免多個進程同時讀寫時讀到不完整的文件
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            temp_path = f'{self.path}.{os.getpid()}.tmp'
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump({'printers': list(self._entries.values()), 'complete_at': self.complete_at},
+                          f, ensure_ascii=False, indent=2)
+            os.replace(temp_path, self.path)
+        except OSError as e:
+            print(f"⚠️  打印機緩存保存失敗 {self.path}: {e}")
+
+    def record(self, printers: Iterable[Dict], now: Optional[float] = None, complete: bool = True):
+        """
+        記錄（或更新）發現的打印機
+        complete 為 False 表示部分結果（例如找到第一台 Brother 打印機後提前返回），只合併條目，
+        不作為完整的打印機列表
+        """
+        now = now or time.time()
+        with self._lock:
+            if complete:
+                self.complete_at = now
+            for printer in printers:
+                ip = printer.get('ip')
+                if not ip:
+                    continue
+                entry = dict(self._entries.get(ip, {}))
+                entry.update(printer)
+                entry.setdefault('first_seen', now)
+                entry['last_seen'] = now
+                self._entries[ip] = entry
+            self._save()
+
+    def touch(self, ips: Iterable[str], now: Optional[float] = None, complete: bool = False):
+        """
+        更新打印機的最後發現時間（重新驗證成功後調用）
+        complete 為 True 表示重新驗證的是完整的打印機列表
+        """
+        now = now or time.time()
+        with self._lock:
+            if complete:
+                self.complete_at = now
+            for ip in ips:
+                if ip in self._entries:
+                    self._entries[ip]['last_seen'] = now
+            self._save()
+
+    def remove(self, ip: str) -> bool:
+        with self._lock:
+            removed = self._entries.pop(ip, None) is not None
+            if removed:
+                self._save()
+            return removed
+
+    def clear(self):
+        with self._lock:
+            self._entries = {}
+            self.complete_at = None
+            self._save()
+
+    def entries(self) -> List[Dict]:
+        """所有條目，最近發現的在前"""
+        with self._lock:
+            entries = [dict(entry) for entry in self._entries.values()]
+        return sorted(entries, key=lambda entry: entry.get('last_seen', 0), reverse=True)
+
+    def fresh(self, now: Optional[float] = None, complete: bool = False) -> List[Dict]:
+        """
+        仍在有效期內的條目
+        complete 為 True 時（列出所有打印機）只有最近一次完整發現仍在有效期內才返回條目
+        """
+        now = now or time.time()
+        if complete and (self.complete_at is None or now - self.complete_at > self.ttl):
+            return []
+        return [entry for entry in self.entries() if now - entry.get('last_seen', 0) <= self.ttl]
+
+    def stats(self) -> Dict:
+        entries = self.entries()
+        return {
+            'path': self.path,
+            'ttl': self.ttl,
+            'count': len(entries),
+            'fresh': len(self.fresh()),
+            'complete_at': self.complete_at,
+        }
+
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+
+def get_printer_cache() -> PrinterCache:
+    """返回進程內共享的默認緩存"""
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = PrinterCache()
+        return _default_cache
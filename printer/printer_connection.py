@@ -0,0 +1,358 @@
+"""
+打印機連接管理模組
+為每台打印機保持一個 9100 端口的長連接，連續打印時無需每張標籤重新建立 TCP 連接；
+連接斷開時自動重連，並支援在同一連接上以多頁任務的形式串流發送批量標籤；
+串流期間有其他任務等待時，在頁與頁之間結束當前多頁任務，讓出連接
+"""
+
+import os
+import select
+import socket
+import threading
+import time
+from typing import Callable, Dict, Iterable, Optional
+
+from brother_ql_raster import (
+    CMD_INVALIDATE, CMD_INITIALIZE, CMD_RASTER_MODE, STATUS_HEADER, STATUS_LENGTH, STATUS_TYPE_REPLY,
+    set_page_flags, status_request,
+)
+
+# 連接、發送超時（秒）
+CONNECT_TIMEOUT = float(os.getenv('PRINTER_CONNECT_TIMEOUT', 5))
+SEND_TIMEOUT = float(os.getenv('PRINTER_SEND_TIMEOUT', 10))
+
+# 連接閒置多少秒後關閉（QL-820NWB 同一時間只接受一個 9100 連接，閒置連接需要及時釋放給其他客戶端）
+# 設為 0 則每次發送後立即關閉（舊行為）
+IDLE_TIMEOUT = float(os.getenv('PRINTER_KEEPALIVE_IDLE', 15))
+
+# 發送緩衝區大小: 每次最多寫入這麼多數據，同時限制內核發送緩衝區
+WRITE_BUFFER = int(os.getenv('PRINTER_WRITE_BUFFER', 64 * 1024))
+
+# 串流讓出連接後，最多等待其他任務取得連接的秒數
+YIELD_WAIT = 1.0
+# 等待狀態回覆時檢查是否有打印任務在等待連接的間隔（秒）
+STATUS_POLL_SLICE = 0.05
+
+
+class PrinterConnection:
+    """
+    單台打印機的長連接
+    所有發送都持有同一把鎖，保證多頁任務不會被其他任務插入
+    """
+
+    def __init__(self, ip: str, port: int = 9100, connect_timeout: float = CONNECT_TIMEOUT,
+                 send_timeout: float = SEND_TIMEOUT, idle_timeout: float = IDLE_TIMEOUT,
+                 write_buffer: int = WRITE_BUFFER):
+        self.ip = ip
+        self.port = port
+        self.connect_timeout = connect_timeout
+        self.send_timeout = send_timeout
+        self.idle_timeout = idle_timeout
+        self.write_buffer = write_buffer
+        self.lock = threading.RLock()
+        self.waiting = 0  # 等待連接的單張任務數
+        self._streams_waiting = 0  # 等待連接的批量串流數（狀態查詢遇到時讓出連接）
+        self._waiting_lock = threading.Lock()
+        self.sock = None
+        self.last_used = 0.0
+        self.connects = 0
+        self.reconnects = 0
+        self.jobs = 0
+        self.yields = 0
+        self.bytes_sent = 0
+        self.last_error = None
+
+    @property
+    def connected(self) -> bool:
+        return self.sock is not None
+
+    def _connect(self) -> socket.socket:
+        sock = socket.create_connection((self.ip, self.port), timeout=self.connect_timeout)
+        sock.settimeout(self.send_timeout)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.write_buffer)
+        self.connects += 1
+        return sock
+
+    def _is_alive(self) -> bool:
+        """
+        檢查已有連接是否仍然可用
+        對方關閉連接時 socket 變為可讀且 recv 返回空；打印機主動發送的狀態數據直接丟棄
+        """
+        try:
+            readable, _, _ = select.select([self.sock], [], [], 0)
+            if not readable:
+                return True
+            return bool(self.sock.recv(4096))
+        except OSError:
+            return False
+
+    def close(self):
+        with self.lock:
+            if self.sock is not None:
+                try:
+                    self.sock.close()
+                except OSError:
+                    pass
+                self.sock = None
+
+    def _ensure_connected(self) -> bool:
+        """返回 True 表示使用的是已有連接"""
+        if self.sock is not None:
+            if time.time() - self.last_used < self.idle_timeout and self._is_alive():
+                return True
+            self.close()
+            self.reconnects += 1
+        self.sock = self._connect()
+        return False
+
+    def _write(self, data: bytes):
+        view = memoryview(data)
+        for offset in range(0, len(view), self.write_buffer):
+            self.sock.sendall(view[offset:offset + self.write_buffer])
+        self.bytes_sent += len(data)
+        self.last_used = time.time()
+
+    def send(self, data: bytes):
+        """
+        發送一個完整的打印任務，失敗時拋出 OSError
+        已有連接發送失敗（例如打印機重啟後連接已失效）時重新連接並重發一次；
+        光柵任務以 invalidate + initialize 開頭，打印機會丟棄之前不完整的數據
+        """
+        with self._waiting_lock:
+            self.waiting += 1
+        with self.lock:
+            with self._waiting_lock:
+                self.waiting -= 1
+            try:
+                reused = self._ensure_connected()
+                try:
+                    self._write(data)
+                except OSError:
+                    self.close()
+                    if not reused:
+                        raise
+                    self.reconnects += 1
+                    self.sock = self._connect()
+                    self._write(data)
+                self.jobs += 1
+                self.last_error = None
+            except OSError as e:
+                self.close()
+                self.last_error = str(e)
+                raise
+            finally:
+                if self.idle_timeout <= 0:
+                    self.close()
+
+    def stream_pages(self, pages: Iterable[bytes],
+                     on_page: Optional[Callable[[int, float], None]] = None, yield_to_waiting: bool = True) -> int:
+        """
+        在同一連接上以一個多頁任務發送多張標籤
+        pages 為 encode_label_page() 的結果，可以是邊渲染邊產出的生成器；
+        每頁的首頁標記和結束命令在發送時按位置設置（最後一頁需要預讀一頁才能確定）
+        yield_to_waiting 時，如有單張任務在等待連接，當前頁作為最後一頁結束任務並讓出連接，
+        之後以新的多頁任務繼續發送其餘標籤
+        on_page(序號, 發送耗時毫秒) 在每頁寫入後調用
+        返回發送的頁數，發送失敗時拋出 OSError（已發送的頁數見 exception.pages_sent）
+        """
+        self._acquire_for_stream()
+        sent = 0
+        try:
+            self._ensure_connected()
+            self._write(CMD_INVALIDATE + CMD_INITIALIZE + CMD_RASTER_MODE)
+            page_in_job = 0
+            previous = None
+            for page in pages:
+                if previous is not None:
+                    yielding = yield_to_waiting and self.waiting > 0
+                    self._write_page(previous, sent, page_in_job, yielding, on_page)
+                    sent += 1
+                    page_in_job += 1
+                    if yielding:
+                        self._yield()
+                        self._ensure_connected()
+                        self._write(CMD_INVALIDATE + CMD_INITIALIZE + CMD_RASTER_MODE)
+                        page_in_job = 0
+                previous = page
+            if previous is not None:
+                self._write_page(previous, sent, page_in_job, True, on_page)
+                sent += 1
+            self.jobs += 1
+            self.last_error = None
+            return sent
+        except OSError as e:
+            self.close()
+            self.last_error = str(e)
+            e.pages_sent = sent
+            raise
+        finally:
+            if self.idle_timeout <= 0:
+                self.close()
+            self.lock.release()
+
+    def _acquire_for_stream(self):
+        with self._waiting_lock:
+            self._streams_waiting += 1
+        self.lock.acquire()
+        with self._waiting_lock:
+            self._streams_waiting -= 1
+
+    @property
+    def in_use(self) -> bool:
+        """連接正在發送或有任務在等待連接"""
+        return self.lock.locked() or self.waiting > 0 or self._streams_waiting > 0
+
+    def request_status(self, timeout: float = 2.0, blocking: bool = False) -> Optional[bytes]:
+        """
+        在同一連接上發送狀態查詢並返回 32 bytes 的狀態信息（QL-820NWB 只接受一個 9100 連接，
+        不能另開連接查詢）
+        blocking=False 時連接正被打印任務使用（或等待回覆期間有任務在等待連接）則返回 None；
+        查詢前沒有打開的連接在查詢後關閉，不會因為輪詢而一直佔用打印機
+        """
+        if not self.lock.acquire(blocking=blocking):
+            return None
+        was_connected = self.sock is not None
+        last_used = self.last_used
+        try:
+            self._ensure_connected()
+            # 丟棄之前打印完成時打印機主動發送的狀態
+            while select.select([self.sock], [], [], 0)[0]:
+                if not self.sock.recv(4096):
+                    raise ConnectionError('打印機已關閉連接')
+            self._write(status_request())
+            deadline = time.monotonic() + timeout
+            buffer = b''
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise socket.timeout('等待打印機狀態超時')
+                if not blocking and (self.waiting > 0 or self._streams_waiting > 0):
+                    return None  # 打印優先，未讀取的回覆在下次查詢時丟棄
+                if not select.select([self.sock], [], [], min(remaining, STATUS_POLL_SLICE))[0]:
+                    continue
+                data = self.sock.recv(4096)
+                if not data:
+                    raise ConnectionError('打印機已關閉連接')
+                buffer += data
+                # 按 32 bytes 對齊，優先返回對查詢的回覆
+                start = buffer.find(bytes((STATUS_HEADER,)))
+                if start < 0:
+                    buffer = b''
+                    continue
+                buffer = buffer[start:]
+                while len(buffer) >= STATUS_LENGTH:
+                    status, buffer = buffer[:STATUS_LENGTH], buffer[STATUS_LENGTH:]
+                    if status[18] == STATUS_TYPE_REPLY or not buffer:
+                        return status
+        except OSError as e:
+            self.close()
+            self.last_error = str(e)
+            raise
+        finally:
+            # 狀態查詢不算作使用，不延長閒置連接的關閉時間
+            self.last_used = last_used
+            if not was_connected or self.idle_timeout <= 0:
+                self.close()
+            self.lock.release()
+
+    def _write_page(self, page: bytes, index: int, page_in_job: int, last: bool, on_page):
+        start = time.perf_counter()
+        self._write(set_page_flags(page, first_page=page_in_job == 0, last_page=last))
+        if on_page:
+            on_page(index, round((time.perf_counter() - start) * 1000, 3))
+
+    def _yield(self):
+        """暫時釋放連接鎖，等待排隊的單張任務取得連接後再重新取得"""
+        self.yields += 1
+        self.lock.release()
+        try:
+            deadline = time.monotonic() + YIELD_WAIT
+            while self.waiting > 0 and time.monotonic() < deadline:
+                time.sleep(0.001)
+        finally:
+            self._acquire_for_stream()
+
+    def to_dict(self) -> Dict:
+        return {
+            'ip': self.ip,
+            'port': self.port,
+            'connected': self.connected,
+            'connects': self.connects,
+            'reconnects': self.reconnects,
+            'jobs': self.jobs,
+            'yields': self.yields,
+            'bytes_sent': self.bytes_sent,
+            'idle_s': round(time.time() - self.last_used, 1) if self.last_used else None,
+            'last_error': self.last_error,
+        }
+
+
+class ConnectionManager:
+    """
+    按 (IP, 端口) 管理打印機長連接
+    後台線程定期關閉閒置連接
+    """
+
+    def __init__(self, idle_timeout: float = IDLE_TIMEOUT, **connection_options):
+        self.idle_timeout = idle_timeout
+        self.connection_options = connection_options
+        self._connections = {}
+        self._lock = threading.Lock()
+        self._reaper = None
+
+    def get(self, ip: str, port: int = 9100) -> PrinterConnection:
+        with self._lock:
+            key = (ip, port)
+            connection = self._connections.get(key)
+            if connection is None:
+                connection = PrinterConnection(ip, port, idle_timeout=self.idle_timeout, **self.connection_options)
+                self._connections[key] = connection
+            if self._reaper is None and self.idle_timeout > 0:
+                self._reaper = threading.Thread(target=self._reap_idle, name='printer-connection-reaper', daemon=True)
+                self._reaper.start()
+            return connection
+
+    def send(self, data: bytes, ip: str, port: int = 9100) -> bool:
+        """發送打印任務，返回是否成功（與 PrinterPool 的 send_func 簽名一致）"""
+        try:
+            self.get(ip, port).send(data)
+            return True
+        except OSError as e:
+            print(f"網路打印錯誤 ({ip}:{port}): {e}")
+            return False
+
+    def close_idle(self, now: Optional[float] = None):
+        now = now or time.time()
+        for connection in self.connections():
+            # 正在發送的連接持有鎖，跳過
+            if connection.connected and now - connection.last_used >= self.idle_timeout \
+                    and connection.lock.acquire(blocking=False):
+                try:
+                    if now - connection.last_used >= self.idle_timeout:
+                        connection.close()
+                finally:
+                    connection.lock.release()
+
+    def _reap_idle(self):
+        while True:
+            time.sleep(max(1.0, self.idle_timeout / 3))
+            self.close_idle()
+
+    def close(self, ip: Optional[str] = None):
+        """關閉指定打印機（或所有打印機）的連接"""
+        for connection in self.connections():
+            if ip is None or connection.ip == ip:
+                connection.close()
+
+    def connections(self):
+        with self._lock:
+            return list(self._connections.values())
+
+    def stats(self) -> Dict:
+        connections = self.connections()
+        return {
+            'idle_timeout': self.idle_timeout,
+            'open': sum(1 for c in connections if c.connected),
+            'connections': [c.to_dict() for c in connections],
+        }
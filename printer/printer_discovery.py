@@ -3,27 +3,189 @@
 支援多種方法動態發現 Brother QL-820NWB 打印機的 IP 地址
 """
 
+import asyncio
+import os
+import queue
 import socket
 import subprocess
 import re
 import ipaddress
-from typing import List, Dict, Optional
+from typing import AsyncIterator, Awaitable, Callable, Iterable, Iterator, List, Dict, Optional
 import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+from printer_cache import PrinterCache, get_printer_cache
+from print_metrics import record_discovery
+from ipp_client import CUPS_CLIENT, IPPError, get_ipp_client
+from printer_status import SNMP_COMMUNITY, snmp_get
+from scan_planner import ScanPlan, is_brother_mac, plan_ranges, read_neighbours
 
 try:
     from zeroconf import ServiceBrowser, Zeroconf, ServiceInfo
     ZEROCONF_AVAILABLE = True
 except ImportError:
     ZEROCONF_AVAILABLE = False
-    print("⚠️  zeroconf 未安裝，mDNS 發現功能不可用")
 
 try:
     import netifaces
     NETIFACES_AVAILABLE = True
 except ImportError:
     NETIFACES_AVAILABLE = False
-    print("⚠️  netifaces 未安裝，網路介面掃描功能受限")
+
+
+def dependency_warnings():
+    """缺少可選依賴時的提示（由服務入口在啟動時輸出，導入本模組時不輸出）"""
+    warnings = []
+    if not ZEROCONF_AVAILABLE:
+        warnings.append("⚠️  zeroconf 未安裝，mDNS 發現功能不可用")
+    if not NETIFACES_AVAILABLE:
+        warnings.append("⚠️  netifaces 未安裝，網路介面掃描功能受限")
+    return warnings
+
+# 常見的打印端口（按優先順序）
+PRINTER_PORTS = [9100, 515, 631]
+
+# 網路掃描時同時進行的 TCP 連接數上限（受限於進程可打開的文件數）
+SCAN_CONCURRENCY = int(os.getenv('SCAN_CONCURRENCY', 512))
+
+# 查找 Brother 打印機時，確認找到後停止掃描子網的其餘部分
+SCAN_STOP_EARLY = os.getenv('SCAN_STOP_EARLY', 'true').lower() == 'true'
+
+# 各發現方法的優先順序: 同一 IP 由多個方法發現時保留排在前面的方法的結果
+DISCOVERY_METHODS = ('mDNS', 'CUPS', 'Network Scan')
+
+# 取消發現時，網路掃描檢查取消信號的間隔（秒）
+CANCEL_POLL_SECONDS = 0.05
+
+# 確認 Brother 打印機的 SNMP 查詢: hrDeviceDescr（例如 "Brother QL-820NWB"），不支援時使用 sysDescr
+OID_HR_DEVICE_DESCR = '1.3.6.1.2.1.25.3.2.1.3.1'
+OID_SYS_DESCR = '1.3.6.1.2.1.1.1.0'
+
+
+# mDNS 瀏覽的服務類型
+MDNS_SERVICE_TYPES = [
+    '_pdl-datastream._tcp.local.',  # Brother 打印服務
+    '_printer._tcp.local.',          # 通用打印服務
+    '_ipp._tcp.local.',              # IPP 打印服務
+]
+
+
+class MdnsPrinterBrowser:
+    """
+    持續運行的 mDNS 瀏覽器
+    維護 Brother 打印機的即時註冊表，包括 IP 變更和離線
+    on_change(event, printer) 在 'added' / 'updated' / 'removed' 時調用
+    """
+    
+    def __init__(self, service_types: Optional[List[str]] = None,
+                 on_change: Optional[Callable[[str, Dict], None]] = None):
+        self.service_types = service_types or list(MDNS_SERVICE_TYPES)
+        self.on_change = on_change
+        self.started_at = None
+        self._zeroconf = None
+        self._browsers = []
+        self._registry = {}  # (service_type, name) -> printer
+        self._lock = threading.Lock()
+        self._found = threading.Event()
+    
+    @property
+    def running(self) -> bool:
+        return self._zeroconf is not None
+    
+    def start(self):
+        if not ZEROCONF_AVAILABLE or self.running:
+            return
+        self._zeroconf = Zeroconf()
+        self.started_at = time.time()
+        self._browsers = [ServiceBrowser(self._zeroconf, service_type, self) for service_type in self.service_types]
+    
+    def stop(self):
+        if not self.running:
+            return
+        for browser in self._browsers:
+            browser.cancel()
+        self._browsers = []
+        self._zeroconf.close()
+        self._zeroconf = None
+    
+    def _resolve(self, zeroconf, service_type, name) -> Optional[Dict]:
+        # 檢查是否為 Brother 打印機
+        if 'brother' not in name.lower() and 'ql' not in name.lower():
+            return None
+        info = zeroconf.get_service_info(service_type, name)
+        if not info or not info.addresses:
+            return None
+        return {
+            'ip': socket.inet_ntoa(info.addresses[0]),
+            'name': name,
+            'port': info.port,
+            'method': 'mDNS',
+            'type': service_type
+        }
+    
+    def _notify(self, event, printer):
+        if self.on_change:
+            try:
+                self.on_change(event, printer)
+            except Exception as e:
+                print(f"❌ mDNS 事件處理錯誤: {e}")
+    
+    # 以下三個方法為 zeroconf ServiceListener 接口
+    def add_service(self, zeroconf, service_type, name):
+        printer = self._resolve(zeroconf, service_type, name)
+        if not printer:
+            return
+        with self._lock:
+            self._registry[(service_type, name)] = printer
+        self._found.set()
+        print(f"📡 mDNS 發現打印機: {name} ({printer['ip']})")
+        self._notify('added', printer)
+    
+    def update_service(self, zeroconf, service_type, name):
+        printer = self._resolve(zeroconf, service_type, name)
+        if not printer:
+            return
+        with self._lock:
+            previous = self._registry.get((service_type, name))
+            self._registry[(service_type, name)] = printer
+        self._found.set()
+        if previous and previous['ip'] != printer['ip']:
+            print(f"📡 mDNS 打印機 IP 變更: {name} {previous['ip']} -> {printer['ip']}")
+            self._notify('removed', previous)
+        self._notify('updated', printer)
+    
+    def remove_service(self, zeroconf, service_type, name):
+        with self._lock:
+            printer = self._registry.pop((service_type, name), None)
+            # 同一台打印機可能以多種服務類型廣播，全部消失後才算離線
+            still_present = printer and any(p['ip'] == printer['ip'] for p in self._registry.values())
+        if printer and not still_present:
+            print(f"📴 mDNS 打印機離線: {name} ({printer['ip']})")
+            self._notify('removed', printer)
+    
+    def printers(self) -> List[Dict]:
+        """當前在線的打印機（按 IP 去重）"""
+        with self._lock:
+            unique = {}
+            for printer in self._registry.values():
+                unique.setdefault(printer['ip'], dict(printer))
+            return list(unique.values())
+    
+    def wait_for_printers(self, timeout: float) -> bool:
+        """
+        剛啟動時等待第一個打印機出現，最多等到啟動後 timeout 秒
+        """
+        if self._found.is_set() or not self.started_at:
+            return self._found.is_set()
+        remaining = self.started_at + timeout - time.time()
+        return self._found.wait(max(0, remaining))
+    
+    def stats(self) -> Dict:
+        return {
+            'running': self.running,
+            'started_at': self.started_at,
+            'printers': len(self.printers()),
+        }
 
 
 class PrinterDiscovery:
@@ -31,11 +193,8 @@ class PrinterDiscovery:
     
     def __init__(self):
         self.discovered_printers = []
-        self.brother_service_types = [
-            '_pdl-datastream._tcp.local.',  # Brother 打印服務
-            '_printer._tcp.local.',          # 通用打印服務
-            '_ipp._tcp.local.',              # IPP 打印服務
-        ]
+        self.last_source = None
+        self.brother_service_types = list(MDNS_SERVICE_TYPES)
     
     def get_local_network_range(self) -> List[str]:
         """
@@ -63,71 +222,47 @@ class PrinterDiscovery:
             except Exception as e:
                 print(f"獲取網路範圍錯誤: {e}")
         
-        # 如果無法自動獲取，使用常見的私有 IP 範圍
+        # 如果無法自動獲取，從本機地址和 ARP 表推算 /24 網段，都沒有時才使用常見的私有 IP 範圍
         if not ranges:
-            ranges = [
-                '192.168.1.0/24',
-                '192.168.0.0/24',
-                '10.0.0.0/24',
-                '172.16.0.0/24'
-            ]
+            ranges, blind = plan_ranges([], read_neighbours())
+            if blind:
+                print("⚠️  無法取得本地網路範圍，掃描常見的私有網段")
         
         return ranges
     
-    def discover_via_mdns(self, timeout=5) -> List[Dict]:
+    def discover_via_mdns(self, timeout=5, on_printer: Optional[Callable[[Dict], None]] = None,
+                          cancel: Optional[threading.Event] = None) -> List[Dict]:
         """
         方法 1: 使用 mDNS/Bonjour 發現打印機
         這是 Brother 打印機最常用的發現方式
+        如果持續運行的 mDNS 瀏覽器已啟動，直接返回其註冊表
+        on_printer(printer) 在每發現一台打印機時立即調用；cancel 被設置時提前結束等待
         """
         if not ZEROCONF_AVAILABLE:
             return []
         
         discovered = []
         
-        class PrinterListener:
-            def __init__(self):
-                self.printers = []
-            
-            def add_service(self, zeroconf, service_type, name):
-                info = zeroconf.get_service_info(service_type, name)
-                if info:
-                    # 檢查是否為 Brother 打印機
-                    if 'brother' in name.lower() or 'ql' in name.lower():
-                        ip = socket.inet_ntoa(info.addresses[0]) if info.addresses else None
-                        if ip:
-                            self.printers.append({
-                                'ip': ip,
-                                'name': name,
-                                'port': info.port,
-                                'method': 'mDNS',
-                                'type': service_type
-                            })
-            
-            def remove_service(self, zeroconf, service_type, name):
-                pass
-            
-            def update_service(self, zeroconf, service_type, name):
-                pass
-        
         try:
-            zeroconf = Zeroconf()
-            listener = PrinterListener()
-            
-            # 瀏覽所有 Brother 相關服務
-            browsers = []
-            for service_type in self.brother_service_types:
-                browser = ServiceBrowser(zeroconf, service_type, listener)
-                browsers.append(browser)
-            
-            # 等待發現
-            time.sleep(timeout)
-            
-            # 清理
-            for browser in browsers:
-                browser.cancel()
-            zeroconf.close()
+            shared = get_mdns_browser(start=False)
+            if shared and shared.running:
+                # 瀏覽器剛啟動時，最多等到啟動後 timeout 秒
+                shared.wait_for_printers(timeout)
+                discovered = shared.printers()
+            else:
+                def on_change(event, printer):
+                    if event != 'removed' and on_printer:
+                        on_printer(printer)
+                
+                browser = MdnsPrinterBrowser(self.brother_service_types, on_change=on_change)
+                browser.start()
+                
+                # 等待發現（被取消時提前結束）
+                (cancel or threading.Event()).wait(timeout)
+                
+                discovered = browser.printers()
+                browser.stop()
             
-            discovered = listener.printers
             print(f"✅ mDNS 發現 {len(discovered)} 個打印機")
             
         except Exception as e:
@@ -139,7 +274,37 @@ class PrinterDiscovery:
         """
         方法 2: 透過 CUPS 查詢已安裝的打印機
         適用於 Mac/Linux 系統
+        以一個 IPP CUPS-Get-Printers 請求取得所有打印機及其 device-uri（CUPS_CLIENT=lpr 時調用 lpstat）
         """
+        if CUPS_CLIENT == 'lpr':
+            return self._discover_via_lpstat()
+        
+        discovered = []
+        try:
+            for printer in get_ipp_client().get_printers():
+                uri = printer.get('device-uri') or ''
+                # 從 URI 中提取 IP
+                uri_match = re.search(r'://([0-9.]+)', uri)
+                if uri_match:
+                    discovered.append({
+                        'ip': uri_match.group(1),
+                        'name': printer.get('printer-name'),
+                        'port': 9100,
+                        'method': 'CUPS',
+                        'uri': uri,
+                        'state': printer.get('printer-state')
+                    })
+            
+            if discovered:
+                print(f"✅ CUPS 發現 {len(discovered)} 個打印機")
+        
+        except (IPPError, OSError) as e:
+            print(f"⚠️  CUPS 查詢失敗（cupsd 未運行？）: {e}")
+        
+        return discovered
+    
+    def _discover_via_lpstat(self) -> List[Dict]:
+        """以 lpstat 子進程查詢（每台打印機再調用一次 lpstat -v）"""
         discovered = []
         
         try:
@@ -204,111 +369,323 @@ class PrinterDiscovery:
         except:
             return False
     
-    def discover_via_network_scan(self, timeout_per_ip: float = 0.5) -> List[Dict]:
+    async def probe_host_async(self, ip: str, ports: List[int], timeout: float,
+                               semaphore: asyncio.Semaphore) -> Optional[Dict]:
         """
-        方法 3: 掃描網路尋找打印機端口（9100, 515, 631）
-        這是最通用的方法，但可能較慢
+        並發探測單個主機的所有端口
+        返回按 ports 順序第一個開放的端口，沒有則返回 None
         """
-        discovered = []
-        printer_ports = [9100, 515, 631]  # 常見的打印端口
-        
-        network_ranges = self.get_local_network_range()
+        async def probe(port):
+            async with semaphore:
+                try:
+                    _, writer = await asyncio.wait_for(asyncio.open_connection(ip, port), timeout)
+                except (OSError, asyncio.TimeoutError):
+                    return False
+                writer.close()
+                try:
+                    await writer.wait_closed()
+                except OSError:
+                    pass
+                return True
         
-        print(f"🔍 開始掃描網路... (範圍: {len(network_ranges)} 個)")
+        open_ports = await asyncio.gather(*(probe(port) for port in ports))
+        for port, is_open in zip(ports, open_ports):
+            if is_open:
+                return {
+                    'ip': ip,
+                    'port': port,
+                    'method': 'Network Scan',
+                    'name': f'Printer at {ip}'
+                }
+        return None
+    
+    async def scan_hosts_async(self, hosts: Iterable[str], ports: Optional[List[int]] = None,
+                               timeout_per_ip: float = 0.5,
+                               concurrency: int = SCAN_CONCURRENCY,
+                               confirm: Optional[Callable[[Dict], Awaitable[None]]] = None) -> AsyncIterator[Dict]:
+        """
+        異步掃描主機列表，按完成順序逐個產出發現的打印機
+        concurrency 為同時進行的 TCP 連接數上限: 固定數量的探測協程（每個主機探測所有端口）
+        按順序從 hosts 取出下一個主機，hosts 可以是惰性的迭代器（例如 ScanPlan.sweep()），
+        不會為整個網段預先創建任務
+        confirm(printer) 在產出前調用（例如確認是否為 Brother 打印機），在各探測協程中進行
+        """
+        ports = ports or PRINTER_PORTS
+        semaphore = asyncio.Semaphore(concurrency)
+        hosts = iter(hosts)
+        # 探測協程的結果: 打印機、None（協程已結束）或異常
+        results = asyncio.Queue()
         
-        for network_str in network_ranges:
+        async def worker():
             try:
-                network = ipaddress.IPv4Network(network_str, strict=False)
-                print(f"   掃描 {network_str}...")
-                
-                # 使用多線程加速掃描
-                threads = []
-                results = []
-                
-                def scan_ip(ip_str):
-                    for port in printer_ports:
-                        if self.check_printer_port(ip_str, port, timeout_per_ip):
-                            results.append({
-                                'ip': ip_str,
-                                'port': port,
-                                'method': 'Network Scan',
-                                'name': f'Printer at {ip_str}'
-                            })
-                            break  # 找到一個端口就足夠了
-                
-                # 限制線程數量，避免過載
-                for ip in network.hosts():
-                    if len(threads) >= 50:  # 最多 50 個並發線程
-                        for t in threads:
-                            t.join()
-                        threads = []
-                    
-                    t = threading.Thread(target=scan_ip, args=(str(ip),))
-                    t.start()
-                    threads.append(t)
-                
-                # 等待所有線程完成
-                for t in threads:
-                    t.join()
-                
+                for ip in hosts:
+                    printer = await self.probe_host_async(ip, ports, timeout_per_ip, semaphore)
+                    if printer and confirm:
+                        await confirm(printer)
+                    if printer:
+                        results.put_nowait(printer)
             except Exception as e:
-                print(f"   掃描 {network_str} 時出錯: {e}")
+                results.put_nowait(e)
+            finally:
+                results.put_nowait(None)
+        
+        workers = [asyncio.ensure_future(worker()) for _ in range(max(1, concurrency // len(ports)))]
+        running = len(workers)
+        try:
+            while running:
+                result = await results.get()
+                if result is None:
+                    running -= 1
+                elif isinstance(result, Exception):
+                    raise result
+                else:
+                    yield result
+        finally:
+            # 調用方提前停止時取消正在進行的探測，其餘主機不再從 hosts 取出
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+    
+    def iter_network_hosts(self, network_ranges: Optional[List[str]] = None) -> Iterator[str]:
+        """列出所有本地網路範圍內的主機（去重，多個範圍交錯產出）"""
+        return ScanPlan(network_ranges or self.get_local_network_range(), neighbours={}).sweep()
+    
+    def plan_network_scan(self, known_ips: Iterable[str] = ()) -> ScanPlan:
+        """
+        網路掃描計劃: 已知打印機（參數和發現緩存中的 IP）和 ARP 表中的主機先探測，
+        再掃描各網路範圍的其餘主機
+        """
+        cached = [entry['ip'] for entry in get_printer_cache().entries()]
+        return ScanPlan(self.get_local_network_range(), list(known_ips) + cached)
+    
+    async def confirm_brother_async(self, printer: Dict, plan: ScanPlan, timeout: float = 0.5):
+        """
+        確認開放打印端口的主機是否為 Brother 打印機，確認後設置 printer['confirmed'] 和名稱:
+        發現緩存中記錄為 Brother 的 IP、Brother 的 MAC 前綴，或 SNMP 設備描述
+        """
+        ip = printer['ip']
+        cached = next((entry for entry in get_printer_cache().entries() if entry['ip'] == ip), None)
+        if cached and self.is_brother_ql(cached):
+            printer.update(name=cached.get('name'), confirmed=True)
+            return
+        if is_brother_mac(plan.mac_for(ip)):
+            printer.update(name=f'Brother printer at {ip}', confirmed=True)
+            return
+        
+        description = await asyncio.get_running_loop().run_in_executor(None, self.snmp_description, ip, timeout)
+        if description and 'brother' in description.lower():
+            printer.update(name=description, confirmed=True)
+        elif description:
+            printer['description'] = description
+    
+    @staticmethod
+    def snmp_description(ip: str, timeout: float = 0.5) -> Optional[str]:
+        """
+        以 SNMP 查詢設備描述: hrDeviceDescr（例如 "Brother QL-820NWB"），不支援時使用 sysDescr
+        沒有啟用 SNMP 時返回 None
+        """
+        for oid in (OID_HR_DEVICE_DESCR, OID_SYS_DESCR):
+            try:
+                values = snmp_get(ip, [oid], SNMP_COMMUNITY, timeout=timeout)
+            except TimeoutError:
+                return None  # 沒有啟用 SNMP
+            except (OSError, ValueError):
+                if oid == OID_HR_DEVICE_DESCR:
+                    continue
+                return None
+            description = values.get(oid, (None, b''))[1]
+            if isinstance(description, bytes):
+                description = description.decode(errors='replace').strip()
+            if description:
+                return description
+        return None
+    
+    async def scan_plan_async(self, plan: ScanPlan, timeout_per_ip: float = 0.5,
+                              concurrency: int = SCAN_CONCURRENCY, stop_early: bool = False) -> AsyncIterator[Dict]:
+        """
+        按掃描計劃探測，逐個產出發現的打印機
+        stop_early 時，優先主機中已確認有 Brother 打印機則不再掃描子網；
+        掃描子網時確認找到 Brother 打印機後立即停止
+        """
+        async def confirm(printer):
+            await self.confirm_brother_async(printer, plan, timeout_per_ip)
+        
+        found_brother = False
+        for phase, hosts in (('priority', plan.priority), ('sweep', None)):
+            if phase == 'sweep':
+                if stop_early and found_brother:
+                    print("   ⏹️  已確認 Brother 打印機，跳過子網掃描")
+                    return
+                hosts = plan.sweep()
+            scan = self.scan_hosts_async(hosts, timeout_per_ip=timeout_per_ip, concurrency=concurrency, confirm=confirm)
+            try:
+                async for printer in scan:
+                    yield printer
+                    found_brother = found_brother or bool(printer.get('confirmed'))
+                    if phase == 'sweep' and stop_early and found_brother:
+                        print(f"   ⏹️  已確認 Brother 打印機 {printer['ip']}，停止掃描")
+                        return
+            finally:
+                await scan.aclose()
+    
+    def discover_via_network_scan(self, timeout_per_ip: float = 0.5,
+                                  concurrency: int = SCAN_CONCURRENCY, stop_early: bool = False,
+                                  known_ips: Iterable[str] = (),
+                                  on_printer: Optional[Callable[[Dict], None]] = None,
+                                  cancel: Optional[threading.Event] = None) -> List[Dict]:
+        """
+        方法 3: 掃描網路尋找打印機端口（9100, 515, 631）
+        先探測已知打印機和 ARP 表中的主機，再以 asyncio 並發掃描所有網路範圍（多個範圍交錯進行）
+        stop_early 時確認找到 Brother 打印機後不再掃描其餘主機
+        on_printer(printer) 在每發現一台打印機時立即調用；cancel 被設置時停止掃描
+        """
+        plan = self.plan_network_scan(known_ips)
+        stats = plan.stats()
+        print(f"🔍 開始掃描網路... (範圍: {len(stats['ranges'])} 個, 優先主機: {stats['priority']} 個, "
+              f"並發: {concurrency})")
+        
+        async def collect():
+            found = []
+            
+            async def consume():
+                async for printer in self.scan_plan_async(
+                        plan, timeout_per_ip=timeout_per_ip, concurrency=concurrency, stop_early=stop_early):
+                    found.append(printer)
+                    if on_printer:
+                        on_printer(printer)
+            
+            task = asyncio.ensure_future(consume())
+            while not task.done():
+                if cancel is not None and cancel.is_set():
+                    task.cancel()
+                    break
+                await asyncio.wait({task}, timeout=CANCEL_POLL_SECONDS)
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+            return found
+        
+        discovered = []
+        try:
+            discovered = asyncio.run(collect())
+        except Exception as e:
+            print(f"   掃描網路時出錯: {e}")
         
-        discovered = results
         if discovered:
             print(f"✅ 網路掃描發現 {len(discovered)} 個可能的打印機")
         
         return discovered
     
-    def discover_via_snmp(self) -> List[Dict]:
+    def discover_via_snmp(self, hosts: Optional[Iterable[str]] = None, timeout: float = 0.5) -> List[Dict]:
         """
-        方法 4: 使用 SNMP 查詢打印機信息
-        需要安裝 python-netsnmp 或 pysnmp
+        方法 4: 以 SNMP 查詢主機的設備描述，返回描述中包含 Brother 的打印機
+        hosts 默認為發現緩存和 ARP 表中的主機（SNMP 需要在打印機網頁設置中啟用）
         """
-        discovered = []
+        if hosts is None:
+            hosts = [entry['ip'] for entry in get_printer_cache().entries()] + list(read_neighbours())
+        hosts = list(dict.fromkeys(hosts))
+        if not hosts:
+            return []
         
-        # 這裡可以實現 SNMP 查詢
-        # 需要額外的依賴: pysnmp
-        # 暫時跳過，因為需要額外配置
+        with ThreadPoolExecutor(max_workers=min(32, len(hosts))) as executor:
+            descriptions = list(executor.map(lambda ip: self.snmp_description(ip, timeout), hosts))
         
+        discovered = [
+            {'ip': ip, 'port': 9100, 'name': description, 'method': 'SNMP'}
+            for ip, description in zip(hosts, descriptions)
+            if description and 'brother' in description.lower()
+        ]
+        if discovered:
+            print(f"✅ SNMP 發現 {len(discovered)} 個 Brother 打印機")
         return discovered
     
-    def discover_all(self, use_mdns=True, use_cups=True, use_scan=True, scan_timeout=0.5) -> List[Dict]:
+    def iter_discover(self, use_mdns=True, use_cups=True, use_scan=True, scan_timeout=0.5,
+                      on_progress: Optional[Callable[[str, List[Dict]], None]] = None,
+                      scan_stop_early: bool = False) -> Iterator[Dict]:
         """
-        使用所有可用方法發現打印機
-        返回去重後的打印機列表
+        同時運行所有發現方法，按發現順序逐個產出打印機（按 IP 去重）
+        同一 IP 之後由優先順序更高的方法（見 DISCOVERY_METHODS）發現時再次產出，調用方以後者為準
+        on_progress(method, printers) 在每個方法完成後調用（在迭代的線程中）
+        提前停止迭代（或關閉生成器）時取消其餘的發現方法
         """
-        all_printers = []
+        methods = []
+        if use_mdns:
+            methods.append(('mDNS', lambda emit, cancel: self.discover_via_mdns(
+                timeout=5, on_printer=emit, cancel=cancel)))
+        if use_cups:
+            methods.append(('CUPS', lambda emit, cancel: self.discover_via_cups()))
+        if use_scan:
+            methods.append(('Network Scan', lambda emit, cancel: self.discover_via_network_scan(
+                timeout_per_ip=scan_timeout, stop_early=scan_stop_early, on_printer=emit, cancel=cancel)))
         
-        print("🔍 開始發現打印機...")
-        print("=" * 50)
+        events = queue.Queue()
+        cancel = threading.Event()
         
-        # 方法 1: mDNS (最快，最準確)
-        if use_mdns:
-            print("📡 方法 1: mDNS/Bonjour 發現...")
-            mdns_printers = self.discover_via_mdns(timeout=5)
-            all_printers.extend(mdns_printers)
+        def run(method, discover):
+            start = time.perf_counter()
+            try:
+                printers = discover(lambda printer: events.put(('printer', method, printer)), cancel)
+            except Exception as e:
+                print(f"❌ {method} 發現錯誤: {e}")
+                printers = []
+            # 被取消的方法不記錄耗時（不完整）
+            if not cancel.is_set():
+                record_discovery(method, time.perf_counter() - start, len(printers))
+            events.put(('done', method, printers))
         
-        # 方法 2: CUPS 查詢
-        if use_cups:
-            print("\n💻 方法 2: CUPS 查詢...")
-            cups_printers = self.discover_via_cups()
-            all_printers.extend(cups_printers)
+        for method, discover in methods:
+            threading.Thread(target=run, args=(method, discover), name=f'discover-{method}', daemon=True).start()
         
-        # 方法 3: 網路掃描（最慢，但最全面）
-        if use_scan:
-            print("\n🌐 方法 3: 網路掃描...")
-            scan_printers = self.discover_via_network_scan(timeout_per_ip=scan_timeout)
-            all_printers.extend(scan_printers)
+        best = {}  # IP -> 方法優先順序
+        pending = len(methods)
+        try:
+            while pending:
+                kind, method, data = events.get()
+                # 方法完成時返回的打印機也逐個檢查（例如 CUPS 沒有逐個通知）
+                for printer in (data if kind == 'done' else [data]):
+                    ip = printer.get('ip')
+                    rank = DISCOVERY_METHODS.index(method)
+                    if not ip or best.get(ip, len(DISCOVERY_METHODS)) <= rank:
+                        continue
+                    best[ip] = rank
+                    yield dict(printer, method=printer.get('method') or method)
+                if kind == 'done':
+                    pending -= 1
+                    if on_progress:
+                        on_progress(method, data)
+        finally:
+            cancel.set()
+    
+    def discover_all(self, use_mdns=True, use_cups=True, use_scan=True, scan_timeout=0.5,
+                     on_progress: Optional[Callable[[str, List[Dict]], None]] = None,
+                     scan_stop_early: bool = False, first_match: bool = False,
+                     on_printer: Optional[Callable[[Dict], None]] = None) -> List[Dict]:
+        """
+        使用所有可用方法發現打印機（各方法同時運行）
+        返回去重後的打印機列表（mDNS、CUPS、網路掃描的順序）
+        on_progress(method, printers) 在每個方法完成後調用，on_printer(printer) 在每發現一台打印機時調用
+        scan_stop_early 時網路掃描確認找到 Brother 打印機後停止（查找打印機時使用，列出所有打印機時不使用）
+        first_match 時找到第一台 Brother QL 打印機後立即返回，並取消其餘的發現方法
+        """
+        print("🔍 開始發現打印機...")
+        print("=" * 50)
         
-        # 去重（基於 IP）
         unique_printers = {}
-        for printer in all_printers:
-            ip = printer.get('ip')
-            if ip and ip not in unique_printers:
-                unique_printers[ip] = printer
+        discoveries = self.iter_discover(use_mdns, use_cups, use_scan, scan_timeout, on_progress, scan_stop_early)
+        try:
+            for printer in discoveries:
+                unique_printers[printer['ip']] = printer
+                if on_printer:
+                    on_printer(printer)
+                if first_match and self.is_brother_ql(printer):
+                    print(f"⏹️  找到 Brother 打印機 {printer['ip']}（{printer['method']}），取消其餘發現方法")
+                    break
+        finally:
+            discoveries.close()
         
-        result = list(unique_printers.values())
+        rank = {method: index for index, method in enumerate(DISCOVERY_METHODS)}
+        result = sorted(unique_printers.values(), key=lambda p: rank.get(p.get('method'), len(rank)))
         
         print("\n" + "=" * 50)
         print(f"✅ 總共發現 {len(result)} 個打印機:")
@@ -317,30 +694,125 @@ class PrinterDiscovery:
         
         return result
     
-    def find_brother_ql820nwb(self) -> Optional[Dict]:
+    @staticmethod
+    def is_brother_ql(printer: Dict) -> bool:
         """
-        專門查找 Brother QL-820NWB 打印機
+        根據名稱判斷是否為 Brother QL 系列打印機
+        """
+        name = printer.get('name', '').lower()
+        return 'ql' in name or '820' in name or 'brother' in name
+    
+    @classmethod
+    def select_brother_ql820nwb(cls, all_printers: List[Dict]) -> Optional[Dict]:
+        """
+        從打印機列表中選出最可能是 Brother QL-820NWB 的打印機
         """
-        all_printers = self.discover_all()
-        
         # 優先選擇名稱包含 "QL" 或 "820" 的打印機
         for printer in all_printers:
-            name = printer.get('name', '').lower()
-            if 'ql' in name or '820' in name or 'brother' in name:
+            if cls.is_brother_ql(printer):
                 return printer
         
         # 如果沒找到，返回第一個（可能是，也可能不是）
         return all_printers[0] if all_printers else None
+    
+    def find_brother_ql820nwb(self, use_cache: bool = False, force_refresh: bool = False) -> Optional[Dict]:
+        """
+        專門查找 Brother QL-820NWB 打印機（找到第一台 Brother QL 打印機後立即返回）
+        use_cache 為 True 時優先使用緩存的結果
+        """
+        if use_cache:
+            printers = self.discover_cached(force_refresh=force_refresh, scan_stop_early=SCAN_STOP_EARLY,
+                                            first_match=True)
+            # 緩存中沒有 Brother 打印機時進行完整發現
+            if not force_refresh and self.last_source != 'discovery' and not any(map(self.is_brother_ql, printers)):
+                printers = self.discover_cached(force_refresh=True, scan_stop_early=SCAN_STOP_EARLY, first_match=True)
+            return self.select_brother_ql820nwb(printers)
+        return self.select_brother_ql820nwb(self.discover_all(scan_stop_early=SCAN_STOP_EARLY, first_match=True))
+    
+    def revalidate(self, printers: List[Dict], timeout: float = 0.5) -> List[Dict]:
+        """
+        對已知打印機各做一次端口探測（並發），返回仍然在線的打印機
+        """
+        if not printers:
+            return []
+        
+        async def probe_all():
+            semaphore = asyncio.Semaphore(SCAN_CONCURRENCY)
+            return await asyncio.gather(*(
+                self.probe_host_async(p['ip'], [p.get('port') or 9100], timeout, semaphore)
+                for p in printers
+            ))
+        
+        start = time.perf_counter()
+        results = asyncio.run(probe_all())
+        alive = [printer for printer, alive in zip(printers, results) if alive]
+        record_discovery('Revalidate', time.perf_counter() - start, len(alive))
+        return alive
+    
+    def discover_cached(self, force_refresh: bool = False, cache: Optional[PrinterCache] = None,
+                        **kwargs) -> List[Dict]:
+        """
+        使用持久化緩存發現打印機:
+        1. 緩存有效期內的結果直接返回
+        2. 過期的條目先各做一次端口探測，仍在線則返回
+        3. 以上都沒有結果（或 force_refresh）時才進行完整發現
+        first_match 或 scan_stop_early（後台自動發現、查找 Brother 打印機）的結果可能只是部分列表:
+        合併到緩存中，但不會作為列出所有打印機時的緩存結果；
+        列出所有打印機時，只有做過完整發現才使用緩存
+        self.last_source 記錄結果來源: cache / revalidated / discovery
+        """
+        cache = cache or get_printer_cache()
+        complete = not (kwargs.get('first_match') or kwargs.get('scan_stop_early'))
+        
+        if not force_refresh and (cache.complete_at is not None or not complete):
+            fresh = cache.fresh(complete=complete)
+            if fresh:
+                self.last_source = 'cache'
+                return fresh
+            
+            alive = self.revalidate(cache.entries())
+            if alive:
+                alive_ips = {p['ip'] for p in alive}
+                cache.touch(alive_ips, complete=complete)
+                print(f"✅ 緩存中 {len(alive)} 個打印機重新驗證成功")
+                self.last_source = 'revalidated'
+                return [entry for entry in cache.entries() if entry['ip'] in alive_ips]
+        
+        printers = self.discover_all(**kwargs)
+        cache.record(printers, complete=complete)
+        self.last_source = 'discovery'
+        return printers
+
+
+_mdns_browser = None
+_mdns_browser_lock = threading.Lock()
+
+
+def get_mdns_browser(start: bool = True, on_change: Optional[Callable[[str, Dict], None]] = None) -> Optional[MdnsPrinterBrowser]:
+    """
+    返回進程內共享的 mDNS 瀏覽器
+    start 為 True 時如尚未運行則啟動
+    """
+    global _mdns_browser
+    with _mdns_browser_lock:
+        if _mdns_browser is None and start and ZEROCONF_AVAILABLE:
+            _mdns_browser = MdnsPrinterBrowser(on_change=on_change)
+        if _mdns_browser is not None:
+            if on_change:
+                _mdns_browser.on_change = on_change
+            if start:
+                _mdns_browser.start()
+        return _mdns_browser
 
 
 # 便捷函數
-def discover_printer_ip() -> Optional[str]:
+def discover_printer_ip(force_refresh: bool = False) -> Optional[str]:
     """
-    快速發現打印機 IP
+    快速發現打印機 IP（優先使用緩存）
     返回第一個找到的打印機 IP，或 None
     """
     discovery = PrinterDiscovery()
-    printer = discovery.find_brother_ql820nwb()
+    printer = discovery.find_brother_ql820nwb(use_cache=True, force_refresh=force_refresh)
     return printer.get('ip') if printer else None
 
 
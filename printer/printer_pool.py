@@ -0,0 +1,222 @@
+"""
+打印機池模組
+管理多台 Brother QL 打印機，每台打印機有獨立的發送隊列，
+任務發送到負載最低的健康打印機，失敗時自動轉到其他打印機重試；
+發送隊列按優先級排序，現場報到的標籤插在批量標籤之前
+"""
+
+import itertools
+import queue
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+
+class PooledPrinter:
+    """打印機池中的單台打印機"""
+
+    def __init__(self, ip: str, port: int = 9100, name: Optional[str] = None, method: Optional[str] = None):
+        self.ip = ip
+        self.port = port
+        self.name = name or f'Printer at {ip}'
+        self.method = method
+        self.healthy = True
+        self.pending = 0
+        self.sent = 0
+        self.failed = 0
+        self.consecutive_failures = 0
+        self.last_error = None
+        self.last_failure_at = None
+        self.status_error = None  # 狀態監控報告的錯誤（例如缺紙），恢復前不分配任務
+        self.busy = False
+        self.queue = queue.PriorityQueue()  # (優先級, 序號, 任務)
+        self.thread = None
+
+    def to_dict(self) -> Dict:
+        return {
+            'ip': self.ip,
+            'port': self.port,
+            'name': self.name,
+            'method': self.method,
+            'healthy': self.healthy,
+            'pending': self.pending,
+            'sent': self.sent,
+            'failed': self.failed,
+            'last_error': self.last_error,
+            'status_error': self.status_error,
+            'busy': self.busy,
+        }
+
+
+class PrinterPool:
+    """
+    打印機池
+    send_func(data, ip, port) 負責實際發送，返回是否成功
+    """
+
+    def __init__(self, send_func: Callable[[bytes, str, int], bool], max_failures: int = 2,
+                 retry_after: float = 30.0):
+        self.send_func = send_func
+        self.max_failures = max_failures  # 連續失敗多少次後標記為不健康
+        self.retry_after = retry_after    # 不健康的打印機多少秒後重新嘗試
+        self._printers = {}
+        self._lock = threading.Lock()
+        self._sequence = itertools.count()  # 同一優先級按提交順序
+
+    def add(self, ip: str, port: int = 9100, name: Optional[str] = None, method: Optional[str] = None) -> PooledPrinter:
+        """加入打印機（已存在則更新名稱並恢復為健康狀態）"""
+        with self._lock:
+            printer = self._printers.get(ip)
+            if printer:
+                printer.name = name or printer.name
+                printer.method = method or printer.method
+                printer.healthy = True
+                printer.consecutive_failures = 0
+                return printer
+
+            printer = PooledPrinter(ip, port, name, method)
+            printer.thread = threading.Thread(target=self._worker, args=(printer,), name=f'printer-{ip}', daemon=True)
+            printer.thread.start()
+            self._printers[ip] = printer
+            print(f"🖨️  打印機池加入: {printer.name} ({ip}:{port})")
+            return printer
+
+    def update(self, printers: List[Dict], port: int = 9100):
+        """
+        根據 PrinterDiscovery.discover_all() 的結果加入打印機
+        """
+        for printer in printers:
+            ip = printer.get('ip')
+            if ip:
+                self.add(ip, port, printer.get('name'), printer.get('method'))
+
+    def remove(self, ip: str) -> bool:
+        with self._lock:
+            printer = self._printers.pop(ip, None)
+        if printer:
+            printer.queue.put((float('inf'), next(self._sequence), None))  # 通知工作線程退出
+        return printer is not None
+
+    def mark_down(self, ip: str, reason: str = '離線') -> bool:
+        """
+        將打印機標記為不健康（例如 mDNS 報告離線），新任務會轉到其他打印機
+        """
+        with self._lock:
+            printer = self._printers.get(ip)
+            if not printer:
+                return False
+            printer.healthy = False
+            printer.last_error = reason
+            printer.last_failure_at = time.time()
+            return True
+
+    def set_status(self, ip: str, error: Optional[str] = None, busy: bool = False) -> bool:
+        """
+        根據狀態監控結果更新打印機: 有錯誤時不再分配任務（轉到其他打印機），恢復後立即可用
+        """
+        with self._lock:
+            printer = self._printers.get(ip)
+            if not printer:
+                return False
+            if printer.status_error and not error:
+                printer.healthy = True
+                printer.consecutive_failures = 0
+            printer.status_error = error
+            printer.busy = busy
+            return True
+
+    def size(self) -> int:
+        with self._lock:
+            return len(self._printers)
+
+    def printers(self) -> List[PooledPrinter]:
+        with self._lock:
+            return list(self._printers.values())
+
+    def _is_available(self, printer: PooledPrinter) -> bool:
+        if printer.status_error:
+            return False
+        if printer.healthy:
+            return True
+        # 不健康的打印機冷卻後允許重新嘗試
+        return printer.last_failure_at is not None and time.time() - printer.last_failure_at >= self.retry_after
+
+    def pick(self, exclude: Tuple[str, ...] = ()) -> Optional[PooledPrinter]:
+        """選擇負載最低的可用打印機"""
+        candidates = [p for p in self.printers() if p.ip not in exclude and self._is_available(p)]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda p: (p.pending + p.busy, not p.healthy, p.sent))
+
+    def send(self, data: bytes, timeout: Optional[float] = None, priority: int = 0) -> Tuple[bool, Optional[str]]:
+        """
+        發送打印數據，失敗時轉到其他打印機重試
+        priority 越小越先發送（見 print_jobs.PRIORITY_RANKS）
+        返回 (是否成功, 打印機 IP)
+        """
+        tried = ()
+        while True:
+            printer = self.pick(exclude=tried)
+            if not printer:
+                return False, tried[-1] if tried else None
+
+            done = threading.Event()
+            outcome = {}
+            with self._lock:
+                printer.pending += 1
+            printer.queue.put((priority, next(self._sequence), (data, done, outcome)))
+
+            if done.wait(timeout) and outcome.get('success'):
+                return True, printer.ip
+
+            tried += (printer.ip,)
+            print(f"⚠️  打印機 {printer.ip} 發送失敗，嘗試其他打印機")
+
+    def _worker(self, printer: PooledPrinter):
+        while True:
+            _, _, task = printer.queue.get()
+            if task is None:
+                break
+            data, done, outcome = task
+            try:
+                success = self.send_func(data, printer.ip, printer.port)
+                error = None if success else '發送失敗'
+            except Exception as e:
+                success = False
+                error = str(e)
+
+            with self._lock:
+                printer.pending -= 1
+            self.record_result(printer.ip, success, error)
+
+            outcome['success'] = success
+            done.set()
+
+    def record_result(self, ip: str, success: bool, error: Optional[str] = None, count: int = 1):
+        """
+        記錄發送結果並更新健康狀態
+        繞過發送隊列直接發送的任務（例如批量串流）也需要調用
+        """
+        with self._lock:
+            printer = self._printers.get(ip)
+            if not printer:
+                return
+            if success:
+                printer.sent += count
+                printer.consecutive_failures = 0
+                printer.healthy = True
+            else:
+                printer.failed += count
+                printer.consecutive_failures += 1
+                printer.last_error = error or '發送失敗'
+                printer.last_failure_at = time.time()
+                if printer.consecutive_failures >= self.max_failures:
+                    printer.healthy = False
+
+    def stats(self) -> Dict:
+        printers = self.printers()
+        return {
+            'count': len(printers),
+            'healthy': sum(1 for p in printers if p.healthy),
+            'printers': [p.to_dict() for p in printers],
+        }
@@ -0,0 +1,435 @@
+"""
+打印機狀態監控模組
+後台線程定期查詢每台打印機的狀態（缺紙、蓋子打開、忙碌等），
+有錯誤的打印機暫停接收任務，任務轉到其他打印機或在隊列中等待恢復
+
+查詢方式:
+- auto: 優先使用 SNMP（不佔用 9100 連接），打印機沒有回應 SNMP 時改用 raster
+- raster: 在 9100 連接上發送 Brother 狀態查詢命令（ESC i S），返回 32 bytes 狀態信息
+- snmp: 以 SNMPv1 查詢 HOST-RESOURCES-MIB 的 hrPrinterStatus 和 hrPrinterDetectedErrorState
+正在接收任務且沒有錯誤的打印機不查詢，只在打印機閒置或報告錯誤時輪詢
+"""
+
+import itertools
+import os
+import socket
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from brother_ql_raster import parse_status
+
+# 查詢方式: auto（優先 SNMP）、raster（9100 狀態查詢）、snmp 或 off
+STATUS_METHOD = os.getenv('PRINTER_STATUS_METHOD', 'auto').lower()
+STATUS_METHODS = ('auto', 'raster', 'snmp', 'off')
+# 輪詢間隔（秒），設為 0 則停用
+STATUS_INTERVAL = float(os.getenv('PRINTER_STATUS_INTERVAL', 10))
+STATUS_TIMEOUT = float(os.getenv('PRINTER_STATUS_TIMEOUT', 2))
+# 有錯誤的打印機，隊列中的任務最多等待恢復的秒數
+ERROR_HOLD_SECONDS = float(os.getenv('PRINTER_ERROR_HOLD', 60))
+
+SNMP_COMMUNITY = os.getenv('PRINTER_SNMP_COMMUNITY', 'public')
+SNMP_PORT = int(os.getenv('PRINTER_SNMP_PORT', 161))
+
+# 錯誤代碼（Brother 狀態信息和 SNMP 共用）及說明
+STATUS_ERROR_MESSAGES = {
+    'no_media': '沒有標籤紙',
+    'end_of_media': '標籤紙用完',
+    'replace_media': '標籤紙不符，請更換',
+    'cutter_jam': '切刀卡紙',
+    'jammed': '卡紙',
+    'cover_open': '蓋子打開',
+    'feed_error': '無法進紙',
+    'printer_off': '打印機已關閉',
+    'offline': '打印機離線',
+    'high_voltage_adapter': '電源適配器錯誤',
+    'fan_error': '風扇錯誤',
+    'expansion_buffer_full': '緩衝區已滿',
+    'communication_error': '通訊錯誤',
+    'communication_buffer_full': '通訊緩衝區已滿',
+    'cancel_key': '已按下取消鍵',
+    'system_error': '系統錯誤',
+    'service_requested': '需要維修',
+    'unreachable': '無法連接打印機',
+}
+
+# 不影響打印的狀態（只作提示）
+STATUS_WARNINGS = frozenset({'low_media'})
+
+# HOST-RESOURCES-MIB
+OID_HR_PRINTER_STATUS = '1.3.6.1.2.1.25.3.5.1.1.1'
+OID_HR_PRINTER_ERRORS = '1.3.6.1.2.1.25.3.5.1.2.1'
+# Printer-MIB: 第一個進紙匣的介質名稱（例如 "62mm"）
+OID_PRT_INPUT_MEDIA_NAME = '1.3.6.1.2.1.43.8.2.1.12.1.1'
+
+# hrPrinterStatus: other(1), unknown(2), idle(3), printing(4), warmup(5)
+HR_PRINTER_PRINTING = 4
+HR_PRINTER_WARMUP = 5
+
+# hrPrinterDetectedErrorState 的位（第一個 byte 的最高位為第 0 位）
+HR_PRINTER_ERRORS = ('low_media', 'no_media', None, None, 'cover_open', 'jammed', 'offline', 'service_requested')
+
+
+# ---- SNMPv1（BER 編碼），只實現 GetRequest 需要的部分 ----
+
+BER_INTEGER = 0x02
+BER_OCTET_STRING = 0x04
+BER_NULL = 0x05
+BER_OID = 0x06
+BER_SEQUENCE = 0x30
+SNMP_GET_REQUEST = 0xA0
+SNMP_GET_RESPONSE = 0xA2
+
+
+def ber_encode(tag: int, payload: bytes) -> bytes:
+    length = len(payload)
+    if length < 0x80:
+        header = bytes((tag, length))
+    else:
+        size = length.to_bytes((length.bit_length() + 7) // 8, 'big')
+        header = bytes((tag, 0x80 | len(size))) + size
+    return header + payload
+
+
+def ber_integer(value: int) -> bytes:
+    return ber_encode(BER_INTEGER, value.to_bytes(max(1, (value.bit_length() + 8) // 8), 'big', signed=True))
+
+
+def ber_oid(oid: str) -> bytes:
+    parts = [int(part) for part in oid.strip('.').split('.')]
+    out = bytearray([parts[0] * 40 + parts[1]])
+    for part in parts[2:]:
+        chunk = [part & 0x7F]
+        part >>= 7
+        while part:
+            chunk.append(0x80 | (part & 0x7F))
+            part >>= 7
+        out.extend(reversed(chunk))
+    return ber_encode(BER_OID, bytes(out))
+
+
+def ber_decode(data: bytes, offset: int = 0) -> Tuple[int, bytes, int]:
+    """解碼一個 BER 元素，返回 (tag, 內容, 下一個元素的位置)；數據不完整或長度超出範圍時拋出 ValueError"""
+    if offset + 2 > len(data):
+        raise ValueError('BER 數據不完整')
+    tag = data[offset]
+    length = data[offset + 1]
+    offset += 2
+    if length & 0x80:
+        size = length & 0x7F
+        if offset + size > len(data):
+            raise ValueError('BER 長度不完整')
+        length = int.from_bytes(data[offset:offset + size], 'big')
+        offset += size
+    if offset + length > len(data):
+        raise ValueError(f'BER 長度 {length} 超出數據範圍')
+    return tag, data[offset:offset + length], offset + length
+
+
+def ber_children(data: bytes) -> List[Tuple[int, bytes]]:
+    children = []
+    offset = 0
+    while offset < len(data):
+        tag, value, offset = ber_decode(data, offset)
+        children.append((tag, value))
+    return children
+
+
+def decode_oid(data: bytes) -> str:
+    if not data:
+        raise ValueError('OID 為空')
+    parts = [data[0] // 40, data[0] % 40]
+    value = 0
+    for byte in data[1:]:
+        value = (value << 7) | (byte & 0x7F)
+        if not byte & 0x80:
+            parts.append(value)
+            value = 0
+    return '.'.join(map(str, parts))
+
+
+def snmp_message(pdu_type: int, request_id: int, varbinds: Iterable[Tuple[str, bytes]],
+                 community: str = SNMP_COMMUNITY, error_status: int = 0) -> bytes:
+    """SNMPv1 消息; varbinds 為 (OID, 已編碼的值)"""
+    bindings = b''.join(ber_encode(BER_SEQUENCE, ber_oid(oid) + value) for oid, value in varbinds)
+    pdu = ber_encode(pdu_type, ber_integer(request_id) + ber_integer(error_status) + ber_integer(0)
+                     + ber_encode(BER_SEQUENCE, bindings))
+    return ber_encode(BER_SEQUENCE, ber_integer(0) + ber_encode(BER_OCTET_STRING, community.encode()) + pdu)
+
+
+def parse_snmp_message(data: bytes) -> Dict:
+    """
+    解析 SNMPv1 消息，返回 {type, request_id, error_status, varbinds: {OID: (tag, 內容)}}
+    不完整或結構錯誤的消息拋出 ValueError（狀態監控視為打印機無法連接）
+    """
+    _, body, _ = ber_decode(data)
+    version, community, (pdu_type, pdu) = ber_children(body)
+    request_id, error_status, _, (_, bindings) = ber_children(pdu)
+    varbinds = {}
+    for _, binding in ber_children(bindings):
+        (_, oid), value = ber_children(binding)
+        varbinds[decode_oid(oid)] = value
+    return {
+        'type': pdu_type,
+        'community': community[1].decode(errors='replace'),
+        'request_id': int.from_bytes(request_id[1], 'big', signed=True),
+        'error_status': int.from_bytes(error_status[1], 'big'),
+        'varbinds': varbinds,
+    }
+
+
+_request_ids = itertools.count(1)
+
+
+def snmp_get(ip: str, oids: List[str], community: str = SNMP_COMMUNITY, port: int = SNMP_PORT,
+             timeout: float = STATUS_TIMEOUT) -> Dict[str, Tuple[int, bytes]]:
+    """SNMPv1 GetRequest，返回 {OID: (tag, 內容)}；超時拋出 socket.timeout"""
+    request_id = next(_request_ids) & 0x7FFFFFFF
+    message = snmp_message(SNMP_GET_REQUEST, request_id, [(oid, ber_encode(BER_NULL, b'')) for oid in oids],
+                           community)
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.settimeout(timeout)
+        sock.sendto(message, (ip, port))
+        deadline = time.monotonic() + timeout
+        while True:
+            sock.settimeout(max(0.001, deadline - time.monotonic()))
+            data, _ = sock.recvfrom(65535)
+            response = parse_snmp_message(data)
+            if response['type'] == SNMP_GET_RESPONSE and response['request_id'] == request_id:
+                if response['error_status']:
+                    raise OSError(f'SNMP 錯誤狀態 {response["error_status"]}')
+                return response['varbinds']
+
+
+def snmp_error_flags(data: bytes) -> List[str]:
+    """hrPrinterDetectedErrorState（BITS）轉為錯誤代碼"""
+    flags = []
+    for index, name in enumerate(HR_PRINTER_ERRORS):
+        if name and index // 8 < len(data) and data[index // 8] & (0x80 >> (index % 8)):
+            flags.append(name)
+    return flags
+
+
+# ---- 狀態查詢 ----
+
+def query_raster_status(connection, timeout: float = STATUS_TIMEOUT, blocking: bool = False) -> Optional[Dict]:
+    """經由 9100 長連接查詢狀態；連接正在打印時返回 None（視為忙碌）"""
+    data = connection.request_status(timeout=timeout, blocking=blocking)
+    if data is None:
+        return None
+    status = parse_status(data)
+    return {
+        'errors': status['errors'],
+        'warnings': [],
+        'busy': status['busy'],
+        'model': status['model'],
+        'media': {
+            'width_mm': status['media_width_mm'],
+            'length_mm': status['media_length_mm'],
+            'type': status['media_type'],
+        },
+    }
+
+
+def query_snmp_status(ip: str, community: str = SNMP_COMMUNITY, port: int = SNMP_PORT,
+                      timeout: float = STATUS_TIMEOUT) -> Dict:
+    values = snmp_get(ip, [OID_HR_PRINTER_STATUS, OID_HR_PRINTER_ERRORS, OID_PRT_INPUT_MEDIA_NAME],
+                      community, port, timeout)
+    printer_status = values.get(OID_HR_PRINTER_STATUS, (None, b''))
+    error_state = values.get(OID_HR_PRINTER_ERRORS, (None, b''))
+    media_name = values.get(OID_PRT_INPUT_MEDIA_NAME, (None, b''))
+    state = int.from_bytes(printer_status[1], 'big') if printer_status[0] == BER_INTEGER else None
+    flags = snmp_error_flags(error_state[1]) if error_state[0] == BER_OCTET_STRING else []
+    return {
+        'errors': [flag for flag in flags if flag not in STATUS_WARNINGS],
+        'warnings': [flag for flag in flags if flag in STATUS_WARNINGS],
+        'busy': state in (HR_PRINTER_PRINTING, HR_PRINTER_WARMUP),
+        'model': None,
+        'media': {'name': media_name[1].decode(errors='replace')} if media_name[0] == BER_OCTET_STRING else None,
+    }
+
+
+def describe_errors(errors: Iterable[str]) -> str:
+    return '、'.join(STATUS_ERROR_MESSAGES.get(error, error) for error in errors)
+
+
+class PrinterStatusMonitor:
+    """
+    打印機狀態監控
+    targets() 返回需要監控的 [(IP, 端口)]；每次查詢後調用 on_update(IP, 狀態)
+    active(IP) 返回打印機是否正在接收任務，正在接收任務且沒有錯誤的打印機跳過查詢
+    """
+
+    def __init__(self, targets: Callable[[], List[Tuple[str, int]]], connections, method: str = STATUS_METHOD,
+                 interval: float = STATUS_INTERVAL, timeout: float = STATUS_TIMEOUT,
+                 on_update: Optional[Callable[[str, Dict], None]] = None,
+                 active: Optional[Callable[[str], bool]] = None, snmp_port: int = SNMP_PORT):
+        self.targets = targets
+        self.connections = connections
+        self.method = method if method in STATUS_METHODS else 'auto'
+        self.interval = interval
+        self.timeout = timeout
+        self.on_update = on_update
+        self.active = active
+        self.snmp_port = snmp_port
+        self._statuses = {}
+        self._raster_ips = set()  # auto: 沒有回應 SNMP、改用 9100 狀態查詢的打印機
+        self._hold_expired = False
+        self._cond = threading.Condition()
+        self._thread = None
+        self.polls = 0
+        self.skipped = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.method != 'off' and self.interval > 0
+
+    def start(self) -> bool:
+        if not self.enabled or self._thread is not None:
+            return False
+        self._thread = threading.Thread(target=self._run, name='printer-status', daemon=True)
+        self._thread.start()
+        return True
+
+    def _run(self):
+        while True:
+            try:
+                self.poll_all()
+            except Exception as e:
+                print(f"⚠️  打印機狀態查詢錯誤: {e}")
+            time.sleep(self.interval)
+
+    def method_for(self, ip: str) -> str:
+        """該打印機使用的查詢方式（raster 或 snmp）"""
+        if self.method == 'auto':
+            return 'raster' if ip in self._raster_ips else 'snmp'
+        return self.method
+
+    def _query(self, ip: str, port: int, method: str) -> Tuple[str, Optional[Dict]]:
+        """返回 (實際使用的查詢方式, 狀態)；9100 連接正在打印時狀態為 None"""
+        if method == 'snmp':
+            try:
+                return 'snmp', query_snmp_status(ip, port=self.snmp_port, timeout=self.timeout)
+            except (OSError, ValueError):
+                if self.method != 'auto':
+                    raise
+            status = query_raster_status(self.connections.get(ip, port), timeout=self.timeout)
+            if status is not None:
+                # 打印機在線但沒有回應 SNMP（未啟用），之後直接使用 9100 狀態查詢
+                print(f"ℹ️  打印機 {ip} 沒有回應 SNMP，改用 9100 狀態查詢")
+                self._raster_ips.add(ip)
+            return 'raster', status
+        return 'raster', query_raster_status(self.connections.get(ip, port), timeout=self.timeout)
+
+    def poll(self, ip: str, port: int = 9100) -> Optional[Dict]:
+        """查詢一台打印機並更新狀態，返回新狀態（9100 連接正在打印時返回 None 並標記為忙碌）"""
+        method = self.method_for(ip)
+        try:
+            method, status = self._query(ip, port, method)
+            if status is None:
+                self._mark_busy(ip)
+                return None
+        except (OSError, ValueError) as e:
+            status = {'errors': ['unreachable'], 'warnings': [], 'busy': False, 'model': None, 'media': None, 'detail': str(e)}
+        self.polls += 1
+        status.update(ip=ip, method=method, checked_at=time.time())
+        status['ready'] = not status['errors']
+        status['reason'] = describe_errors(status['errors']) or None
+        self._update(ip, status)
+        return status
+
+    def poll_all(self, force: bool = False):
+        """
+        查詢所有打印機；正在接收任務且沒有錯誤的打印機跳過（打印中的錯誤由發送失敗處理），
+        force 時全部查詢
+        """
+        for ip, port in self.targets():
+            if not force and self.active and self.is_ready(ip) and self.active(ip):
+                self.skipped += 1
+                self._mark_busy(ip)
+                continue
+            self.poll(ip, port)
+
+    def _mark_busy(self, ip: str):
+        with self._cond:
+            status = self._statuses.get(ip)
+            if status:
+                status['busy'] = True
+
+    def _update(self, ip: str, status: Dict):
+        with self._cond:
+            previous = self._statuses.get(ip)
+            self._statuses[ip] = status
+            if not self.is_blocking(status):
+                self._hold_expired = False
+        if previous is None or previous['errors'] != status['errors']:
+            if status['ready']:
+                if previous and not previous['ready']:
+                    print(f"✅ 打印機 {ip} 已恢復")
+            else:
+                print(f"🛑 打印機 {ip} 暫停: {status['reason']}")
+        if self.on_update:
+            self.on_update(ip, status)
+        # 先更新打印機池再喚醒等待的工作線程，避免喚醒後仍選不到打印機
+        with self._cond:
+            self._cond.notify_all()
+
+    def status(self, ip: str) -> Optional[Dict]:
+        with self._cond:
+            status = self._statuses.get(ip)
+            return dict(status) if status else None
+
+    def is_ready(self, ip: str) -> bool:
+        """未查詢過的打印機視為可用"""
+        status = self.status(ip)
+        return status is None or status['ready']
+
+    @staticmethod
+    def is_blocking(status: Optional[Dict]) -> bool:
+        """
+        打印機報告了錯誤（缺紙、蓋子打開等）
+        無法連接不算: 發送失敗時已有重連和轉到其他打印機的處理，且 CUPS 打印可能不經過網路
+        """
+        return status is not None and not status['ready'] and 'unreachable' not in status['errors']
+
+    def blocked_reason(self, ips: Iterable[str]) -> Optional[str]:
+        """所有打印機都報告錯誤時返回原因，否則返回 None"""
+        reasons = []
+        for ip in ips:
+            status = self.status(ip)
+            if not self.is_blocking(status):
+                return None
+            reasons.append(f"{ip}: {status['reason']}")
+        return '；'.join(reasons) or None
+
+    def wait_ready(self, ips: Callable[[], Iterable[str]], timeout: float = ERROR_HOLD_SECONDS) -> bool:
+        """
+        等待直到至少一台打印機可用（背壓: 打印機有錯誤時工作線程暫停發送，任務留在隊列中）
+        返回是否可用；狀態監控停用時立即返回 True
+        等待超時後，在有打印機恢復之前其他等待立即返回 False，隊列中的任務不會逐個再等待
+        """
+        if not self.enabled:
+            return True
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while True:
+                current = list(ips())
+                if not current or not all(self.is_blocking(self._statuses.get(ip)) for ip in current):
+                    return True
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or self._hold_expired:
+                    self._hold_expired = True
+                    return False
+                self._cond.wait(min(remaining, self.interval))
+
+    def stats(self) -> Dict:
+        with self._cond:
+            statuses = [dict(status) for status in self._statuses.values()]
+        return {
+            'method': self.method,
+            'interval': self.interval,
+            'enabled': self.enabled,
+            'polls': self.polls,
+            'skipped': self.skipped,
+            'printers': statuses,
+        }
@@ -0,0 +1,167 @@
+"""
+網路掃描計劃模組
+決定網路掃描的探測順序: 先探測最可能是打印機的主機（已知打印機 IP、ARP/鄰居表中的主機，
+Brother MAC 前綴優先），再掃描子網的其餘部分；多個網路介面的範圍交錯掃描，而不是一個接一個
+"""
+
+import ipaddress
+import re
+import socket
+import subprocess
+import sys
+import time
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+# Brother Industries 的 MAC 前綴（OUI）
+BROTHER_OUIS = frozenset({'00:80:77', '00:1b:a9', '30:05:5c', '3c:2a:f4', 'b4:22:00'})
+
+# 鄰居表重新讀取的最短間隔（秒）
+NEIGHBOUR_REFRESH_SECONDS = 0.5
+
+# 無法取得任何網路範圍時盲掃的常見私有網段
+FALLBACK_RANGES = ['192.168.1.0/24', '192.168.0.0/24', '10.0.0.0/24', '172.16.0.0/24']
+
+_ARP_LINE = re.compile(r'\((\d+\.\d+\.\d+\.\d+)\) at ([0-9a-fA-F:]+) ')
+
+
+def normalize_mac(mac: str) -> str:
+    """統一為小寫、每段兩位（macOS 的 arp 會省略前導 0）"""
+    return ':'.join(part.zfill(2) for part in mac.lower().split(':'))
+
+
+def is_brother_mac(mac: Optional[str]) -> bool:
+    return bool(mac) and normalize_mac(mac)[:8] in BROTHER_OUIS
+
+
+def read_neighbours() -> Dict[str, str]:
+    """
+    讀取 ARP / 鄰居表，返回 {IP: MAC}（只包括已解析的條目）
+    Linux 讀取 /proc/net/arp，其他系統調用 arp -an
+    """
+    neighbours = {}
+    try:
+        if sys.platform.startswith('linux'):
+            with open('/proc/net/arp') as f:
+                next(f, None)  # 標題行
+                for line in f:
+                    fields = line.split()
+                    # 欄位: IP、硬件類型、標誌、MAC、掩碼、介面；標誌 0x0 為未解析
+                    if len(fields) >= 4 and fields[2] != '0x0' and fields[3] != '00:00:00:00:00:00':
+                        neighbours[fields[0]] = normalize_mac(fields[3])
+        else:
+            output = subprocess.run(['arp', '-an'], capture_output=True, text=True, timeout=2).stdout
+            for match in _ARP_LINE.finditer(output):
+                neighbours[match.group(1)] = normalize_mac(match.group(2))
+    except (OSError, subprocess.SubprocessError):
+        pass
+    return neighbours
+
+
+def local_ipv4_address() -> Optional[str]:
+    """
+    本機的對外 IPv4 地址（不需要 netifaces）
+    UDP 的 connect 不會發送數據包，只讓系統選擇路由和源地址
+    """
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.connect(('192.0.2.1', 9))
+            ip = sock.getsockname()[0]
+    except OSError:
+        return None
+    return None if ip.startswith('127.') or ip == '0.0.0.0' else ip
+
+
+def subnet_24(ip: str) -> str:
+    return str(ipaddress.IPv4Network(f'{ip}/24', strict=False))
+
+
+def _interleave(iterators: List[Iterator[str]]) -> Iterator[str]:
+    """輪流從每個迭代器取一個，直到全部取完"""
+    iterators = list(iterators)
+    while iterators:
+        for iterator in list(iterators):
+            try:
+                yield next(iterator)
+            except StopIteration:
+                iterators.remove(iterator)
+
+
+class ScanPlan:
+    """
+    一次網路掃描的探測順序
+    priority: 已知打印機 IP → 鄰居表中 Brother MAC 的主機 → 其餘鄰居（按此順序）
+    sweep(): 各網路範圍中其餘的主機，多個範圍交錯產出
+    """
+
+    def __init__(self, ranges: Iterable[str], known_ips: Iterable[str] = (),
+                 neighbours: Optional[Dict[str, str]] = None):
+        self.ranges = []
+        for network_str in ranges:
+            try:
+                self.ranges.append(ipaddress.IPv4Network(network_str, strict=False))
+            except ValueError as e:
+                print(f"   無效的網路範圍 {network_str}: {e}")
+        self.neighbours = read_neighbours() if neighbours is None else dict(neighbours)
+        self._neighbours_read_at = time.monotonic()
+        self.known_ips = list(dict.fromkeys(known_ips))
+
+        brother = [ip for ip, mac in self.neighbours.items() if is_brother_mac(mac)]
+        others = [ip for ip in self.neighbours if ip not in brother and self._in_ranges(ip)]
+        self.priority = list(dict.fromkeys(self.known_ips + brother + others))
+        self._planned = set(self.priority)
+
+    def _in_ranges(self, ip: str) -> bool:
+        address = ipaddress.IPv4Address(ip)
+        return any(address in network for network in self.ranges)
+
+    def sweep(self) -> Iterator[str]:
+        """子網的其餘主機（不重複產出 priority 中的主機）"""
+        seen = set(self._planned)
+        for network in self.ranges:
+            print(f"   掃描 {network}...")
+
+        def hosts(network):
+            for ip in network.hosts():
+                ip_str = str(ip)
+                if ip_str not in seen:
+                    seen.add(ip_str)
+                    yield ip_str
+
+        return _interleave([hosts(network) for network in self.ranges])
+
+    @property
+    def sweep_size(self) -> int:
+        return sum(max(0, network.num_addresses - 2) for network in self.ranges)
+
+    def mac_for(self, ip: str) -> Optional[str]:
+        """
+        主機的 MAC 地址；探測過的同網段主機會出現在鄰居表中，
+        所以查不到時重新讀取（最多每 NEIGHBOUR_REFRESH_SECONDS 秒一次）
+        """
+        if ip not in self.neighbours and time.monotonic() - self._neighbours_read_at >= NEIGHBOUR_REFRESH_SECONDS:
+            self.neighbours.update(read_neighbours())
+            self._neighbours_read_at = time.monotonic()
+        return self.neighbours.get(ip)
+
+    def stats(self) -> Dict:
+        return {
+            'ranges': [str(network) for network in self.ranges],
+            'known': len(self.known_ips),
+            'neighbours': len(self.neighbours),
+            'priority': len(self.priority),
+            'sweep': self.sweep_size,
+        }
+
+
+def plan_ranges(interface_ranges: List[str], neighbours: Dict[str, str]) -> Tuple[List[str], bool]:
+    """
+    沒有網路介面信息（netifaces 未安裝）時，從本機地址和鄰居表推算 /24 網段，
+    都沒有時才使用 FALLBACK_RANGES；返回 (範圍, 是否為盲掃)
+    """
+    if interface_ranges:
+        return interface_ranges, False
+    ips = [ip for ip in [local_ipv4_address(), *neighbours] if ip]
+    ranges = list(dict.fromkeys(subnet_24(ip) for ip in ips))
+    if ranges:
+        return ranges, False
+    return list(FALLBACK_RANGES), True
@@ -0,0 +1,8 @@
+"""
+pytest 配置: 模組以扁平方式互相導入（例如 from printer_cache import ...），測試時將 printer/ 加入 sys.path
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,132 @@
+"""
+badge_layout 測試: 圖片路徑限制在 BADGE_ASSET_ROOT 內，遠程圖片只在註冊佈局時下載
+"""
+
+import base64
+import http.server
+import io
+import threading
+
+import pytest
+from PIL import Image
+
+import badge_layout
+from badge_layout import embed_remote_images, get_render_plan, load_image, resolve_asset_path
+from label_renderer import new_image
+
+
+def png_bytes(size=(8, 8), color=(255, 0, 0)):
+    buffer = io.BytesIO()
+    Image.new('RGB', size, color).save(buffer, 'PNG')
+    return buffer.getvalue()
+
+
+@pytest.fixture
+def asset_root(tmp_path, monkeypatch):
+    root = tmp_path / 'public'
+    (root / 'uploads').mkdir(parents=True)
+    (root / 'uploads' / 'logo.png').write_bytes(png_bytes())
+    (tmp_path / 'secret.png').write_bytes(png_bytes())
+    monkeypatch.setattr(badge_layout, 'BADGE_ASSET_ROOT', str(root))
+    load_image.cache_clear()
+    yield root
+    load_image.cache_clear()
+
+
+@pytest.fixture
+def image_server():
+    """本地 HTTP 圖片服務，記錄請求次數"""
+    requests = []
+    body = png_bytes()
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            requests.append(self.path)
+            payload = body if self.path != '/large.png' else b'\x00' * (badge_layout.BADGE_IMAGE_MAX_BYTES + 1)
+            self.send_response(200)
+            self.send_header('Content-Type', 'image/png')
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{server.server_address[1]}', requests
+    server.shutdown()
+
+
+def test_asset_paths_stay_inside_root(asset_root, tmp_path):
+    assert resolve_asset_path('/uploads/logo.png') == str(asset_root / 'uploads' / 'logo.png')
+    assert load_image('uploads/logo.png').size == (8, 8)
+    for url in ('../secret.png', '/uploads/../../secret.png', 'uploads/../../secret.png'):
+        with pytest.raises(ValueError):
+            load_image(url)
+    # 絕對路徑視為相對於 BADGE_ASSET_ROOT，不會讀取到根目錄以外的文件
+    for url in (str(tmp_path / 'secret.png'), '/etc/passwd'):
+        assert resolve_asset_path(url).startswith(str(asset_root))
+        with pytest.raises(FileNotFoundError):
+            load_image(url)
+
+
+def test_symlink_outside_root_is_rejected(asset_root, tmp_path):
+    (asset_root / 'uploads' / 'link.png').symlink_to(tmp_path / 'secret.png')
+    with pytest.raises(ValueError):
+        load_image('/uploads/link.png')
+
+
+def test_remote_images_are_not_fetched_when_printing(image_server):
+    base, requests = image_server
+    with pytest.raises(ValueError):
+        load_image.__wrapped__(f'{base}/logo.png')
+    assert requests == []
+
+
+def test_remote_images_are_embedded_at_registration(image_server):
+    base, requests = image_server
+    config = {'width': 100, 'height': 62, 'elements': [
+        {'type': 'image', 'imageUrl': f'{base}/logo.png', 'x': 100, 'y': 100},
+        {'type': 'image', 'imageUrl': '{{user.photo}}', 'x': 200, 'y': 100},
+    ]}
+    embedded = embed_remote_images(config)
+    assert requests == ['/logo.png']
+    url = embedded['elements'][0]['imageUrl']
+    assert url.startswith('data:image/png;base64,')
+    assert base64.b64decode(url.split(',', 1)[1]) == png_bytes()
+    assert embedded['elements'][1] == config['elements'][1]
+
+    plan = get_render_plan(embedded)
+    plan.render({'user': {'photo': f'{base}/logo.png'}})
+    assert requests == ['/logo.png']
+
+
+def test_oversized_remote_image_is_rejected(image_server):
+    base, _ = image_server
+    with pytest.raises(ValueError):
+        embed_remote_images({'elements': [{'type': 'image', 'imageUrl': f'{base}/large.png'}]})
+
+
+def test_oversized_data_url_is_rejected(monkeypatch):
+    monkeypatch.setattr(badge_layout, 'BADGE_IMAGE_MAX_BYTES', 16)
+    with pytest.raises(ValueError):
+        load_image.__wrapped__('data:image/png;base64,' + base64.b64encode(png_bytes()).decode('ascii'))
+
+
+def test_static_layers_are_drawn_once(monkeypatch):
+    config = {'width': 100, 'height': 62, 'elements': [
+        {'type': 'text', 'content': 'WELCOME', 'x': 100, 'y': 40, 'fontSize': 40, 'zIndex': 0},
+        {'type': 'text', 'content': '{{user.name}}', 'x': 100, 'y': 300, 'fontSize': 40, 'zIndex': 1},
+    ]}
+    plan = get_render_plan(config, 'mono')
+    assert (len(plan.static_layers), len(plan.layers)) == (1, 1)
+    # 靜態圖層已在底圖上，每張標籤只繪製含變量的圖層
+    assert plan.base.tobytes() != new_image(*plan.canvas_size, 'mono').tobytes()
+    drawn = []
+    monkeypatch.setattr(badge_layout.RenderLayer, 'draw', lambda self, img, draw, data: drawn.append(self.template.text))
+    first = plan.render({'user': {'name': 'A'}})
+    plan.render({'user': {'name': 'B'}})
+    assert drawn == ['{{user.name}}', '{{user.name}}']
+    # 渲染使用底圖的副本，不修改緩存的底圖
+    assert first is not plan.base and first.tobytes() == plan.base.tobytes()
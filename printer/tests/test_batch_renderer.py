@@ -0,0 +1,67 @@
+"""
+batch_renderer 測試: 渲染進程以 __mp_main__ 重新導入入口腳本時，不啟動打印線程和打印機池
+入口腳本在子進程中運行（與 python printer/printer_bridge.py 相同，入口模組就是 __main__）
+"""
+
+import json
+import os
+import subprocess
+import sys
+
+PRINTER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PROBE = '''
+import json
+import sys
+import threading
+
+{imports}
+
+
+def probe():
+    """在渲染進程中返回線程名稱和已導入的應用模組"""
+    return {{'threads': sorted(t.name for t in threading.enumerate()),
+             'bridge': 'printer_bridge' in sys.modules}}
+
+
+if __name__ == '__main__':
+    {start}
+    import printer_bridge
+    executor = printer_bridge.batch_renderer._get_executor()
+    result = {{'parent': probe(), 'worker': executor.submit(probe).result()}}
+    printer_bridge.batch_renderer.shutdown()
+    print(json.dumps(result))
+'''
+
+
+def run_probe(tmp_path, imports, start):
+    script = tmp_path / 'entry.py'
+    script.write_text(PROBE.format(imports=imports, start=start))
+    env = dict(os.environ, PYTHONPATH=PRINTER_DIR, BATCH_PROCESSES='1', MDNS_BROWSER='false',
+               PRINTER_IP='127.0.0.1', PRINTER_IPS='127.0.0.2', PRINTER_CACHE_PATH=str(tmp_path / 'printers.json'))
+    output = subprocess.run([sys.executable, str(script)], cwd=tmp_path, env=env, capture_output=True,
+                            text=True, timeout=120, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def service_threads(names):
+    return [name for name in names if name.startswith(('print-worker-', 'printer-'))]
+
+
+def test_import_does_not_start_threads(tmp_path):
+    result = run_probe(tmp_path, 'import printer_bridge', 'pass')
+    assert service_threads(result['parent']['threads']) == []
+
+
+def test_worker_of_bridge_entry_has_no_print_threads(tmp_path):
+    result = run_probe(tmp_path, 'import printer_bridge', 'printer_bridge.init()')
+    parent = service_threads(result['parent']['threads'])
+    assert 'print-worker-0' in parent and 'printer-127.0.0.1' in parent and 'printer-127.0.0.2' in parent
+    assert service_threads(result['worker']['threads']) == []
+
+
+def test_worker_of_wsgi_entry_does_not_import_app(tmp_path):
+    result = run_probe(tmp_path, 'import wsgi', 'wsgi.create_app()')
+    assert result['parent']['bridge'] and 'print-worker-0' in result['parent']['threads']
+    assert not result['worker']['bridge']
+    assert service_threads(result['worker']['threads']) == []
@@ -0,0 +1,210 @@
+"""
+brother_ql_raster 測試: 光柵編碼與解碼往返、PackBits 邊界情況、狀態信息
+"""
+
+import random
+
+import pytest
+from PIL import Image, ImageDraw
+
+from brother_ql_raster import (
+    COMPRESSION_TIFF, EXPANDED_CUT_AT_END, EXPANDED_TWO_COLOR, MEDIA_CONTINUOUS, MEDIA_DIE_CUT, MEDIA_PROFILES,
+    MODE_AUTO_CUT, PACKED_ZERO_LINE, PHASE_PRINTING, STATUS_TYPE_ERROR, ZERO_LINE, decode_raster, encode_label,
+    encode_label_page, encode_labels, encode_status, packbits_decode, packbits_encode, page_to_job, parse_status,
+    printable_size, raster_lines_to_image, set_page_flags,
+)
+from label_renderer import COLOR_BLACK_RED, COLOR_MODES, PALETTE_BLACK, PALETTE_RED, create_label_image, new_image
+
+
+def sample_image(media, color_mode='mono', length=400):
+    """可打印範圍大小的測試圖像: 黑色邊框、對角線和一個紅色方塊"""
+    width, height = printable_size(media, length)
+    img = new_image(width, height, color_mode)
+    draw = ImageDraw.Draw(img)
+    black = 'black' if color_mode == 'rgb' else (PALETTE_BLACK if color_mode == COLOR_BLACK_RED else 0)
+    red = (255, 0, 0) if color_mode == 'rgb' else (PALETTE_RED if color_mode == COLOR_BLACK_RED else 0)
+    draw.rectangle((0, 0, width - 1, height - 1), outline=black, width=3)
+    draw.line((0, 0, width - 1, height - 1), fill=black, width=5)
+    draw.rectangle((100, 50, 160, 110), fill=red)
+    return img
+
+
+def black_mask(img):
+    """1-bit 遮罩: 0 為打印（黑或紅）"""
+    return img.convert('L').point(lambda v: 255 if v >= 128 else 0).convert('1')
+
+
+@pytest.mark.parametrize('data', [
+    b'',
+    b'\x00',
+    ZERO_LINE,
+    bytes(300),                        # 超過 128 的重複
+    b'\xff' * 129 + b'\x01',
+    bytes(range(90)),                  # 全部不重複
+    bytes(range(256)) + bytes(range(256)),  # 不重複超過 128
+    b'\x01\x02\x02\x03\x03\x03\x04',
+])
+def test_packbits_round_trip(data):
+    encoded = packbits_encode(data)
+    assert packbits_decode(encoded) == data
+    # 每段最多 128 bytes
+    assert all(count <= 128 for count in _packbits_counts(encoded))
+
+
+def _packbits_counts(encoded):
+    i = 0
+    while i < len(encoded):
+        header = encoded[i]
+        if header < 128:
+            yield header + 1
+            i += header + 2
+        else:
+            yield 257 - header
+            i += 2
+
+
+def test_packbits_random_round_trip():
+    rng = random.Random(0)
+    for _ in range(200):
+        data = bytes(rng.choice((0, 0, 0, 255, rng.randrange(256))) for _ in range(rng.randrange(1, 200)))
+        assert packbits_decode(packbits_encode(data)) == data
+
+
+def test_packed_zero_line_constant():
+    assert packbits_encode(ZERO_LINE) == PACKED_ZERO_LINE
+
+
+@pytest.mark.parametrize('media', sorted(MEDIA_PROFILES))
+@pytest.mark.parametrize('compress', [True, False])
+def test_round_trip_mono(media, compress):
+    img = sample_image(media)
+    pages = decode_raster(encode_label(img, media=media, compress=compress))
+    assert len(pages) == 1
+    page = pages[0]
+    profile = MEDIA_PROFILES[media]
+    assert page['info']['line_count'] == img.height == len(page['lines'])
+    assert page['info']['media_type'] == profile['media_type']
+    assert page['info']['width_mm'] == profile['width_mm']
+    assert page['info']['length_mm'] == profile['length_mm']
+    assert page['info']['first_page'] and page['last_page']
+    assert page['margin'] == profile['feed_margin']
+    assert page['various_mode'] == MODE_AUTO_CUT
+    assert page['expanded_mode'] & EXPANDED_CUT_AT_END
+
+    decoded = raster_lines_to_image(page['lines'], media)
+    assert decoded.tobytes() == img.tobytes()
+
+
+@pytest.mark.parametrize('media', sorted(MEDIA_PROFILES))
+@pytest.mark.parametrize('color_mode', COLOR_MODES)
+def test_round_trip_color_modes(media, color_mode):
+    img = sample_image(media, color_mode)
+    page = decode_raster(encode_label(img, media=media))[0]
+    two_color = MEDIA_PROFILES[media].get('two_color', False)
+    assert bool(page['expanded_mode'] & EXPANDED_TWO_COLOR) == two_color
+
+    black = raster_lines_to_image(page['lines'], media)
+    if not two_color:
+        # 單色介質: 紅色打印為黑色
+        assert page['red_lines'] == []
+        assert black.tobytes() == black_mask(img).tobytes()
+        return
+
+    red = raster_lines_to_image(page['red_lines'], media)
+    assert len(page['red_lines']) == len(page['lines'])
+    red_box = (100, 50, 161, 111)
+    if color_mode == COLOR_BLACK_RED:
+        # 紅色方塊只在紅色圖層
+        assert red.crop(red_box).getextrema() == (0, 0)
+        assert black.crop((110, 60, 150, 100)).getextrema() == (255, 255)
+    else:
+        # 非調色板圖像沒有紅色圖層
+        assert red.getextrema() == (255, 255)
+        assert black.crop(red_box).getextrema() == (0, 0)
+
+
+def test_two_color_preview():
+    img = sample_image('62red', COLOR_BLACK_RED)
+    page = decode_raster(encode_label(img, media='62red'))[0]
+    preview = raster_lines_to_image(page['lines'], '62red', red_lines=page['red_lines'])
+    assert preview.getpixel((130, 80)) == PALETTE_RED
+    assert preview.getpixel((1, 200)) == PALETTE_BLACK
+
+
+def test_multi_page_flags():
+    images = [sample_image('62', length=200 + i) for i in range(3)]
+    pages = decode_raster(encode_labels(images, media='62'))
+    assert [p['info']['first_page'] for p in pages] == [True, False, False]
+    assert [p['last_page'] for p in pages] == [False, False, True]
+    assert [p['info']['line_count'] for p in pages] == [200, 201, 202]
+
+
+def test_set_page_flags_and_page_to_job():
+    page = encode_label_page(sample_image('62x100'), media='62x100')
+    middle = decode_raster(set_page_flags(page, first_page=False, last_page=False))[0]
+    assert not middle['info']['first_page'] and not middle['last_page']
+    job = decode_raster(page_to_job(page))
+    assert len(job) == 1 and job[0]['info']['first_page'] and job[0]['last_page']
+    with pytest.raises(ValueError):
+        set_page_flags(b'not a page', True, True)
+
+
+def test_compression_command():
+    data = encode_label(sample_image('62'), media='62')
+    assert b'M' + bytes([COMPRESSION_TIFF]) in data
+
+
+@pytest.mark.parametrize('media,size', [
+    ('62', (732, 1181)),        # 整張標籤寬度，超出可打印範圍
+    ('62', (600, 1181)),
+    ('62x100', (696, 1181)),    # 預切標籤長度不符
+])
+def test_size_mismatch_raises(media, size):
+    with pytest.raises(ValueError):
+        encode_label(Image.new('1', size, 1), media=media)
+
+
+def test_landscape_image_is_rotated():
+    width, length = printable_size('62x100')
+    img = Image.new('1', (length, width), 1)
+    ImageDraw.Draw(img).rectangle((0, 0, 9, width - 1), fill=0)
+    page = decode_raster(encode_label(img, media='62x100'))[0]
+    assert page['info']['line_count'] == length
+    decoded = raster_lines_to_image(page['lines'], '62x100')
+    assert decoded.size == (width, length)
+
+
+@pytest.mark.parametrize('media', sorted(MEDIA_PROFILES))
+def test_default_label_matches_media(media):
+    img = create_label_image('張三', 'ABC 公司', 'USER123', media=media)
+    assert img.size == printable_size(media, img.height)
+    page = decode_raster(encode_label(img, media=media))[0]
+    assert raster_lines_to_image(page['lines'], media).tobytes() == black_mask(img).tobytes()
+
+
+def test_status_round_trip():
+    status = parse_status(encode_status(errors=('no_media', 'cover_open'), media_width_mm=62, media_length_mm=100,
+                                        media_type=MEDIA_DIE_CUT, status_type=STATUS_TYPE_ERROR))
+    assert status['model'] == 'QL-820NWB'
+    assert status['errors'] == ['no_media', 'cover_open']
+    assert not status['busy']
+    assert status['media_width_mm'] == 62 and status['media_length_mm'] == 100
+    assert status['media_type'] == 'die_cut'
+    assert status['status_type'] == STATUS_TYPE_ERROR
+
+
+def test_status_busy_is_not_an_error():
+    status = parse_status(encode_status(errors=('printer_in_use',), media_type=MEDIA_CONTINUOUS))
+    assert status['errors'] == [] and status['busy']
+    assert parse_status(encode_status(phase=PHASE_PRINTING))['busy']
+
+
+def test_status_without_media():
+    status = parse_status(encode_status(media_width_mm=0))
+    assert status['media_type'] is None
+
+
+@pytest.mark.parametrize('data', [b'', b'\x80' * 10, b'\x00' * 32])
+def test_invalid_status(data):
+    with pytest.raises(ValueError):
+        parse_status(data)
@@ -0,0 +1,284 @@
+"""
+ipp_client 測試: 屬性編碼、響應解析，以及對本地 http.server 假 cupsd 的長連接重用和重新連接
+"""
+
+import http.server
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import ipp_client
+from ipp_client import (
+    OP_CUPS_GET_PRINTERS, OP_PRINT_JOB, STATUS_NOT_FOUND, STATUS_OK, TAG_BOOLEAN, TAG_CHARSET, TAG_ENUM, TAG_INTEGER,
+    TAG_JOB, TAG_KEYWORD, TAG_LANGUAGE, TAG_NAME, TAG_OPERATION, TAG_PRINTER, TAG_TEXT, TAG_URI, IPPClient, IPPError,
+    decode_message, encode_attribute, encode_message, group_attributes, option_attribute,
+)
+
+
+class FakeCupsd:
+    """
+    本地假 cupsd（HTTP/1.1 keep-alive）
+    close_after_response: 回覆後關閉連接（模擬 cupsd 關閉閒置連接）
+    drop: 之後多少個請求讀取後不回覆並關閉連接（模擬檢查連接之後才被關閉）
+    """
+
+    def __init__(self, printers=2, status=STATUS_OK):
+        self.printers = printers
+        self.status = status
+        self.close_after_response = False
+        self.drop = 0
+        self.connections = 0
+        self.closed = 0
+        self.jobs = []
+        self.requests = []
+        self.lock = threading.Lock()
+        cupsd = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def setup(self):
+                super().setup()
+                with cupsd.lock:
+                    cupsd.connections += 1
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                request = decode_message(body)
+                with cupsd.lock:
+                    cupsd.requests.append(request)
+                    if request['code'] == OP_PRINT_JOB:
+                        cupsd.jobs.append(request['data'])
+                    drop = cupsd.drop > 0
+                    cupsd.drop -= drop
+                if drop:
+                    self.close_connection = True
+                    return
+                payload = cupsd.respond(request)
+                self.close_connection = cupsd.close_after_response
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/ipp')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+                self.wfile.flush()
+
+            def log_message(self, *args):
+                pass
+
+        class Server(http.server.ThreadingHTTPServer):
+            daemon_threads = True
+
+            def shutdown_request(self, request):
+                super().shutdown_request(request)
+                with cupsd.lock:
+                    cupsd.closed += 1
+
+        self.httpd = Server(('127.0.0.1', 0), Handler)
+        self.address = f'127.0.0.1:{self.httpd.server_address[1]}'
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def respond(self, request):
+        operation = [(TAG_CHARSET, 'attributes-charset', 'utf-8'), (TAG_LANGUAGE, 'attributes-natural-language', 'en')]
+        if self.status != STATUS_OK:
+            operation.append((TAG_TEXT, 'status-message', 'No destinations added.'))
+            return encode_message(self.status, request['request_id'], [(TAG_OPERATION, operation)])
+        groups = [(TAG_OPERATION, operation)]
+        if request['code'] == OP_PRINT_JOB:
+            groups.append((TAG_JOB, [(TAG_INTEGER, 'job-id', len(self.jobs)), (TAG_ENUM, 'job-state', 3)]))
+        elif request['code'] == OP_CUPS_GET_PRINTERS:
+            for i in range(self.printers):
+                groups.append((TAG_PRINTER, [
+                    (TAG_NAME, 'printer-name', f'QL{i}'),
+                    (TAG_URI, 'device-uri', f'socket://192.168.1.{i + 10}:9100'),
+                    (TAG_ENUM, 'printer-state', 3 + i),
+                    (TAG_BOOLEAN, 'printer-is-accepting-jobs', True),
+                ]))
+        return encode_message(STATUS_OK, request['request_id'], groups)
+
+    def wait_closed(self, count, timeout=2.0):
+        deadline = time.monotonic() + timeout
+        while self.closed < count and time.monotonic() < deadline:
+            time.sleep(0.005)
+        assert self.closed >= count
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+@pytest.fixture
+def cupsd():
+    server = FakeCupsd()
+    yield server
+    server.close()
+
+
+@pytest.fixture
+def client(cupsd):
+    ipp = IPPClient(cupsd.address, timeout=5)
+    yield ipp
+    ipp.close()
+
+
+# ---- 編碼和解析 ----
+
+def test_encode_attribute_layout():
+    assert encode_attribute(TAG_INTEGER, 'copies', 2) == b'\x21\x00\x06copies\x00\x04\x00\x00\x00\x02'
+    assert encode_attribute(TAG_BOOLEAN, 'x', False) == b'\x22\x00\x01x\x00\x01\x00'
+    # 1setOf: 第二個值名稱為空
+    assert encode_attribute(TAG_KEYWORD, 'a', ['b', 'cd']) == b'\x44\x00\x01a\x00\x01b' + b'\x44\x00\x00\x00\x02cd'
+
+
+def test_option_attribute_types():
+    assert option_attribute('fit-to-page', True) == (TAG_BOOLEAN, 'fit-to-page', True)
+    assert option_attribute('copies', 3) == (TAG_INTEGER, 'copies', 3)
+    assert option_attribute('media', 'Custom.62x100mm') == (TAG_KEYWORD, 'media', 'Custom.62x100mm')
+
+
+def test_message_round_trip():
+    data = b'\x89PNG document'
+    message = encode_message(OP_PRINT_JOB, 7, [
+        (TAG_OPERATION, [(TAG_CHARSET, 'attributes-charset', 'utf-8'), (TAG_NAME, 'job-name', '張三')]),
+        (TAG_JOB, [(TAG_KEYWORD, 'media', ['Custom.62x100mm', 'roll']), (TAG_INTEGER, 'copies', -1)]),
+    ], data)
+    decoded = decode_message(message)
+    assert decoded['version'] == (2, 0)
+    assert (decoded['code'], decoded['request_id']) == (OP_PRINT_JOB, 7)
+    assert group_attributes(decoded, TAG_OPERATION) == [{'attributes-charset': 'utf-8', 'job-name': '張三'}]
+    assert group_attributes(decoded, TAG_JOB) == [{'media': ['Custom.62x100mm', 'roll'], 'copies': -1}]
+    assert decoded['data'] == data
+
+
+@pytest.mark.parametrize('data', [b'', b'\x02\x00\x00\x00\x00\x00\x00\x01', b'\x02\x00\x00\x00\x00\x00\x00\x01\x44',
+                                  b'\x02\x00\x00\x00\x00\x00\x00\x01\x01\x44\x00'])
+def test_decode_rejects_bad_messages(data):
+    with pytest.raises(IPPError):
+        decode_message(data)
+
+
+# ---- 對假 cupsd 的請求 ----
+
+def test_print_job_sends_document_and_options(cupsd, client):
+    assert client.print_job('QL-820NWB', b'png-bytes', options={'media': 'Custom.62x100mm', 'copies': 2}) == 1
+    request = cupsd.requests[0]
+    operation = group_attributes(request, TAG_OPERATION)[0]
+    assert request['code'] == OP_PRINT_JOB
+    assert operation['printer-uri'] == 'ipp://127.0.0.1/printers/QL-820NWB'
+    assert operation['document-format'] == 'image/png'
+    assert group_attributes(request, TAG_JOB) == [{'media': 'Custom.62x100mm', 'copies': 2}]
+    assert request['data'] == b'png-bytes'
+
+
+def test_get_printers_parses_groups(client):
+    printers = client.get_printers()
+    assert [p['printer-name'] for p in printers] == ['QL0', 'QL1']
+    assert [p['printer-state'] for p in printers] == ['idle', 'processing']
+    assert printers[0]['device-uri'] == 'socket://192.168.1.10:9100'
+    assert printers[0]['printer-is-accepting-jobs'] is True
+
+
+def test_error_status_raises(cupsd, client):
+    cupsd.status = 0x0501
+    with pytest.raises(IPPError, match='No destinations added') as error:
+        client.print_job('QL0', b'x')
+    assert error.value.status == 0x0501
+    assert client.stats()['last_error'] == 'No destinations added.'
+
+
+def test_get_printers_not_found_is_empty(cupsd, client):
+    cupsd.status = STATUS_NOT_FOUND
+    assert client.get_printers() == []
+
+
+def test_keep_alive_reuses_one_connection(cupsd, client):
+    for _ in range(5):
+        client.print_job('QL0', b'x')
+    client.get_printers()
+    assert cupsd.connections == 1
+    assert client.stats()['connects'] == 1
+    assert client.connected
+
+
+def test_concurrent_requests_use_one_connection_each(cupsd, client):
+    barrier = threading.Barrier(4)
+
+    def print_one(i):
+        barrier.wait()
+        return client.print_job('QL0', b'x')
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        list(executor.map(print_one, range(4)))
+    assert 2 <= cupsd.connections <= 4
+    opened = cupsd.connections
+    for _ in range(8):
+        client.print_job('QL0', b'x')
+    assert cupsd.connections == opened
+    assert client.stats()['idle_connections'] == opened
+
+
+def test_idle_connections_are_capped(cupsd):
+    ipp = IPPClient(cupsd.address, max_idle=1)
+    barrier = threading.Barrier(3)
+
+    def query(i):
+        barrier.wait()
+        return ipp.get_printers()
+
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        list(executor.map(query, range(3)))
+    assert ipp.stats()['idle_connections'] == 1
+    ipp.close()
+
+
+def test_connection_closed_by_cupsd_is_replaced(cupsd, client):
+    cupsd.close_after_response = True
+    client.print_job('QL0', b'first')
+    cupsd.close_after_response = False
+    cupsd.wait_closed(1)
+    # 閒置連接已被關閉: 重用前發現並改用新連接，不需要重發
+    client.print_job('QL0', b'second')
+    stats = client.stats()
+    assert stats['stale_connections'] == 1 and stats['reconnects'] == 0
+    assert cupsd.jobs == [b'first', b'second']
+    assert cupsd.connections == 2
+
+
+def test_query_is_resent_when_connection_drops(cupsd, client):
+    client.get_printers()
+    cupsd.drop = 1
+    assert len(client.get_printers()) == 2
+    assert client.stats()['reconnects'] == 1
+    assert sum(1 for r in cupsd.requests if r['code'] == OP_CUPS_GET_PRINTERS) == 3
+
+
+def test_print_job_is_not_resent_after_it_was_sent(cupsd, client):
+    client.print_job('QL0', b'first')
+    cupsd.drop = 1
+    with pytest.raises(IPPError, match='不自動重發'):
+        client.print_job('QL0', b'second')
+    # cupsd 已收到任務，沒有重複提交
+    assert cupsd.jobs == [b'first', b'second']
+    assert client.stats()['reconnects'] == 0
+    # 之後的請求使用新連接
+    client.print_job('QL0', b'third')
+    assert cupsd.jobs[-1] == b'third'
+
+
+def test_connect_error_is_raised(cupsd):
+    address = cupsd.address
+    cupsd.close()
+    ipp = IPPClient(address, timeout=1)
+    with pytest.raises(OSError):
+        ipp.print_job('QL0', b'x')
+    assert ipp.stats()['active_requests'] == 0
+    assert ipp.last_error
+
+
+def test_default_client_uses_cups_server(monkeypatch, cupsd):
+    monkeypatch.setattr(ipp_client, 'CUPS_SERVER', cupsd.address)
+    monkeypatch.setattr(ipp_client, '_default_client', None)
+    assert ipp_client.get_ipp_client().server == cupsd.address
+    assert ipp_client.get_ipp_client() is ipp_client.get_ipp_client()
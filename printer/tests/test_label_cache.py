@@ -0,0 +1,70 @@
+"""
+label_cache 測試: 磁盤緩存以累計值追蹤佔用，未超過上限時寫入不掃描目錄
+"""
+
+import os
+
+import pytest
+
+import label_cache
+from label_cache import DISK_TRIM_RATIO, PrerenderCache
+
+KB = 1024
+
+
+def payload(i, size=KB):
+    return {'png': bytes([i % 256]) * size, 'page': bytes([i % 256]) * size}
+
+
+def disk_usage(path):
+    return sum(entry.stat().st_size for entry in os.scandir(path))
+
+
+@pytest.fixture
+def scans(monkeypatch):
+    """記錄 os.scandir 的調用次數"""
+    calls = []
+    scandir = os.scandir
+
+    def counting_scandir(path):
+        calls.append(path)
+        return scandir(path)
+
+    monkeypatch.setattr(label_cache.os, 'scandir', counting_scandir)
+    return calls
+
+
+def test_puts_under_the_limit_do_not_scan(tmp_path, scans):
+    cache = PrerenderCache('62', memory_mb=0, disk_path=str(tmp_path), disk_mb=1)
+    scans.clear()
+    for i in range(50):
+        cache.put({'name': f'Attendee {i}'}, payload(i))
+    assert scans == []
+    assert cache.stats()['disk_bytes'] == disk_usage(tmp_path) == 50 * 2 * KB
+
+
+def test_trim_runs_only_when_over_the_limit(tmp_path, scans):
+    cache = PrerenderCache('62', memory_mb=0, disk_path=str(tmp_path), disk_mb=40 / 1024)
+    for i in range(50):
+        cache.put({'name': f'Attendee {i}'}, payload(i))
+        assert cache.stats()['disk_bytes'] <= cache.max_disk_bytes
+    stats = cache.stats()
+    # 刪除到上限的 DISK_TRIM_RATIO，之後的寫入不會每次都清理；只有啟動和清理時掃描目錄
+    assert 0 < stats['disk_trims'] < 20
+    assert len(scans) == stats['disk_trims'] + 1
+    assert stats['disk_bytes'] == disk_usage(tmp_path)
+    assert cache.max_disk_bytes * DISK_TRIM_RATIO - 2 * KB <= stats['disk_bytes']
+
+
+def test_replaced_and_rewritten_files_are_counted_once(tmp_path):
+    cache = PrerenderCache('62', memory_mb=0, disk_path=str(tmp_path), disk_mb=1)
+    cache.put({'name': 'A', 'attendee_id': 1}, payload(1))
+    cache.put({'name': 'A', 'attendee_id': 1}, payload(1, size=2 * KB))
+    assert cache.stats()['disk_bytes'] == disk_usage(tmp_path) == 4 * KB
+    # 參加者資料變更: 舊標籤被刪除
+    cache.put({'name': 'A (new)', 'attendee_id': 1}, payload(2))
+    assert cache.stats()['disk_bytes'] == disk_usage(tmp_path) == 2 * KB
+    # 重啟後從目錄讀取佔用
+    assert PrerenderCache('62', memory_mb=0, disk_path=str(tmp_path)).stats()['disk_bytes'] == 2 * KB
+    cache.clear()
+    assert cache.stats()['disk_bytes'] == 0
@@ -0,0 +1,99 @@
+"""
+printer_cache 測試: 提前返回的部分發現結果只合併到緩存，不作為完整的打印機列表
+"""
+
+import pytest
+
+from printer_cache import PrinterCache
+from printer_discovery import PrinterDiscovery
+
+BROTHER = {'ip': '192.168.1.20', 'name': 'Brother QL-820NWB', 'port': 9100, 'method': 'mDNS'}
+OFFICE = {'ip': '192.168.1.30', 'name': 'Office LaserJet', 'port': 9100, 'method': 'CUPS'}
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return PrinterCache(path=str(tmp_path / 'printers.json'), ttl=300)
+
+
+class StubDiscovery(PrinterDiscovery):
+    """以固定結果代替真正的發現方法，記錄每次調用的參數"""
+
+    def __init__(self, full, first):
+        super().__init__()
+        self.full, self.first = full, first
+        self.calls = []
+
+    def discover_all(self, **kwargs):
+        self.calls.append(kwargs)
+        partial = kwargs.get('first_match') or kwargs.get('scan_stop_early')
+        return list(self.first if partial else self.full)
+
+    def revalidate(self, printers, timeout=0.5):
+        return printers
+
+
+def test_partial_record_does_not_count_as_complete(cache):
+    cache.record([BROTHER], now=1000, complete=False)
+    assert cache.complete_at is None
+    assert cache.fresh(now=1001) == [dict(BROTHER, first_seen=1000, last_seen=1000)]
+    assert cache.fresh(now=1001, complete=True) == []
+
+
+def test_partial_record_merges_into_complete_list(cache):
+    cache.record([BROTHER, OFFICE], now=1000)
+    cache.record([dict(BROTHER, name='QL-820NWB')], now=1100, complete=False)
+    assert cache.complete_at == 1000
+    assert {p['ip'] for p in cache.fresh(now=1200, complete=True)} == {BROTHER['ip'], OFFICE['ip']}
+    # 完整列表過期後部分結果不能代替它
+    assert cache.fresh(now=1350, complete=True) == []
+    assert [p['ip'] for p in cache.fresh(now=1350)] == [BROTHER['ip']]
+
+
+def test_complete_at_persists(cache):
+    cache.record([OFFICE], now=1000)
+    assert PrinterCache(path=cache.path, ttl=300).complete_at == 1000
+    cache.clear()
+    assert PrinterCache(path=cache.path, ttl=300).complete_at is None
+
+
+def test_first_match_result_is_not_served_as_full_list(cache):
+    discovery = StubDiscovery(full=[BROTHER, OFFICE], first=[BROTHER])
+    assert discovery.discover_cached(cache=cache, first_match=True) == [BROTHER]
+    assert discovery.last_source == 'discovery'
+
+    # 列出所有打印機時不使用 first_match 的部分結果
+    printers = discovery.discover_cached(cache=cache)
+    assert discovery.last_source == 'discovery'
+    assert {p['ip'] for p in printers} == {BROTHER['ip'], OFFICE['ip']}
+    assert len(discovery.calls) == 2
+
+    # 完整發現之後兩種調用都使用緩存
+    assert len(discovery.discover_cached(cache=cache)) == 2
+    assert discovery.last_source == 'cache'
+    discovery.discover_cached(cache=cache, first_match=True)
+    assert discovery.last_source == 'cache'
+    assert len(discovery.calls) == 2
+
+
+def test_background_stop_early_result_is_not_served_as_full_list(cache):
+    # 後台自動發現以 scan_stop_early 運行，確認找到 Brother 打印機後停止掃描子網
+    discovery = StubDiscovery(full=[BROTHER, OFFICE], first=[BROTHER])
+    assert discovery.discover_cached(cache=cache, scan_stop_early=True) == [BROTHER]
+    assert cache.complete_at is None
+
+    assert len(discovery.discover_cached(cache=cache)) == 2
+    assert discovery.last_source == 'discovery'
+    assert discovery.calls[-1] == {}
+
+
+def test_revalidation_requires_a_complete_list(cache):
+    discovery = StubDiscovery(full=[BROTHER, OFFICE], first=[BROTHER])
+    cache.record([BROTHER], now=1, complete=False)
+    discovery.discover_cached(cache=cache, first_match=True)
+    assert discovery.last_source == 'revalidated'
+    assert discovery.calls == []
+
+    discovery.discover_cached(cache=cache)
+    assert discovery.last_source == 'discovery'
+    assert len(discovery.calls) == 1
@@ -0,0 +1,55 @@
+"""
+printer_discovery 測試: 網路掃描以固定數量的探測協程從惰性的主機迭代器取出主機
+"""
+
+import asyncio
+import socket
+
+import pytest
+
+from printer_discovery import PrinterDiscovery
+
+PRINTER_IP = '127.0.0.50'
+
+
+@pytest.fixture
+def listener():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind((PRINTER_IP, 0))
+    sock.listen(16)
+    yield sock.getsockname()[1]
+    sock.close()
+
+
+def test_scan_pulls_hosts_lazily_with_bounded_tasks(listener):
+    pulled = []
+    max_tasks = []
+
+    def hosts():
+        # 127.0.x.x 都是本機地址，沒有監聽的端口立即拒絕連接
+        for i in range(1, 20000):
+            max_tasks.append(len(asyncio.all_tasks()))
+            pulled.append(i)
+            yield f'127.0.{i // 256}.{i % 256}'
+
+    async def first_printer():
+        scan = PrinterDiscovery().scan_hosts_async(hosts(), ports=[listener], timeout_per_ip=1, concurrency=8)
+        try:
+            return await scan.__anext__()
+        finally:
+            await scan.aclose()
+
+    printer = asyncio.run(first_printer())
+    assert (printer['ip'], printer['port']) == (PRINTER_IP, listener)
+    # 找到打印機後停止: 只取出了打印機之前的主機和正在探測的少量主機，而不是整個網段
+    assert len(pulled) < 200
+    # 任務數量固定（8 個探測協程和各自的連接），不隨主機數量增長
+    assert max(max_tasks) < 50
+
+
+def test_scan_finishes_all_hosts(listener):
+    async def scan():
+        hosts = [f'127.0.0.{i}' for i in range(40, 61)]
+        return [p async for p in PrinterDiscovery().scan_hosts_async(hosts, ports=[listener], concurrency=4)]
+
+    assert [p['ip'] for p in asyncio.run(scan())] == [PRINTER_IP]
@@ -0,0 +1,350 @@
+"""
+printer_status 測試: SNMP BER 編解碼（對本地 UDP 假 SNMP agent）、32 bytes 狀態信息解析，
+以及狀態監控的暫停等待和轉到其他打印機
+"""
+
+import socket
+import threading
+import time
+
+import pytest
+
+from brother_ql_raster import MEDIA_CONTINUOUS, STATUS_TYPE_REPLY, encode_status, parse_status
+from printer_pool import PrinterPool
+from printer_status import (
+    BER_INTEGER, BER_NULL, BER_OCTET_STRING, OID_HR_PRINTER_ERRORS, OID_HR_PRINTER_STATUS, OID_PRT_INPUT_MEDIA_NAME,
+    SNMP_GET_REQUEST, SNMP_GET_RESPONSE, PrinterStatusMonitor, ber_decode, ber_encode, ber_integer, ber_oid,
+    decode_oid, parse_snmp_message, query_snmp_status, snmp_get, snmp_message,
+)
+
+PRINTER_A = '127.0.0.1'
+PRINTER_B = '127.0.0.2'
+
+
+class SnmpAgent:
+    """
+    本地 UDP 假 SNMP agent: 以 values 中的 {OID: (tag, 內容)} 回覆 GetRequest
+    truncate: 只發送回覆的前 truncate 個字節（模擬不完整的數據包）
+    """
+
+    def __init__(self, values=None, error_status=0, silent=False, truncate=None, host='127.0.0.1', port=0):
+        self.values = values or {}
+        self.error_status = error_status
+        self.silent = silent
+        self.truncate = truncate
+        self.requests = []
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((host, port))
+        self.port = self.sock.getsockname()[1]
+        self.thread = threading.Thread(target=self._serve, daemon=True)
+        self.thread.start()
+
+    def _serve(self):
+        while True:
+            try:
+                data, address = self.sock.recvfrom(65535)
+            except OSError:
+                return
+            request = parse_snmp_message(data)
+            self.requests.append(request)
+            if self.silent:
+                continue
+            varbinds = [(oid, ber_encode(*self.values.get(oid, (BER_NULL, b'')))) for oid in request['varbinds']]
+            reply = snmp_message(SNMP_GET_RESPONSE, request['request_id'], varbinds, request['community'],
+                                 self.error_status)
+            try:
+                self.sock.sendto(reply[:self.truncate], address)
+            except OSError:
+                return
+
+    def close(self):
+        self.sock.close()
+
+
+@pytest.fixture
+def agent():
+    agents = []
+
+    def start(**kwargs):
+        agents.append(SnmpAgent(**kwargs))
+        return agents[-1]
+
+    yield start
+    for running in agents:
+        running.close()
+
+
+# ---- BER ----
+
+@pytest.mark.parametrize('value', [0, 1, 127, 128, 255, 256, 0x7FFFFFFF, -1, -129])
+def test_ber_integer_round_trip(value):
+    tag, content, end = ber_decode(ber_integer(value))
+    assert tag == BER_INTEGER
+    assert int.from_bytes(content, 'big', signed=True) == value
+    assert end == len(ber_integer(value))
+
+
+@pytest.mark.parametrize('oid', [OID_HR_PRINTER_STATUS, OID_PRT_INPUT_MEDIA_NAME, '1.3.6.1.4.1.2435.2.3.9.4.2.1.5.5.1.0',
+                                 '1.3.6.1.2.1.1.16384.2097151'])
+def test_ber_oid_round_trip(oid):
+    tag, content, _ = ber_decode(ber_oid(oid))
+    assert tag == 0x06
+    assert decode_oid(content) == oid
+
+
+@pytest.mark.parametrize('length', [0, 127, 128, 255, 256, 70000])
+def test_ber_long_lengths(length):
+    encoded = ber_encode(BER_OCTET_STRING, b'x' * length) + b'rest'
+    tag, content, end = ber_decode(encoded)
+    assert (tag, len(content)) == (BER_OCTET_STRING, length)
+    assert encoded[end:] == b'rest'
+
+
+def test_snmp_message_round_trip():
+    message = snmp_message(SNMP_GET_REQUEST, 42, [(OID_HR_PRINTER_STATUS, ber_encode(BER_NULL, b''))], 'secret')
+    parsed = parse_snmp_message(message)
+    assert parsed['type'] == SNMP_GET_REQUEST
+    assert parsed['community'] == 'secret'
+    assert parsed['request_id'] == 42
+    assert parsed['varbinds'] == {OID_HR_PRINTER_STATUS: (BER_NULL, b'')}
+
+
+@pytest.mark.parametrize('data', [b'', b'\x30', b'\x30\x05\x02', b'\x30\x84\x00', b'\x30\x82\xff\xff\x02\x01\x00',
+                                  b'\x30\x03\x02\x01\x00', b'\x30\x0b\x02\x01\x00\x04\x00\xa2\x04\x02\x01\x01\x06'])
+def test_parse_rejects_truncated_messages(data):
+    with pytest.raises(ValueError):
+        parse_snmp_message(data)
+
+
+def test_parse_rejects_every_truncation():
+    message = snmp_message(SNMP_GET_RESPONSE, 7, [(OID_HR_PRINTER_STATUS, ber_integer(3))], 'public')
+    for end in range(len(message)):
+        with pytest.raises(ValueError):
+            parse_snmp_message(message[:end])
+
+
+# ---- 對 UDP 假 agent 的 SNMP 查詢 ----
+
+def test_snmp_get_against_agent(agent):
+    running = agent(values={OID_HR_PRINTER_STATUS: (BER_INTEGER, b'\x03')})
+    values = snmp_get('127.0.0.1', [OID_HR_PRINTER_STATUS, OID_HR_PRINTER_ERRORS], community='public',
+                      port=running.port, timeout=1)
+    assert values[OID_HR_PRINTER_STATUS] == (BER_INTEGER, b'\x03')
+    assert values[OID_HR_PRINTER_ERRORS] == (BER_NULL, b'')
+    assert running.requests[0]['community'] == 'public'
+    assert running.requests[0]['type'] == SNMP_GET_REQUEST
+
+
+def test_snmp_get_error_status(agent):
+    running = agent(error_status=2)
+    with pytest.raises(OSError, match='SNMP'):
+        snmp_get('127.0.0.1', [OID_HR_PRINTER_STATUS], port=running.port, timeout=1)
+
+
+def test_snmp_get_timeout(agent):
+    running = agent(silent=True)
+    with pytest.raises(TimeoutError):
+        snmp_get('127.0.0.1', [OID_HR_PRINTER_STATUS], port=running.port, timeout=0.2)
+
+
+def test_query_snmp_status(agent):
+    # hrPrinterDetectedErrorState: 第 1 位 no_media、第 0 位 low_media（警告）、第 4 位 cover_open
+    running = agent(values={
+        OID_HR_PRINTER_STATUS: (BER_INTEGER, b'\x04'),
+        OID_HR_PRINTER_ERRORS: (BER_OCTET_STRING, bytes((0b11001000,))),
+        OID_PRT_INPUT_MEDIA_NAME: (BER_OCTET_STRING, b'62mm'),
+    })
+    status = query_snmp_status('127.0.0.1', port=running.port, timeout=1)
+    assert status['errors'] == ['no_media', 'cover_open']
+    assert status['warnings'] == ['low_media']
+    assert status['busy']
+    assert status['media'] == {'name': '62mm'}
+
+
+# ---- 32 bytes 狀態信息 ----
+
+def raw_status(**fields):
+    data = bytearray(32)
+    data[0:8] = b'\x80\x20\x42\x34\x41\x30\x30\x00'
+    for offset, value in fields.items():
+        data[int(offset[1:])] = value
+    return bytes(data)
+
+
+def test_parse_status_fields():
+    status = parse_status(raw_status(b8=0x01, b9=0x10, b10=62, b11=MEDIA_CONTINUOUS, b18=0x02))
+    assert status['model'] == 'QL-820NWB'
+    assert status['errors'] == ['no_media', 'cover_open']
+    assert status['media_width_mm'] == 62 and status['media_type'] == 'continuous'
+    assert status['status_type'] == 0x02
+
+
+def test_parse_status_busy_and_unknown_codes():
+    status = parse_status(raw_status(b4=0x99, b8=0x10, b11=0x4A, b19=0x01))
+    assert status['model'] == '0x99'
+    assert status['media_type'] == '0x4a'
+    assert status['errors'] == [] and status['busy']
+
+
+@pytest.mark.parametrize('data', [b'', raw_status()[:31], b'\x00' + raw_status()[1:]])
+def test_parse_status_rejects_bad_replies(data):
+    with pytest.raises(ValueError):
+        parse_status(data)
+
+
+# ---- 狀態監控: 暫停等待和轉到其他打印機 ----
+
+class FakeConnection:
+    """以可修改的 32 bytes 狀態信息回覆 9100 狀態查詢"""
+
+    def __init__(self, ip):
+        self.ip = ip
+        self.errors = ()
+        self.busy = False
+        self.queries = 0
+
+    def request_status(self, timeout=2.0, blocking=False):
+        self.queries += 1
+        if self.busy:
+            return None
+        return encode_status(errors=self.errors, media_type=MEDIA_CONTINUOUS, status_type=STATUS_TYPE_REPLY)
+
+
+class FakeConnections:
+    def __init__(self, ips):
+        self.by_ip = {ip: FakeConnection(ip) for ip in ips}
+
+    def get(self, ip, port=9100):
+        return self.by_ip[ip]
+
+
+@pytest.fixture
+def pool_and_monitor():
+    sent = []
+    pool = PrinterPool(lambda data, ip, port: sent.append(ip) or True)
+    for ip in (PRINTER_A, PRINTER_B):
+        pool.add(ip)
+    connections = FakeConnections([PRINTER_A, PRINTER_B])
+    active = set()
+
+    def on_update(ip, status):
+        pool.set_status(ip, status['reason'] if monitor.is_blocking(status) else None, status['busy'])
+
+    monitor = PrinterStatusMonitor(lambda: [(p.ip, p.port) for p in pool.printers()], connections,
+                                   method='raster', interval=0.05, timeout=0.5, on_update=on_update,
+                                   active=lambda ip: ip in active)
+    yield pool, monitor, connections, sent, active
+    for ip in (PRINTER_A, PRINTER_B):
+        pool.remove(ip)
+
+
+def test_reroute_while_printer_reports_error(pool_and_monitor):
+    pool, monitor, connections, sent, _ = pool_and_monitor
+    connections.by_ip[PRINTER_A].errors = ('no_media',)
+    monitor.poll_all()
+    assert not monitor.is_ready(PRINTER_A)
+    assert monitor.status(PRINTER_A)['reason'] == '沒有標籤紙'
+
+    for _ in range(3):
+        assert pool.send(b'label', timeout=2) == (True, PRINTER_B)
+    assert sent == [PRINTER_B] * 3
+    assert monitor.blocked_reason([PRINTER_A, PRINTER_B]) is None
+
+    # 恢復後重新分配任務
+    connections.by_ip[PRINTER_A].errors = ()
+    monitor.poll_all()
+    assert monitor.is_ready(PRINTER_A)
+    assert pool.pick(exclude=(PRINTER_B,)).ip == PRINTER_A
+
+
+def test_hold_until_recovery(pool_and_monitor):
+    _, monitor, connections, _, _ = pool_and_monitor
+    for connection in connections.by_ip.values():
+        connection.errors = ('cover_open',)
+    monitor.poll_all()
+    assert monitor.blocked_reason([PRINTER_A, PRINTER_B]) == f'{PRINTER_A}: 蓋子打開；{PRINTER_B}: 蓋子打開'
+
+    def recover():
+        time.sleep(0.2)
+        connections.by_ip[PRINTER_B].errors = ()
+        monitor.poll(PRINTER_B)
+
+    threading.Thread(target=recover).start()
+    start = time.monotonic()
+    assert monitor.wait_ready(lambda: [PRINTER_A, PRINTER_B], timeout=5)
+    assert 0.1 < time.monotonic() - start < 2
+
+
+def test_hold_timeout_fails_fast_until_recovery(pool_and_monitor):
+    _, monitor, connections, _, _ = pool_and_monitor
+    for connection in connections.by_ip.values():
+        connection.errors = ('cutter_jam',)
+    monitor.poll_all()
+
+    start = time.monotonic()
+    assert not monitor.wait_ready(lambda: [PRINTER_A, PRINTER_B], timeout=0.2)
+    assert time.monotonic() - start >= 0.2
+    # 超時後其他等待立即返回，不會逐個任務再等待
+    start = time.monotonic()
+    assert not monitor.wait_ready(lambda: [PRINTER_A, PRINTER_B], timeout=5)
+    assert time.monotonic() - start < 0.1
+
+    connections.by_ip[PRINTER_A].errors = ()
+    monitor.poll(PRINTER_A)
+    assert monitor.wait_ready(lambda: [PRINTER_A, PRINTER_B], timeout=0.2)
+
+
+def test_unreachable_printer_does_not_block():
+    monitor = PrinterStatusMonitor(lambda: [], None, method='raster')
+    assert not monitor.is_blocking({'ready': False, 'errors': ['unreachable']})
+    assert monitor.is_blocking({'ready': False, 'errors': ['no_media']})
+    assert not monitor.is_blocking(None)
+
+
+def test_poll_only_idle_or_failed_printers(pool_and_monitor):
+    _, monitor, connections, _, active = pool_and_monitor
+    monitor.poll_all()
+    active.add(PRINTER_A)
+    monitor.poll_all()
+    assert connections.by_ip[PRINTER_A].queries == 1
+    assert connections.by_ip[PRINTER_B].queries == 2
+    assert monitor.status(PRINTER_A)['busy']
+    assert monitor.skipped == 1
+
+    # 有錯誤的打印機即使正在接收任務也繼續查詢，以便恢復後立即重新加入
+    connections.by_ip[PRINTER_A].errors = ('no_media',)
+    monitor.poll_all(force=True)
+    monitor.poll_all()
+    assert connections.by_ip[PRINTER_A].queries == 3
+
+
+def test_auto_prefers_snmp_and_falls_back_to_raster(agent):
+    running = agent(values={OID_HR_PRINTER_STATUS: (BER_INTEGER, b'\x03')})
+    connections = FakeConnections([PRINTER_A])
+    monitor = PrinterStatusMonitor(lambda: [(PRINTER_A, 9100)], connections, method='auto', timeout=0.3,
+                                   snmp_port=running.port)
+    assert monitor.poll(PRINTER_A)['method'] == 'snmp'
+    assert connections.by_ip[PRINTER_A].queries == 0
+
+    # agent 不再回覆後打印機只回應 9100 狀態查詢，之後不再嘗試 SNMP
+    running.silent = True
+    assert monitor.poll(PRINTER_A)['method'] == 'raster'
+    assert monitor.method_for(PRINTER_A) == 'raster'
+    assert monitor.poll(PRINTER_A)['method'] == 'raster'
+    assert len(running.requests) == 2
+
+
+def test_truncated_snmp_reply_marks_printer_unreachable(agent):
+    # 打印機 A 回覆不完整的數據包（長度超出數據範圍），不影響同一輪查詢中的打印機 B
+    broken = agent(values={OID_HR_PRINTER_STATUS: (BER_INTEGER, b'\x03')}, truncate=20)
+    agent(values={OID_HR_PRINTER_STATUS: (BER_INTEGER, b'\x03')}, host=PRINTER_B, port=broken.port)
+    monitor = PrinterStatusMonitor(lambda: [(PRINTER_A, 9100), (PRINTER_B, 9100)], None, method='snmp',
+                                   timeout=0.5, snmp_port=broken.port)
+    monitor.poll_all()
+    assert monitor.status(PRINTER_A)['errors'] == ['unreachable']
+    assert 'BER' in monitor.status(PRINTER_A)['detail']
+    assert monitor.is_ready(PRINTER_B)
+
+    broken.truncate = None
+    monitor.poll_all(force=True)
+    assert monitor.is_ready(PRINTER_A)
@@ -0,0 +1,57 @@
+"""
+打印橋接服務的生產環境入口
+
+使用 waitress（多線程 WSGI 服務器，支援 Mac/Linux/Windows）:
+    python printer/wsgi.py
+
+其他 WSGI 服務器使用應用工廠 wsgi:create_app()（或 wsgi:app），但只能運行一個進程（以線程擴展），例如:
+    gunicorn --chdir printer --workers 1 --worker-class gthread --threads 32 'wsgi:create_app()'
+
+waitress 在調用應用之前讀取整個請求體，流式批量打印（NDJSON）要等上傳結束後才開始；
+需要邊上傳邊打印時使用上面的 gunicorn 命令（以 1 KB 為單位把請求體交給應用）
+
+為什麼是一個進程:
+打印任務隊列、打印機池、9100 長連接、已註冊的佈局和當前打印機 IP 都保存在進程內，
+而 QL-820NWB 同一時間只接受一個 9100 連接；多個服務進程會各自持有一份狀態並互相搶佔打印機。
+因此由一個進程負責協調，HTTP 請求由線程處理，CPU 密集的渲染和編碼在渲染進程池（BATCH_PROCESSES）
+中進行，吞吐量隨 CPU 核心數增加
+
+渲染進程由 forkserver（或 spawn）啟動，會以 __mp_main__ 重新導入入口腳本。
+因此本模組頂層不導入 printer_bridge，服務在 create_app() 中才導入並以 printer_bridge.init() 啟動；
+渲染進程只導入渲染模組（batch_renderer、badge_layout 等），不載入應用，也不啟動打印線程或打印機池
+"""
+
+import os
+
+# HTTP 請求線程數（/print?wait= 會佔用一個線程直到任務完成）
+WEB_THREADS = int(os.getenv('WEB_THREADS', 32))
+
+
+def create_app():
+    """應用工廠: 導入打印橋接服務，啟動渲染進程池、打印線程和打印機池，返回 Flask 應用"""
+    if int(os.getenv('WEB_CONCURRENCY', 1)) > 1:
+        print("⚠️  打印橋接服務的狀態保存在進程內，請只運行一個服務進程（以 --threads 擴展）")
+
+    import printer_bridge
+    return printer_bridge.init()
+
+
+def __getattr__(name):
+    """wsgi:app 在第一次訪問時創建應用（只用於 WSGI 服務器載入，渲染進程不會訪問）"""
+    if name == 'app':
+        return create_app()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+if __name__ == '__main__':
+    port = int(os.getenv('PRINTER_BRIDGE_PORT', 5000))
+
+    try:
+        from waitress import serve
+    except ImportError:
+        raise SystemExit("❌ waitress 未安裝，請運行: pip install -r printer/printer_bridge_requirements.txt")
+
+    app = create_app()
+    from printer_bridge import print_startup_banner
+    print_startup_banner(port, f'waitress, {WEB_THREADS} 線程')
+    serve(app, host='0.0.0.0', port=port, threads=WEB_THREADS)